@@ -1,98 +1,1079 @@
-from flask import Flask, request, jsonify, send_from_directory, make_response
+import time
+BOOT_T0 = time.perf_counter()
+#mốc khởi động, đặt trước các import nặng (torch, sentence-transformers) để đo được cả thời gian import
+from flask import Flask, request, jsonify, send_from_directory, send_file, make_response, Response
 import os, certifi, ssl
 os.environ["SSL_CERT_FILE"] = certifi.where()
 os.environ["REQUESTS_CA_BUNDLE"] = certifi.where()
 import asyncio, uuid, os, edge_tts, re, ssl, aiohttp
 import requests, os, uuid, asyncio, threading, edge_tts, re
 from flask_cors import CORS
-from sentence_transformers import SentenceTransformer, util
-from collections import deque
+from sentence_transformers import SentenceTransformer
+from collections import deque, OrderedDict
 from flask import abort
+import torch
 import aiohttp, ssl
 import pyttsx3
+import json, time, queue, hashlib, atexit, sqlite3
+import bisect, contextvars, functools, random, base64, io, shutil, subprocess
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+import numpy as np
 
 app = Flask(__name__)
 CORS(app)
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ========== STARTUP ==========
+#Thời gian từng giai đoạn khởi động (ms), in ra log và trả qua /ready
+STARTUP_TIMINGS = OrderedDict()
+STARTUP_TIMINGS["imports"] = round((time.perf_counter() - BOOT_T0) * 1000.0, 1)
+PREFORK = os.environ.get("CHATBOX_PREFORK", "0") == "1"
+MULTI_WORKER = PREFORK and int(os.environ.get("CHATBOX_WORKERS", "1")) > 1
+#serve.py chạy nhiều worker: request bất kỳ có thể tới worker bất kỳ → chỉ dùng trạng thái nằm trên đĩa / SQLite.
+#Các chế độ giữ trạng thái trong RAM của 1 worker (TTS_ASYNC, TTS_PIPELINE, AUDIO_MEMORY) bị tắt.
+
+
+@contextmanager
+def startup_phase(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS[name] = round((time.perf_counter() - start) * 1000.0, 1)
+        print(f"[STARTUP] {name}: {STARTUP_TIMINGS[name]:.0f} ms")
+
+# ========== METRICS ==========
+#Thời gian từng giai đoạn của request (ms) + bộ đếm fallback / lỗi, xuất ở /metrics
+#(định dạng Prometheus text; ?format=json cho JSON kèm p50/p95/p99 ước lượng từ bucket).
+#Histogram dùng bucket cố định → ghi nhận O(1), không giữ từng mẫu. LOG_TIMINGS=1 → mỗi request in thêm 1 dòng [TIMING] dạng JSON.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+DEBUG_LOG = LOG_LEVEL == "DEBUG"
+DEBUG_PAYLOAD_SAMPLE = float(os.environ.get("DEBUG_PAYLOAD_SAMPLE", "0"))
+#tỉ lệ request in toàn bộ payload gửi LM Studio (chỉ khi LOG_LEVEL=DEBUG): in cả prompt ra stdout rất chậm
+LOG_TIMINGS = os.environ.get("LOG_TIMINGS", "0") == "1"
+#dòng [TIMING] mỗi request (chat_bench.py bật sẵn); /metrics luôn có histogram, không cần bật
+COUNTER_LABELS = {"requests_total": "route", "intent_source_total": "source", "errors_total": "stage",
+                  "fast_path_total": "intent"}
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        #ô cuối: > bucket lớn nhất (+Inf)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float):
+        #Cận trên của bucket chứa phân vị q (ước lượng, đủ để so sánh trước/sau khi tối ưu)
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and c:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else float(LATENCY_BUCKETS_MS[-1])
+        return float(LATENCY_BUCKETS_MS[-1])
+
+
+class RequestTiming:
+    def __init__(self, route: str):
+        self.route = route
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.tags = {}
+
+CURRENT_TIMING = contextvars.ContextVar("current_timing", default=None)
+#request đang xử lý trong luồng / coroutine hiện tại → các hàm sâu bên trong ghi được thời gian vào đúng request
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        #stage → Histogram
+        self.counters = {}
+        #(tên, nhãn) → số đếm
+
+    def _record(self, stage: str, ms: float):
+        with self.lock:
+            hist = self.histograms.get(stage)
+            if hist is None:
+                hist = self.histograms[stage] = Histogram()
+            hist.observe(ms)
+
+    def observe(self, stage: str, ms: float):
+        self._record(stage, ms)
+        timing = CURRENT_TIMING.get()
+        if timing is not None:
+            timing.stages[stage] = round(timing.stages.get(stage, 0.0) + ms, 2)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000.0)
+
+    def inc(self, name: str, label: str = "", n: int = 1):
+        with self.lock:
+            self.counters[(name, label)] = self.counters.get((name, label), 0) + n
+
+    def tag(self, key: str, value):
+        timing = CURRENT_TIMING.get()
+        if timing is not None:
+            timing.tags[key] = value
+
+    def begin(self, route: str) -> RequestTiming:
+        timing = RequestTiming(route)
+        CURRENT_TIMING.set(timing)
+        self.inc("requests_total", route)
+        return timing
+
+    def end(self, timing: RequestTiming):
+        total = (time.perf_counter() - timing.start) * 1000.0
+        timing.stages["total"] = round(total, 2)
+        self._record(f"{timing.route}_total", total)
+        if LOG_TIMINGS:
+            print("[TIMING] " + json.dumps({"route": timing.route, **timing.tags, "ms": timing.stages}))
+        if CURRENT_TIMING.get() is timing:
+            CURRENT_TIMING.set(None)
+
+    def snapshot(self):
+        with self.lock:
+            stages = {
+                name: {
+                    "count": h.count,
+                    "mean_ms": (h.sum / h.count) if h.count else 0.0,
+                    "p50_ms": h.quantile(0.50),
+                    "p95_ms": h.quantile(0.95),
+                    "p99_ms": h.quantile(0.99),
+                } for name, h in self.histograms.items()
+            }
+            counters = {}
+            for (name, label), value in self.counters.items():
+                counters.setdefault(name, {})[label or "all"] = value
+            return {"stages": stages, "counters": counters}
+
+    def prometheus(self, gauges) -> str:
+        lines = ["# TYPE chatbox_stage_latency_ms histogram"]
+        with self.lock:
+            for name, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for le, c in zip(list(LATENCY_BUCKETS_MS) + ["+Inf"], h.counts):
+                    cumulative += c
+                    lines.append(f'chatbox_stage_latency_ms_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'chatbox_stage_latency_ms_sum{{stage="{name}"}} {h.sum:.3f}')
+                lines.append(f'chatbox_stage_latency_ms_count{{stage="{name}"}} {h.count}')
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                lines.append(f"# TYPE chatbox_{name} counter")
+                for (n, label), value in sorted(self.counters.items()):
+                    if n == name:
+                        key = COUNTER_LABELS.get(name, "kind")
+                        lines.append(f'chatbox_{name}{{{key}="{label}"}} {value}' if label else f"chatbox_{name} {value}")
+        for name, value in gauges:
+            lines.append(f"chatbox_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+
+def timed_request(route: str):
+    #Bọc 1 route: đo tổng thời gian + các giai đoạn bên trong, in 1 dòng [TIMING] khi xong
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            timing = METRICS.begin(route)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                METRICS.end(timing)
+        return wrapper
+    return decorator
+
 # ========== INTENT DETECTION ==========
-EMB_MODEL = SentenceTransformer('all-MiniLM-L6-v2')
+EMB_MODEL_NAME = os.environ.get("EMB_MODEL_NAME", "all-MiniLM-L6-v2")
 #Model "all-MiniLM-L6-v2" là loại Sentence Transformer đã được huấn luyện trước (pretrained) để hiểu ngữ nghĩa câu tiếng Anh.
 #Ví dụ: “hello” và “hi there” → hai câu này nghĩa gần giống nhau, nên model tạo ra hai vector cũng gần nhau
-INTENT_EXAMPLES = {
-    "greeting": ["hello", "hi", "hey there", "how are you"],
-    "ask_direction": [
-        "where is the village", "how do I get to the village", "show me the way",
-        "which way to go", "guide me", "how to reach the town", "where is the town"
-    ],
-    "combat": ["attack", "fight", "kill the wolf", "start combat", "go fight", "battle"],
-    "trade": ["open shop", "show me your wares", "buy items", "sell goods", "trade"],
-    "farewell": ["goodbye", "bye", "see you", "take care", "farewell"],
-    "ask_for_quest": [
-        "do you need help", "do you need anything", "can I help you", 
-        "any task for me", "do you have work for me", "need assistance",
-        "what can I do for you", "any quests", "got any jobs"
-    ],
-    "quest_confirmation": [
-        "yes I will help", "sure I'll help", "okay I accept", "yes let's do it",
-        "I agree", "count me in", "yes", "sure", "okay", "alright"
-    ],
-    "quest_status": [
-        "what is my quest", "show my quests", "what tasks do I have",
-        "check my quest progress", "quest status", "how is my quest going",
-        "what am I supposed to do"
-    ],
-    "complete_quest": [
-        "I finished the quest", "quest done", "I completed the task",
-        "here are the items", "I have what you need", "task completed",
-        "I'm done with the quest", "turn in quest"
-    ]
+INTENT_INDEX_DIR = os.path.abspath(os.environ.get("INTENT_INDEX_DIR", os.path.join(BASE_DIR, "intent_index~")))
+#thư mục "~" bị Unity bỏ qua (không import, không sinh .meta), cố định theo BASE_DIR thay vì thư mục đang chạy
+INTENT_EXAMPLES_PATH = os.environ.get("INTENT_EXAMPLES_PATH", os.path.join(BASE_DIR, "intent_examples.json"))
+INTENT_TOP_K = int(os.environ.get("INTENT_TOP_K", "3"))
+INTENT_CANDIDATES = int(os.environ.get("INTENT_CANDIDATES", "32"))
+#số câu ví dụ gần nhất được lấy ra trước khi gom theo intent
+INTENT_ANN = os.environ.get("INTENT_ANN", "auto")
+#exact | hnsw | auto (HNSW khi bộ ví dụ có từ INTENT_ANN_MIN câu và đã cài hnswlib)
+INTENT_ANN_MIN = int(os.environ.get("INTENT_ANN_MIN", "2000"))
+INTENT_RELOAD_INTERVAL = float(os.environ.get("INTENT_RELOAD_INTERVAL", "2"))
+EMB_WARMUP = os.environ.get("EMB_WARMUP", "1") == "1"
+EMB_BACKEND = os.environ.get("EMB_BACKEND", "torch")
+#torch: PyTorch fp32 (mặc định) | torch-int8: lượng tử hóa động các lớp Linear (không cần thư viện thêm)
+#onnx: ONNX Runtime fp32 | onnx-int8: ONNX Runtime + trọng số int8 (cần optimum[onnxruntime])
+#Trên máy chỉ có CPU, bản int8 encode nhanh hơn và chiếm ít RAM hơn; kiểm tra độ lệch bằng intent_parity.py.
+EMB_ONNX_FILE = os.environ.get("EMB_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+#file int8 dựng sẵn trong repo model trên HuggingFace; không có thì tự lượng tử hóa vào INTENT_INDEX_DIR
+
+
+def load_torch_model(name: str):
+    return SentenceTransformer(name)
+
+
+def load_torch_int8_model(name: str):
+    model = SentenceTransformer(name, device="cpu")
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    #inplace: không giữ song song bản fp32 trong RAM
+
+
+def load_onnx_model(name: str):
+    return SentenceTransformer(name, backend="onnx", device="cpu")
+
+
+def load_onnx_int8_model(name: str):
+    try:
+        return SentenceTransformer(name, backend="onnx", device="cpu", model_kwargs={"file_name": EMB_ONNX_FILE})
+    except Exception as e:
+        print(f"[EMB] {EMB_ONNX_FILE} not available for {name} ({e}), quantizing locally")
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+    export_dir = os.path.join(INTENT_INDEX_DIR, "onnx-" + re.sub(r"[^\w.-]+", "_", name))
+    quantized = os.path.join(export_dir, "onnx", "model_qint8_avx2.onnx")
+    if not os.path.exists(quantized):
+        model = SentenceTransformer(name, backend="onnx", device="cpu")
+        model.save(export_dir)
+        export_dynamic_quantized_onnx_model(model, "avx2", export_dir)
+    return SentenceTransformer(export_dir, backend="onnx", device="cpu",
+                               model_kwargs={"file_name": "onnx/model_qint8_avx2.onnx"})
+
+
+EMB_BACKENDS = {
+    "torch": load_torch_model,
+    "torch-int8": load_torch_int8_model,
+    "onnx": load_onnx_model,
+    "onnx-int8": load_onnx_int8_model,
 }
 
-INTENT_EMB = {k: EMB_MODEL.encode(v, convert_to_tensor=True) for k, v in INTENT_EXAMPLES.items()}
-INTENT_THRESHOLD = 0.55
 
-OLLAMA_URL = "http://127.0.0.1:1234/v1/chat/completions"
+class LazyEmbeddingModel:
+    #Model chỉ được nạp khi cần encode lần đầu (hoặc bởi luồng warm-up lúc khởi động),
+    #nên import ChatBox không phải chờ nạp model khi đã có sẵn file embedding của các câu ví dụ.
+    #Mọi nơi cần embedding chỉ gọi .encode(...) (cùng tham số với SentenceTransformer.encode), không phụ thuộc backend.
+    def __init__(self, name: str, backend: str = "torch"):
+        self.name = name
+        self.backend = backend
+        self._model = None
+        self._lock = threading.Lock()
+        self.error = None
+
+    def _load(self):
+        loader = EMB_BACKENDS.get(self.backend)
+        if loader is None:
+            print(f"[EMB] unknown backend '{self.backend}', using torch")
+            self.backend = "torch"
+            loader = load_torch_model
+        try:
+            return loader(self.name)
+        except Exception as e:
+            if self.backend == "torch":
+                raise
+            print(f"[EMB] backend '{self.backend}' failed ({e}), falling back to torch")
+            self.error = f"{self.backend}: {e}"
+            self.backend = "torch"
+            return load_torch_model(self.name)
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def get(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    try:
+                        with startup_phase("emb_model_load"):
+                            self._model = self._load()
+                    except Exception as e:
+                        self.error = str(e)
+                        raise
+        return self._model
+
+    def encode(self, *args, **kwargs):
+        return self.get().encode(*args, **kwargs)
+
+EMB_MODEL = LazyEmbeddingModel(EMB_MODEL_NAME, EMB_BACKEND)
+
+# ========== EMBEDDING MICRO-BATCHER ==========
+#Nhiều /chat đồng thời, mỗi request encode 1 câu → model chạy nhiều forward pass nhỏ, tốn CPU nhất.
+#Batcher gom các lời gọi encode đến trong vòng EMB_BATCH_WAIT_MS ms (hoặc tới khi đủ EMB_BATCH_MAX câu)
+#thành 1 lần encode, rồi trả phần kết quả của từng request qua Future. EMB_BATCH_WAIT_MS=0 → encode trực tiếp.
+EMB_BATCH_WAIT_MS = float(os.environ.get("EMB_BATCH_WAIT_MS", "3"))
+EMB_BATCH_MAX = int(os.environ.get("EMB_BATCH_MAX", "64"))
+
+
+class EmbeddingBatcher:
+    def __init__(self, max_batch: int, wait_ms: float):
+        self.max_batch = max(1, max_batch)
+        self.wait = max(0.0, wait_ms) / 1000.0
+        self.q = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.texts = 0
+        self.batch_sizes = deque(maxlen=512)
+        self.wait_ms = deque(maxlen=512)
+        self.encode_ms = deque(maxlen=512)
+
+    def _ensure_worker(self):
+        #Luồng worker được tạo ở lần dùng đầu tiên của mỗi process (luồng không sống sót qua fork của launcher nhiều worker)
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.q = queue.Queue()
+                    threading.Thread(target=self._worker, name="emb-batcher", daemon=True).start()
+                    self.pid = os.getpid()
+
+    def encode(self, texts):
+        #Trả tensor (len(texts) x D) đã chuẩn hóa, giống EMB_MODEL.encode(texts, convert_to_tensor=True, normalize_embeddings=True)
+        if self.wait <= 0 or len(texts) >= self.max_batch:
+            return EMB_MODEL.encode(texts, convert_to_tensor=True, normalize_embeddings=True)
+        #tắt batching, hoặc bản thân request đã là 1 lô lớn (/intent/batch)
+        self._ensure_worker()
+        fut = Future()
+        self.q.put((list(texts), fut, time.monotonic()))
+        return fut.result()
+
+    def _collect(self):
+        first = self.q.get()
+        batch, n = [first], len(first[0])
+        deadline = time.monotonic() + self.wait
+        while n < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.q.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            n += len(item[0])
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._collect()
+            start = time.monotonic()
+            unique = list(dict.fromkeys(t for texts, _, _ in batch for t in texts))
+            #câu trùng giữa các request trong cùng lô chỉ encode 1 lần
+            try:
+                emb = EMB_MODEL.encode(unique, convert_to_tensor=True, normalize_embeddings=True)
+            except Exception as e:
+                for _, fut, _ in batch:
+                    fut.set_exception(e)
+                continue
+            pos = {t: i for i, t in enumerate(unique)}
+            for texts, fut, _ in batch:
+                fut.set_result(emb[[pos[t] for t in texts]])
+            done = time.monotonic()
+            with self.lock:
+                self.requests += len(batch)
+                self.batches += 1
+                self.texts += len(unique)
+                self.batch_sizes.append(len(unique))
+                self.encode_ms.append((done - start) * 1000.0)
+                self.wait_ms.extend((start - enqueued) * 1000.0 for _, _, enqueued in batch)
+
+    def stats(self):
+        with self.lock:
+            sizes, wait_ms, encode_ms = list(self.batch_sizes), list(self.wait_ms), list(self.encode_ms)
+            return {
+                "enabled": self.wait > 0,
+                "max_batch": self.max_batch,
+                "window_ms": self.wait * 1000.0,
+                "queue_depth": self.q.qsize() if self.q is not None else 0,
+                "requests": self.requests,
+                "batches": self.batches,
+                "texts": self.texts,
+                "requests_per_batch": (self.requests / self.batches) if self.batches else 0.0,
+                "batch_size": {"p50": percentile(sizes, 50), "p95": percentile(sizes, 95), "max": max(sizes, default=0)},
+                "queue_wait_ms": {"p50": percentile(wait_ms, 50), "p95": percentile(wait_ms, 95)},
+                "encode_ms": {"p50": percentile(encode_ms, 50), "p95": percentile(encode_ms, 95)},
+            }
+
+EMB_BATCHER = EmbeddingBatcher(EMB_BATCH_MAX, EMB_BATCH_WAIT_MS)
+
+
+def intent_index_key(examples: dict) -> str:
+    #Tên file embedding = tên model + hash của bộ câu ví dụ → đổi model hoặc sửa ví dụ thì file cũ tự "hết hạn"
+    backend = EMB_MODEL.backend
+    #backend thực sự dùng: EMB_BACKEND lỗi khi nạp thì EMB_MODEL đã chuyển sang torch
+    blob = json.dumps({"model": EMB_MODEL_NAME, "backend": backend, "examples": examples},
+                      sort_keys=True, ensure_ascii=False)
+    model_slug = re.sub(r"[^\w.-]+", "_", f"{EMB_MODEL_NAME}-{backend}")
+    #backend khác (int8, onnx) cho embedding hơi khác → mỗi backend 1 file riêng
+    return f"{model_slug}-{hashlib.sha256(blob.encode('utf-8')).hexdigest()[:16]}"
+
+
+def load_intent_embeddings(examples: dict, texts):
+    #Đọc ma trận embedding các câu ví dụ từ INTENT_INDEX_DIR bằng memory-map (copy-on-write: nhiều process
+    #dùng chung trang bộ nhớ của file). Chưa có / hỏng → encode bằng model rồi ghi file mới (ghi tạm + rename).
+    key = intent_index_key(examples)
+    npy_path = os.path.join(INTENT_INDEX_DIR, key + ".npy")
+    meta_path = os.path.join(INTENT_INDEX_DIR, key + ".json")
+    #file theo backend cấu hình (model chưa nạp); nếu backend đó hỏng, IntentIndexRegistry.get dựng lại sau khi nạp
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        matrix = np.load(npy_path, mmap_mode="c")
+        if meta.get("count") == len(texts) and matrix.shape[0] == len(texts):
+            print(f"[INTENT] loaded example embeddings {key} (mmap)")
+            return torch.from_numpy(matrix)
+    except (OSError, ValueError, KeyError):
+        pass
+    matrix = EMB_MODEL.encode(texts, convert_to_tensor=True, normalize_embeddings=True).detach().cpu().float().numpy()
+    key = intent_index_key(examples)
+    npy_path = os.path.join(INTENT_INDEX_DIR, key + ".npy")
+    meta_path = os.path.join(INTENT_INDEX_DIR, key + ".json")
+    #tính lại sau khi encode: model vừa nạp có thể đã chuyển backend
+    try:
+        os.makedirs(INTENT_INDEX_DIR, exist_ok=True)
+        tmp = f"{npy_path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, matrix)
+        os.replace(tmp, npy_path)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"model": EMB_MODEL_NAME, "backend": EMB_MODEL.backend, "count": len(texts), "dim": int(matrix.shape[1]),
+                       "created": time.time()}, f)
+        os.replace(meta_path + ".tmp", meta_path)
+        print(f"[INTENT] built example embeddings {key}")
+    except OSError as e:
+        print(f"[INTENT] cannot write example embeddings to {INTENT_INDEX_DIR}: {e}")
+    return torch.from_numpy(matrix)
+
+
+def remove_stale_intent_files(live_keys):
+    #Xóa file embedding / HNSW của các bộ ví dụ cũ (cùng model + backend) không còn được dùng
+    prefix = re.sub(r"[^\w.-]+", "_", f"{EMB_MODEL_NAME}-{EMB_MODEL.backend}")
+    stale = re.compile(re.escape(prefix) + r"-([0-9a-f]{16})\.(?:npy|json|hnsw)")
+    try:
+        for name in os.listdir(INTENT_INDEX_DIR):
+            m = stale.fullmatch(name)
+            if m and f"{prefix}-{m.group(1)}" not in live_keys:
+                os.remove(os.path.join(INTENT_INDEX_DIR, name))
+    except OSError:
+        pass
+
+
+class IntentIndex:
+    #1 bộ câu ví dụ đã encode (N x D, chuẩn hóa). Chấm điểm theo láng giềng gần nhất:
+    #lấy INTENT_CANDIDATES câu ví dụ gần câu người chơi nhất (tìm chính xác bằng 1 phép nhân ma trận,
+    #hoặc gần đúng bằng HNSW khi bộ ví dụ lớn), gom theo intent, điểm intent = trung bình top-k cosine
+    #(k = min(INTENT_TOP_K, số câu ví dụ của intent)). Thêm câu ví dụ không làm loãng điểm như trung bình
+    #trên toàn bộ ví dụ trước đây, và với HNSW chi phí mỗi request gần như không tăng theo N.
+    def __init__(self, examples: dict, matrix=None):
+        self.examples = examples
+        self.labels = list(examples.keys())
+        texts, label_idx = [], []
+        for i, label in enumerate(self.labels):
+            texts.extend(examples[label])
+            label_idx.extend([i] * len(examples[label]))
+        self.matrix = load_intent_embeddings(examples, texts) if matrix is None else matrix
+        self.key = intent_index_key(examples)
+        self.backend = EMB_MODEL.backend
+        #tính sau khi có ma trận: nếu vừa nạp model (và phải chuyển backend) thì key theo backend thực tế
+        self.label_idx = torch.tensor(label_idx, dtype=torch.long)
+        counts = torch.bincount(self.label_idx, minlength=len(self.labels))
+        self.k_per_label = counts.clamp(min=1, max=INTENT_TOP_K).to(self.matrix.dtype)
+        self.ann = self._build_ann() if matrix is None else None
+        self.kind = "hnsw" if self.ann is not None else "exact"
+
+    def _build_ann(self):
+        n = len(self.label_idx)
+        if INTENT_ANN == "exact" or (INTENT_ANN == "auto" and n < INTENT_ANN_MIN):
+            return None
+        try:
+            import hnswlib
+        except ImportError:
+            if INTENT_ANN == "hnsw":
+                print("[INTENT] hnswlib not installed, using exact search")
+            return None
+        index = hnswlib.Index(space="ip", dim=int(self.matrix.shape[1]))
+        path = os.path.join(INTENT_INDEX_DIR, self.key + ".hnsw")
+        try:
+            index.load_index(path, max_elements=n)
+        except (OSError, RuntimeError):
+            index.init_index(max_elements=n, ef_construction=200, M=16)
+            index.add_items(self.matrix.numpy(), np.arange(n))
+            try:
+                index.save_index(path)
+            except (OSError, RuntimeError) as e:
+                print(f"[INTENT] cannot save HNSW index: {e}")
+        index.set_ef(max(64, 2 * INTENT_CANDIDATES))
+        return index
+
+    def neighbours(self, q):
+        k = min(INTENT_CANDIDATES, len(self.label_idx))
+        if self.ann is not None:
+            ids, dist = self.ann.knn_query(q.numpy(), k=k)
+            return 1.0 - torch.from_numpy(dist).to(q.dtype), torch.from_numpy(ids.astype(np.int64))
+        #HNSW với space="ip" trả khoảng cách = 1 - tích vô hướng
+        return (q @ self.matrix.T).topk(k, dim=1)
+
+    def score(self, sent_emb):
+        #sent_emb: (B x D) đã chuẩn hóa → cosine = tích vô hướng. Trả [(intent, điểm)] cho từng câu.
+        q = sent_emb.detach().to("cpu", self.matrix.dtype)
+        sims, ids = self.neighbours(q)
+        #sims, ids: (B x K), xếp giảm dần theo cosine
+        onehot = torch.nn.functional.one_hot(self.label_idx[ids], len(self.labels)).to(sims.dtype)
+        rank = onehot.cumsum(dim=1) * onehot
+        #thứ hạng (từ 1) của mỗi láng giềng trong intent của nó; 0 ở các cột intent khác
+        keep = (rank > 0) & (rank <= self.k_per_label)
+        scores = (sims.unsqueeze(2) * keep).sum(dim=1) / self.k_per_label
+        best_score, best_idx = scores.max(dim=1)
+        return [(self.labels[i], float(sc)) for i, sc in zip(best_idx.tolist(), best_score.tolist())]
+
+    def stats(self):
+        return {"key": self.key, "backend": self.backend, "kind": self.kind, "intents": len(self.labels),
+                "examples": len(self.label_idx)}
+
+
+def load_intent_example_sets(path: str) -> dict:
+    #{"intents": {...}, "npcs": {"<npc_id>": {"inherit": true, "intents": {...}}}}
+    #inherit (mặc định true): câu ví dụ riêng của NPC được cộng thêm vào bộ mặc định; false: chỉ dùng bộ riêng
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    default = data["intents"]
+    sets = {"default": default}
+    for npc_id, spec in (data.get("npcs") or {}).items():
+        own = spec.get("intents") or {}
+        if spec.get("inherit", True):
+            own = {label: default.get(label, []) + own.get(label, []) for label in {**default, **own}}
+        sets[npc_id] = own
+    return sets
+
+
+class IntentIndexRegistry:
+    #Các IntentIndex theo npc_id ("default" cho NPC không có bộ riêng), nạp từ intent_examples.json.
+    #Luồng nền kiểm tra mtime của file mỗi INTENT_RELOAD_INTERVAL giây (hoặc POST /intent/reload):
+    #bộ mới được encode xong mới thay thế bộ cũ, request đang chạy vẫn dùng bộ cũ. File lỗi → giữ bộ cũ.
+    def __init__(self, path: str):
+        self.path = path
+        self.indexes = {}
+        self.mtime = None
+        self.lock = threading.Lock()
+        self.reloads = 0
+        self.errors = 0
+        self.last_error = None
+
+    def load(self):
+        with self.lock:
+            mtime = os.path.getmtime(self.path)
+            sets = load_intent_example_sets(self.path)
+            by_key = {ix.key: ix for ix in self.indexes.values()}
+            indexes = {}
+            for name, examples in sets.items():
+                key = intent_index_key(examples)
+                indexes[name] = by_key.get(key) or by_key.setdefault(key, IntentIndex(examples))
+            #bộ ví dụ không đổi (kể cả NPC có bộ giống hệt nhau) → dùng lại index đã có
+            self.indexes = indexes
+            self.mtime = mtime
+            remove_stale_intent_files({ix.key for ix in indexes.values()})
+
+    def reload(self) -> bool:
+        try:
+            self.load()
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            try:
+                self.mtime = os.path.getmtime(self.path)
+            except OSError:
+                pass
+            #không thử lại bản lỗi này mỗi vòng theo dõi; sửa file (mtime đổi) thì nạp lại
+            self.errors += 1
+            self.last_error = str(e)
+            print(f"[INTENT] reload of {self.path} failed, keeping previous index: {e}")
+            return False
+        self.reloads += 1
+        self.last_error = None
+        print(f"[INTENT] reloaded {self.path}: " + ", ".join(f"{n}={ix.kind}/{len(ix.label_idx)}" for n, ix in self.indexes.items()))
+        return True
+
+    def watch(self):
+        while True:
+            time.sleep(INTENT_RELOAD_INTERVAL)
+            try:
+                changed = os.path.getmtime(self.path) != self.mtime
+            except OSError:
+                continue
+            if changed:
+                self.reload()
+
+    def get(self, npc_id=None) -> IntentIndex:
+        indexes = self.indexes
+        index = indexes.get(npc_id) or indexes["default"]
+        if index.backend != EMB_MODEL.backend and self.reload():
+            indexes = self.indexes
+            index = indexes.get(npc_id) or indexes["default"]
+        #index nạp từ file của backend cấu hình nhưng model lại chuyển sang torch → encode lại ví dụ bằng backend thực tế
+        return index
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "sets": {name: ix.stats() for name, ix in self.indexes.items()},
+            "top_k": INTENT_TOP_K,
+            "candidates": INTENT_CANDIDATES,
+            "reloads": self.reloads,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
+
+INTENT_INDEXES = IntentIndexRegistry(INTENT_EXAMPLES_PATH)
+with startup_phase("intent_index"):
+    INTENT_INDEXES.load()
+INTENT_EXAMPLES = INTENT_INDEXES.get().examples
+#bộ mặc định lúc khởi động; danh sách nhãn cho LLM (VALID_INTENTS) chỉ cập nhật khi khởi động lại
+INTENT_THRESHOLD = float(os.environ.get("INTENT_THRESHOLD", "0.6"))
+#ngưỡng cho điểm top-k (cao hơn điểm trung bình toàn bộ ví dụ trước đây nên ngưỡng cũng cao hơn 0.55 cũ)
+INTENT_BATCH_MAX = 256
+
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://127.0.0.1:1234/v1/chat/completions")
+#đổi được để trỏ tới LM Studio khác máy hoặc LLM giả lập của chat_bench.py
 MODEL_NAME = "Llama-3.2-3B-Instruct-GGUF"
 
-system_prompt = (
-    "You are Snow, a gentle young girl in the countryside. "
-    "You are picking wildflowers in a sunny meadow, wearing a white dress. "
-    "You are kind, soft-spoken, sometimes shy, but warm-hearted. "
-    "Always reply as Snow, briefly and naturally.\n"
-    "Never include code blocks, JSON, or technical details. Speak like a person.\n"
-)
+# ========== NPC PERSONAS ==========
+#Mỗi NPC (chọn bằng "npc_id" trong request, thiếu/không rõ → default_npc) có trong npc_personas.json:
+#  - system_prompt: persona, ghép với "style" chung thành prefix prompt 1 lần lúc nạp (prefix cố định → KV cache)
+#  - actions: bảng intent → {"action", "params"} ghi đè / bổ sung bảng "actions" chung ("intent": null → NONE)
+#  - canned: intent → danh sách câu trả lời soạn sẵn cho đường tắt (FAST_PATH), ghi đè bảng "canned" chung
+#Bộ câu ví dụ intent riêng của NPC nằm ở intent_examples.json (mục "npcs", cùng npc_id), embedding đã tính sẵn.
+NPC_PERSONAS_PATH = os.environ.get("NPC_PERSONAS_PATH", os.path.join(BASE_DIR, "npc_personas.json"))
+
+
+class Persona:
+    def __init__(self, npc_id: str, spec: dict, style: str, default_actions: dict, default_canned: dict):
+        self.npc_id = npc_id
+        self.name = spec.get("name") or npc_id
+        prompt = spec["system_prompt"]
+        self.prefix = ("".join(prompt) if isinstance(prompt, list) else prompt) + style
+        actions = {**default_actions, **(spec.get("actions") or {})}
+        self.actions = {intent: (a["action"], a.get("params") or {}) for intent, a in actions.items() if a}
+        canned = {**default_canned, **(spec.get("canned") or {})}
+        self.canned = {intent: list(lines) for intent, lines in canned.items() if lines}
+
+    def action_for(self, intent):
+        action, params = self.actions.get(intent, ("NONE", {}))
+        return action, dict(params)
+        #bản sao: params trả về cho từng request, không dùng chung dict của bảng
+
+    def canned_line(self, intent, avoid=None):
+        lines = self.canned.get(intent)
+        if not lines:
+            return None
+        return random.choice([line for line in lines if line != avoid] or lines)
+        #tránh lặp lại đúng câu NPC vừa nói ở lượt trước
+
+
+class PersonaRegistry:
+    def __init__(self, path: str):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        style = data.get("style") or ""
+        if isinstance(style, list):
+            style = "".join(style)
+        default_actions = data.get("actions") or {}
+        default_canned = data.get("canned") or {}
+        self.personas = {npc_id: Persona(npc_id, spec, style, default_actions, default_canned)
+                         for npc_id, spec in data["npcs"].items()}
+        self.default = self.personas[data.get("default_npc") or next(iter(self.personas))]
+
+    def get(self, npc_id=None) -> Persona:
+        return self.personas.get(npc_id) or self.default
+
+    def stats(self):
+        return {
+            "default_npc": self.default.npc_id,
+            "npcs": {
+                npc_id: {
+                    "name": p.name,
+                    "prefix_tokens_est": count_tokens(p.prefix),
+                    "actions": len(p.actions),
+                    "canned_lines": sum(len(lines) for lines in p.canned.values()),
+                    "intent_set": INTENT_INDEXES.get(npc_id).key,
+                } for npc_id, p in self.personas.items()
+            },
+        }
+
+PERSONAS = PersonaRegistry(NPC_PERSONAS_PATH)
 
 VOICE, RATE, PITCH = "en-US-JennyNeural", "-10%", "+4Hz"
-SESSIONS = {}
 
-MAX_TURNS = 20
+MAX_TURNS = int(os.environ.get("MAX_TURNS", "100"))
+#Số message tối đa lưu cho mỗi session; phần đưa vào prompt được cắt theo ngân sách token (PROMPT_TOKEN_BUDGET)
+
+INTENT_CACHE_SIZE = int(os.environ.get("INTENT_CACHE_SIZE", "2048"))
+
+def normalize_utterance(text: str) -> str:
+    #"Hi!", "hi", "  HI  " → "hi": khóa cache dùng chung cho các câu chỉ khác hoa/thường, khoảng trắng, dấu câu cuối.
+    return re.sub(r"\s+", " ", (text or "").lower()).strip().rstrip(".!?~ ")
+
+
+class EmbeddingCache:
+    #Cache LRU có giới hạn, an toàn đa luồng: text đã chuẩn hóa → (embedding, (intent, score)).
+    #Người chơi lặp lại các câu ngắn ("hi", "yes", "bye") rất nhiều → tránh encode lại.
+    def __init__(self, maxsize: int):
+        self.maxsize = max(0, maxsize)
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry
 
-#hàm này là bộ so khớp ngữ nghĩa giữa câu người dùng và các ví dụ intent, dùng cosine similarity để chấm điểm và chọn intent có độ giống ngữ nghĩa cao nhất.
-def detect_intent_semantic(text: str):
+    def put(self, key: str, emb, result):
+        if self.maxsize == 0:
+            return
+        with self._lock:
+            self._data[key] = (emb, result)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+INTENT_CACHE = EmbeddingCache(INTENT_CACHE_SIZE)
+
+#Bộ so khớp ngữ nghĩa giữa câu người dùng và các câu ví dụ intent (của NPC đang nói chuyện),
+#dùng cosine similarity với các câu ví dụ gần nhất để chấm điểm và chọn intent.
+def detect_intent_semantic_batch(texts, npc_id=None):
+    #Phân loại nhiều câu trong 1 lần encode (1 forward pass) → dùng cho các cảnh đông NPC.
+    index = INTENT_INDEXES.get(npc_id)
+    results = [("other", 0.0)] * len(texts)
+    #câu rỗng → ("other", 0.0), giống detect_intent_semantic
+    misses = {}
+    #khóa đã chuẩn hóa → các vị trí trong texts; câu trùng nhau trong cùng batch chỉ encode 1 lần
+    for i, t in enumerate(texts):
+        key = normalize_utterance(t)
+        if not key:
+            continue
+        key = f"{index.key}|{key}"
+        #khóa cache gồm cả bộ ví dụ: NPC khác / file ví dụ vừa nạp lại → không dùng nhầm kết quả cũ
+        if key in misses:
+            misses[key].append(i)
+            continue
+        hit = INTENT_CACHE.get(key)
+        if hit is not None:
+            results[i] = hit[1]
+        else:
+            misses[key] = [i]
+    if not misses:
+        return results
+    keys = list(misses.keys())
+    sent_emb = EMB_BATCHER.encode([k.split("|", 1)[1] for k in keys])
+    #qua micro-batcher: các /chat đồng thời dùng chung 1 lần encode
+    for key, emb, res in zip(keys, sent_emb, index.score(sent_emb)):
+        INTENT_CACHE.put(key, emb.detach().cpu(), res)
+        for i in misses[key]:
+            results[i] = res
+    return results
+
+
+def detect_intent_semantic(text: str, npc_id=None):
     if not text:
         return "other", 0.0
     #nếu input rỗng → không thể suy ý định → trả ("other", 0.0)
-    sent_emb = EMB_MODEL.encode(text, convert_to_tensor=True)
-    #Mã hóa câu đầu vào thành vector nhúng (embedding vector) sử dụng mô hình Sentence Transformer đã tải trước đó.
-    #convert_to_tensor=True giúp .encode() trả thẳng tensor thay vì mảng numpy
-    best_intent, best_score = "other", -1.0
-    #Khởi tạo kết quả tạm thời. -1.0 để đảm bảo bất kỳ điểm cosine hợp lệ nào (≥ -1) cũng sẽ lớn hơn giá trị khởi tạo này.
-    for intent, ex_emb in INTENT_EMB.items():
-        score = float(util.cos_sim(sent_emb, ex_emb).mean().item())
-        if score > best_score:
-            best_intent, best_score = intent, score
-    return best_intent, best_score
-#text = "can you show me the way to the town?"
-#greeting: ví dụ kiểu “hello, hi…” → cosine thấp.
-#ask_direction: ví dụ “where is the village / show me the way …” → cosine cao ở hầu hết ví dụ → điểm trung bình cao.
-#Kết quả: ("ask_direction", ~0.82) chẳng hạn.
-def classify_intent_llama(text: str) -> str:
-    payload = {
+    return detect_intent_semantic_batch([text], npc_id)[0]
+# ========== LM STUDIO CLIENT ==========
+#Mọi lời gọi tới LM Studio đi qua 1 client dùng chung: requests.Session giữ kết nối keep-alive,
+#và bộ điều tiết giới hạn số request đồng thời tới model cục bộ. Quá giới hạn thì xếp hàng (có hạn chờ);
+#hàng đợi đầy hoặc quá hạn → từ chối ngay (LlmBusyError) để trả câu trả lời dự phòng thay vì làm chậm tất cả.
+LLM_MAX_INFLIGHT = int(os.environ.get("LLM_MAX_INFLIGHT", "2"))
+LLM_MAX_WAITING = int(os.environ.get("LLM_MAX_WAITING", "16"))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", "20"))
+LLM_SESSIONS_KEEP = 10000
+#số session nhớ số thứ tự lượt chat mới nhất (đủ để lượt cũ không thay thế lượt mới)
+BUSY_REPLY = "Ah... sorry, give me a moment. So many people are talking to me at once."
+
+#Thứ tự ưu tiên trong hàng đợi (số nhỏ = ưu tiên cao). Xác nhận / nộp quest đi trước nói chuyện phiếm.
+#Request chờ lâu được "già hóa": mỗi LLM_PRIORITY_AGING giây chờ tăng 1 bậc ưu tiên → không ai bị bỏ đói.
+LLM_INTENT_PRIORITY = {
+    "quest_confirmation": 0,
+    "complete_quest": 0,
+    "ask_for_quest": 1,
+    "quest_status": 1,
+    "ask_direction": 1,
+    "combat": 1,
+    "trade": 1,
+}
+LLM_CLASSIFY_PRIORITY = 1
+LLM_DEFAULT_PRIORITY = 2
+LLM_PRIORITY_AGING = 5.0
+
+
+def llm_priority(intent) -> int:
+    return LLM_INTENT_PRIORITY.get(intent, LLM_DEFAULT_PRIORITY)
+
+
+class LlmBusyError(Exception):
+    pass
+
+
+class LlmSupersededError(Exception):
+    #Người chơi đã gửi câu mới trong cùng session → kết quả của request cũ sẽ bị client bỏ đi.
+    pass
+
+
+class LlmTicket:
+    def __init__(self, session_id, priority: int, seq: int, request: int):
+        self.session_id = session_id
+        self.priority = priority
+        self.seq = seq
+        self.request = request
+        #số thứ tự lượt chat sở hữu ticket (1 lượt có thể dùng 2 ticket: phân loại rồi sinh câu trả lời)
+        self.enqueued = time.monotonic()
+        self.superseded = False
+
+    def sort_key(self, now: float):
+        return (self.priority - (now - self.enqueued) / LLM_PRIORITY_AGING, self.seq)
+
+
+class LlmQueue:
+    #Luật xếp hàng dùng chung cho LlmClient (luồng) và chatbox_async.AsyncLlmClient (asyncio): giới hạn chỗ,
+    #hàng chờ có hạn, ưu tiên + già hóa, câu mới thay thế câu cũ cùng session, thống kê.
+    #Chỉ giữ trạng thái và ra quyết định; khóa / chờ / đánh thức là việc của client (threading hoặc asyncio Condition).
+    #Mọi phương thức phải gọi khi đang giữ khóa của client; sau admit() / leave() / finish() client cần notify_all.
+    def __init__(self, max_inflight: int, max_waiting: int, queue_timeout: float):
+        self.max_inflight = max(1, max_inflight)
+        self.max_waiting = max(0, max_waiting)
+        self.queue_timeout = queue_timeout
+        self.inflight = 0
+        self.waiters = []
+        self.latest = {}
+        #session_id → ticket mới nhất (đang chờ hoặc đang chạy) của session đó
+        self.seq = 0
+        self.request_seq = 0
+        self.requests = OrderedDict()
+        #session_id → số thứ tự lượt chat mới nhất đã bắt đầu
+        self.served = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.superseded = 0
+        self.wait_ms = deque(maxlen=512)
+
+    def timeout_for(self, timeout) -> float:
+        return self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+
+    def _head(self):
+        if not self.waiters:
+            return None
+        now = time.monotonic()
+        return min(self.waiters, key=lambda t: t.sort_key(now))
+
+    def begin_request(self, session_id) -> int:
+        #Mỗi lượt chat lấy số thứ tự ngay khi bắt đầu, trước mọi lần gọi LLM của lượt đó.
+        #Thay thế luôn ticket đang chờ / đang chạy của lượt cũ, kể cả khi lượt mới được trả lời không cần LLM
+        #(luật từ khóa, câu soạn sẵn) → client cần notify_all sau lời gọi này.
+        self.request_seq += 1
+        if session_id is not None:
+            self.requests[session_id] = self.request_seq
+            self.requests.move_to_end(session_id)
+            while len(self.requests) > LLM_SESSIONS_KEEP:
+                self.requests.popitem(last=False)
+            self._supersede(session_id, self.request_seq)
+        return self.request_seq
+
+    def _supersede(self, session_id, request: int):
+        old = self.latest.get(session_id)
+        if old is not None and not old.superseded and old.request < request:
+            old.superseded = True
+            self.superseded += 1
+            if old in self.waiters:
+                self.waiters.remove(old)
+            #request cũ đang chờ bị loại khỏi hàng ngay; request cũ đang chạy sẽ tự dừng khi thấy cờ superseded
+
+    def admit(self, session_id, priority: int, request: int = None) -> LlmTicket:
+        #Tạo ticket; còn chỗ và không ai chờ thì chạy ngay, không thì vào hàng (đầy → LlmBusyError).
+        #request: số từ begin_request của lượt chat; None → coi như lượt mới nhất của session.
+        if request is None:
+            request = self.begin_request(session_id)
+        self.seq += 1
+        ticket = LlmTicket(session_id, priority, self.seq, request)
+        if session_id is not None:
+            if request < self.requests.get(session_id, request):
+                self.superseded += 1
+                raise LlmSupersededError("superseded before admission")
+            #lượt cũ (vd. vừa phân loại xong, giờ mới xin chỗ sinh câu) không được thay thế lượt mới hơn
+            self._supersede(session_id, request)
+            self.latest[session_id] = ticket
+        if self.inflight >= self.max_inflight or self.waiters:
+            if len(self.waiters) >= self.max_waiting:
+                self.rejected += 1
+                self._release_session(ticket)
+                raise LlmBusyError("LLM queue full")
+            self.waiters.append(ticket)
+        return ticket
+
+    def ready(self, ticket: LlmTicket, deadline: float) -> bool:
+        #True → ticket được chạy; False → chờ tiếp (tối đa deadline - now). Bị thay thế / quá hạn → exception.
+        if ticket not in self.waiters and not ticket.superseded:
+            return True
+        if ticket.superseded:
+            raise LlmSupersededError("superseded while queued")
+        #kiểm tra trước: ticket bị thay thế đã bị gỡ khỏi waiters, không còn là đầu hàng
+        if self.inflight < self.max_inflight and self._head() is ticket:
+            return True
+        if deadline - time.monotonic() <= 0:
+            self.timed_out += 1
+            raise LlmBusyError("LLM queue wait timed out")
+        return False
+
+    def leave(self, ticket: LlmTicket, admitted: bool):
+        #Ra khỏi hàng chờ: admitted → giữ 1 chỗ, ngược lại (lỗi / bị thay thế / quá hạn) bỏ ticket
+        if ticket in self.waiters:
+            self.waiters.remove(ticket)
+        if admitted:
+            self.inflight += 1
+            self.served += 1
+            self.wait_ms.append((time.monotonic() - ticket.enqueued) * 1000.0)
+        else:
+            self._release_session(ticket)
+
+    def finish(self, ticket: LlmTicket):
+        self.inflight -= 1
+        self._release_session(ticket)
+
+    def _release_session(self, ticket):
+        if ticket.session_id is not None and self.latest.get(ticket.session_id) is ticket:
+            del self.latest[ticket.session_id]
+
+    def stats(self):
+        wait_ms = list(self.wait_ms)
+        return {
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "waiting": len(self.waiters),
+            "max_waiting": self.max_waiting,
+            "served": self.served,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "superseded": self.superseded,
+            "queue_wait_ms": {"p50": percentile(wait_ms, 50), "p95": percentile(wait_ms, 95)},
+        }
+
+
+class LlmClient:
+    def __init__(self, max_inflight: int, max_waiting: int, queue_timeout: float):
+        self.queue = LlmQueue(max_inflight, max_waiting, queue_timeout)
+        self.max_inflight = self.queue.max_inflight
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_inflight * 2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def slot(self, timeout: float = None, session_id=None, priority: int = LLM_DEFAULT_PRIORITY, request: int = None):
+        #Giữ 1 chỗ trong số LLM_MAX_INFLIGHT trong suốt khối with (kể cả khi đang đọc stream).
+        deadline = time.monotonic() + self.queue.timeout_for(timeout)
+        with self.cond:
+            try:
+                ticket = self.queue.admit(session_id, priority, request)
+            finally:
+                self.cond.notify_all()
+            #đánh thức request cũ cùng session (nếu vừa bị thay thế) để nó thoát khỏi hàng ngay, kể cả khi hàng đầy
+            admitted = False
+            try:
+                while not self.queue.ready(ticket, deadline):
+                    self.cond.wait(deadline - time.monotonic())
+                admitted = True
+            finally:
+                self.queue.leave(ticket, admitted)
+                self.cond.notify_all()
+        try:
+            yield ticket
+        finally:
+            with self.cond:
+                self.queue.finish(ticket)
+                self.cond.notify_all()
+
+    def begin_request(self, session_id) -> int:
+        with self.cond:
+            try:
+                return self.queue.begin_request(session_id)
+            finally:
+                self.cond.notify_all()
+
+    def post(self, payload: dict, timeout: float, session_id=None, priority: int = LLM_DEFAULT_PRIORITY,
+             request: int = None):
+        with self.slot(timeout, session_id, priority, request) as ticket:
+            resp = self.session.post(OLLAMA_URL, json=payload, timeout=timeout)
+            if ticket.superseded:
+                resp.close()
+                raise LlmSupersededError("superseded while generating")
+            return resp
+
+    @contextmanager
+    def stream(self, payload: dict, timeout: float, session_id=None, priority: int = LLM_DEFAULT_PRIORITY,
+               request: int = None):
+        #Trả (resp, ticket); người đọc stream kiểm tra ticket.superseded giữa các token.
+        with self.slot(timeout, session_id, priority, request) as ticket:
+            with self.session.post(OLLAMA_URL, json={**payload, "stream": True}, stream=True, timeout=timeout) as resp:
+                yield resp, ticket
+
+    def stats(self):
+        with self.cond:
+            return self.queue.stats()
+
+LLM = LlmClient(LLM_MAX_INFLIGHT, LLM_MAX_WAITING, LLM_QUEUE_TIMEOUT)
+
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(pct / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+
+def classify_payload(text: str, valid_intents=None) -> dict:
+    #valid_intents: nhãn của NPC đang nói chuyện (giống single-call); None → bộ mặc định VALID_INTENTS
+    return {
         "model": MODEL_NAME,
         "messages": [
             {"role": "system",
              "content": ("Classify the user's intent into one of: "
-                         "greeting, ask_direction, combat, trade, farewell, other. "
+                         + ", ".join(valid_intents or VALID_INTENTS) + ". "
                          "Return only the single label (lowercase).")},
             {"role": "user", "content": text}
         ]
@@ -100,37 +1081,478 @@ def classify_intent_llama(text: str) -> str:
     #messages là danh sách hội thoại theo format chuẩn của API kiểu ChatGPT / OpenAI:
     #role: "system" → hướng dẫn cho AI về cách trả lời.
     #role: "user" → nội dung người dùng thật sự nói.
+
+
+def classify_label(j: dict, valid_intents=None) -> str:
+    intent = (j["choices"][0]["message"]["content"] or "").strip().lower().split()[0]
+    #cắt chuỗi trả về, lấy từ đầu đến dấu cách đầu tiên, chuyển thành chữ thường
+    METRICS.inc("intent_source_total", "llm_classify")
+    return intent if intent in (valid_intents or VALID_INTENTS) else "other"
+    #kiểm tra hợp lệ nhãn intent nếu không thì trả "other"
+
+
+def classify_intent_llama(text: str, session_id=None, request: int = None, valid_intents=None) -> str:
     try:
-        r = requests.post(OLLAMA_URL, json=payload, timeout=15)
-        j = r.json()
+        with METRICS.stage("llm_classify"):
+            r = LLM.post(classify_payload(text, valid_intents), timeout=15, session_id=session_id,
+                         priority=LLM_CLASSIFY_PRIORITY, request=request)
+            j = r.json()
         #chuyển đổi phản hồi JSON từ Ollama thành dict Python
-        intent = (j["choices"][0]["message"]["content"] or "").strip().lower().split()[0]
-        #cắt chuỗi trả về, lấy từ đầu đến dấu cách đầu tiên, chuyển thành chữ thường
-        return intent if intent in INTENT_EXAMPLES.keys() or intent == "other" else "other"
-        #kiểm tra hợp lệ nhãn intent nếu không thì trả "other"
+        return classify_label(j, valid_intents)
+    except LlmSupersededError:
+        raise
     except:
+        METRICS.inc("errors_total", "llm_classify")
+        METRICS.inc("fallbacks_total", "classify_other")
         return "other"
 
 
-def detect_intent(text: str):
-    intent, conf = detect_intent_semantic(text)
-    #tính cosine similarity với intent và conf
+# ========== KEYWORD INTENT RULES ==========
+INTENT_RULES_PATH = os.environ.get("INTENT_RULES_PATH", os.path.join(BASE_DIR, "intent_rules.json"))
+
+class KeywordIntentMatcher:
+    #Bảng luật từ khóa (intent_rules.json) được biên dịch thành 1 regex duy nhất.
+    #Mỗi vị trí trong câu được thử bằng lookahead rỗng (?=...) với các nhánh xếp theo priority,
+    #nên các từ khóa chồng lên nhau ("where" / "here are") không che mất luật ưu tiên cao hơn.
+    #So khớp chuỗi con (giống `k in low_text` trước đây), không phân biệt hoa/thường.
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=lambda r: r.get("priority", 0))
+        self._compiled = {}
+
+    @classmethod
+    def from_file(cls, path: str):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f)["rules"])
+
+    def _pattern(self, flags: frozenset):
+        #Luật có "requires" (vd: quest_context) chỉ được bật khi request có context tương ứng
+        #→ biên dịch 1 regex cho mỗi tổ hợp context, lưu lại để dùng lại.
+        pat = self._compiled.get(flags)
+        if pat is None:
+            active = [r for r in self.rules if set(r.get("requires", [])) <= flags and r.get("keywords")]
+            branches = []
+            for i, rule in enumerate(active):
+                alts = "|".join(re.escape(k.lower()) for k in sorted(rule["keywords"], key=len, reverse=True))
+                branches.append(f"(?P<r{i}>{alts})")
+            pat = (re.compile("(?=" + "|".join(branches) + ")") if branches else None, active)
+            self._compiled[flags] = pat
+        return pat
+
+    def match(self, text: str, flags=frozenset()):
+        #Trả về luật có priority cao nhất khớp với câu, hoặc None.
+        regex, active = self._pattern(frozenset(flags))
+        if regex is None or not text:
+            return None
+        best = None
+        for m in regex.finditer(text.lower()):
+            i = int(m.lastgroup[1:])
+            if best is None or i < best:
+                best = i
+                if best == 0:
+                    break
+        return active[best] if best is not None else None
+
+KEYWORD_MATCHER = KeywordIntentMatcher.from_file(INTENT_RULES_PATH)
+
+
+def detect_intent_fast(text: str, quest_context: str = "", npc_id=None):
+    #Các tầng không gọi LLM: luật từ khóa → embedding (nếu đủ ngưỡng). Trả None nếu chưa chắc chắn.
+    flags = {"quest_context"} if quest_context else set()
+    with METRICS.stage("intent_keyword"):
+        rule = KEYWORD_MATCHER.match(text, flags)
+    if rule is not None:
+        if DEBUG_LOG:
+            print(f"[INTENT] keyword rule '{rule['name']}' -> {rule['intent']}")
+        METRICS.inc("intent_source_total", "keyword")
+        return rule["intent"]
+    with METRICS.stage("embedding"):
+        intent, conf = detect_intent_semantic(text, npc_id)
     if conf < INTENT_THRESHOLD:
-    #nếu điểm cosine thấp hơn ngưỡng (<0.55) → không chắc chắn → dùng mô hình Llama để phân loại intent
-        intent = classify_intent_llama(text)
-    #nếu điểm cosine cao hơn ngưỡng → dùng intent từ bộ so khớp ngữ nghĩa tự nhiên
+        return None
+    METRICS.inc("intent_source_total", "embedding")
     return intent
-#Hàm này quyết định khi nào dùng cái nào — giống như “bộ điều phối” giữa 2 mô hình.
-
-def get_history(session_id: str):
-    #nhận vào 1 session_id (chuỗi định danh phiên trò chuyện)
-    q = SESSIONS.get(session_id)
-    #tạo session lưu trữ lịch sử hội thoại dạng hàng đợi (deque) với độ dài tối đa MAX_TURNS(20)
-    if q is None:
-        q = deque(maxlen=MAX_TURNS)
-        SESSIONS[session_id] = q
-    return q
-#Lưu trữ lịch sử hội thoại cho từng phiên trò chuyện riêng biệt tránh NPC quên trò chuyện trước đó.
+
+# ========== SINGLE-CALL MODE (intent + reply in one completion) ==========
+#Bật bằng LLM_SINGLE_CALL=1 hoặc "single_call": true trong request /chat.
+#Khi intent chưa chắc chắn, thay vì gọi classify_intent_llama rồi mới sinh câu trả lời (2 lượt LLM),
+#ta yêu cầu model ghi nhãn intent ở dòng đầu rồi mới trả lời → chỉ 1 lượt.
+LLM_SINGLE_CALL = os.environ.get("LLM_SINGLE_CALL", "0") == "1"
+VALID_INTENTS = list(INTENT_EXAMPLES.keys()) + ["other"]
+
+
+@lru_cache(maxsize=256)
+def single_call_instructions(valid_intents: tuple) -> str:
+    #Dựng 1 lần cho mỗi bộ nhãn (mỗi NPC có thể có bộ intent riêng)
+    return (
+        "\n\n[HIDDEN INTENT TAG]\n"
+        "Before replying, decide what the player wants. The first line of your answer must be exactly "
+        "'INTENT: <label>' where <label> is one of: " + ", ".join(valid_intents) + ". "
+        "The player never sees this line. "
+        "Then, on the next line, write your reply as usual."
+    )
+
+INTENT_TAG_RE = re.compile(r"^\s*[\[(]?\s*intent\s*[:=]\s*[\"']?([a-z_ ]+?)[\"']?\s*[\])]?\s*$",
+                           re.IGNORECASE | re.MULTILINE)
+REPLY_PREFIX_RE = re.compile(r"^\s*reply\s*:\s*", re.IGNORECASE)
+
+
+def normalize_intent_label(label, valid_intents=None) -> str:
+    label = re.sub(r"[\s-]+", "_", str(label or "").strip().lower())
+    return label if label in (valid_intents or VALID_INTENTS) else "other"
+
+
+def parse_intent_reply(raw: str, valid_intents=None):
+    #Tách (intent, reply) từ output của single-call. Chấp nhận:
+    #  - "INTENT: trade\n<reply>" (hợp đồng chuẩn, có thể kèm [ ] hoặc dấu =)
+    #  - JSON {"intent": ..., "reply": ...} (model nhỏ đôi khi tự trả JSON, có thể bọc ```)
+    #Không tìm thấy nhãn → ("other", toàn bộ text) giống classify_intent_llama khi lỗi.
+    raw = (raw or "").strip()
+    body = re.sub(r"^```(?:json)?\s*|\s*```$", "", raw)
+    if body.startswith("{"):
+        try:
+            obj = json.loads(body)
+            if isinstance(obj, dict) and ("reply" in obj or "intent" in obj):
+                return normalize_intent_label(obj.get("intent"), valid_intents), str(obj.get("reply") or "").strip()
+        except ValueError:
+            pass
+    m = INTENT_TAG_RE.search(raw)
+    #thẻ thường ở dòng đầu, nhưng model nhỏ đôi khi đặt cuối → nhận ở bất kỳ dòng nào và luôn bỏ khỏi reply (TTS không đọc nhãn)
+    if m is None:
+        return "other", raw
+    reply = strip_intent_tags(raw)
+    reply = REPLY_PREFIX_RE.sub("", reply).strip()
+    return normalize_intent_label(m.group(1), valid_intents), reply
+
+
+def strip_intent_tags(text: str) -> str:
+    #Bỏ mọi dòng "INTENT: ..." (model nhỏ đôi khi lặp lại thẻ sau câu đầu) → không lưu vào lịch sử, TTS không đọc nhãn
+    return INTENT_TAG_RE.sub("", text or "").strip()
+
+
+INTENT_TAG_PREFIX_RE = re.compile(r"\s*[\[(]?\s*(?:i(?:n(?:t(?:e(?:n(?:t(?:\s*(?:[:=][\"'a-z_ \])]*)?)?)?)?)?)?)?)?",
+                                  re.IGNORECASE)
+#phần đầu dòng còn có thể thành thẻ intent khi có thêm token
+
+
+class IntentTagFilter:
+    #Lọc thẻ intent khỏi stream single-call: dòng nào còn có thể là "INTENT: ..." thì giữ lại tới khi có xuống dòng.
+    def __init__(self):
+        self.held = ""
+        self.mid_line = False
+        #đã trả ra một phần dòng hiện tại → phần còn lại của dòng không thể là thẻ
+
+    def feed(self, text: str) -> str:
+        #Thêm token mới, trả về phần text an toàn để gửi cho client.
+        self.held += text
+        out = []
+        while self.held:
+            line, nl, rest = self.held.partition("\n")
+            if self.mid_line:
+                out.append(line + nl)
+            elif nl:
+                if not INTENT_TAG_RE.fullmatch(line):
+                    out.append(line + nl)
+            elif INTENT_TAG_PREFIX_RE.fullmatch(line):
+                break
+            else:
+                out.append(line)
+            self.mid_line = not nl
+            self.held = rest
+        return "".join(out)
+
+    def flush(self) -> str:
+        held, self.held = self.held, ""
+        return "" if INTENT_TAG_RE.fullmatch(held) else held
+
+# ========== SESSION STORE ==========
+#Lưu lịch sử hội thoại theo session, có giới hạn: session không hoạt động quá SESSION_TTL giây bị xóa,
+#tổng số session và tổng dung lượng (ước tính) bị chặn trên, vượt thì xóa session dùng lâu nhất (LRU).
+#SESSION_BACKEND=sqlite lưu ra file SQLite (SESSION_DB_PATH) → nhiều worker dùng chung, khởi động lại không mất hội thoại.
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.path.abspath(os.environ.get("SESSION_DB_PATH", os.path.join(BASE_DIR, "sessions~", "sessions.db")))
+SESSION_TTL = float(os.environ.get("SESSION_TTL", str(2 * 3600)))
+SESSION_MAX = int(os.environ.get("SESSION_MAX", "5000"))
+SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+MESSAGE_OVERHEAD_BYTES = 100
+#ước tính chi phí cố định của 1 message (dict + chuỗi role) ngoài phần nội dung
+
+
+def message_bytes(msg: dict) -> int:
+    return len((msg.get("content") or "").encode("utf-8")) + MESSAGE_OVERHEAD_BYTES
+
+
+def session_state(history, offset: int, summary: str, summary_upto: int) -> dict:
+    #offset = số thứ tự (tính từ đầu phiên) của history[0]; các message trước đó đã bị store bỏ đi
+    return {"history": history, "offset": max(0, offset), "summary": summary or "", "summary_upto": summary_upto}
+
+
+class MemorySessionStore:
+    def __init__(self, max_turns: int, ttl: float, max_sessions: int, max_bytes: int):
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.sessions = OrderedDict()
+        #session_id → {"history": deque, "bytes": int, "last_used": float, "total": int, "summary": str, "summary_upto": int}
+        #dùng gần nhất ở cuối; total = số message đã từng ghi, summary tóm tắt các message [0, summary_upto)
+        self.total_bytes = 0
+        self.evicted = 0
+        self.expired = 0
+        self.lock = threading.Lock()
+
+    def _drop(self, session_id):
+        entry = self.sessions.pop(session_id, None)
+        if entry is not None:
+            self.total_bytes -= entry["bytes"]
+        return entry
+
+    def _sweep(self):
+        now = time.time()
+        while self.sessions:
+            sid, entry = next(iter(self.sessions.items()))
+            if now - entry["last_used"] > self.ttl:
+                self.expired += 1
+            elif len(self.sessions) > self.max_sessions or self.total_bytes > self.max_bytes:
+                self.evicted += 1
+            else:
+                break
+            self._drop(sid)
+
+    def get_state(self, session_id: str):
+        with self.lock:
+            self._sweep()
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return session_state([], 0, "", 0)
+            entry["last_used"] = time.time()
+            self.sessions.move_to_end(session_id)
+            q = entry["history"]
+            return session_state(list(q), entry["total"] - len(q), entry["summary"], entry["summary_upto"])
+
+    def get(self, session_id: str):
+        return self.get_state(session_id)["history"]
+
+    def set_summary(self, session_id: str, summary: str, upto: int, expected_upto: int) -> bool:
+        #Chỉ ghi nếu chưa ai cập nhật tóm tắt kể từ lúc đọc (expected_upto) và session còn tồn tại
+        #(total < upto nghĩa là session đã bị /reset rồi tạo lại trong lúc đang tóm tắt)
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is None or entry["summary_upto"] != expected_upto or entry["total"] < upto:
+                return False
+            delta = len(summary.encode("utf-8")) - len(entry["summary"].encode("utf-8"))
+            entry["summary"] = summary
+            entry["summary_upto"] = upto
+            entry["bytes"] += delta
+            self.total_bytes += delta
+            return True
+
+    def append(self, session_id: str, messages):
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                entry = {"history": deque(maxlen=self.max_turns), "bytes": 0, "last_used": 0.0,
+                         "total": 0, "summary": "", "summary_upto": 0}
+                self.sessions[session_id] = entry
+            q = entry["history"]
+            for msg in messages:
+                if len(q) == q.maxlen:
+                    dropped = message_bytes(q[0])
+                    entry["bytes"] -= dropped
+                    self.total_bytes -= dropped
+                q.append(msg)
+                entry["total"] += 1
+                entry["bytes"] += message_bytes(msg)
+                self.total_bytes += message_bytes(msg)
+            entry["last_used"] = time.time()
+            self.sessions.move_to_end(session_id)
+            self._sweep()
+
+    def delete(self, session_id: str):
+        with self.lock:
+            self._drop(session_id)
+
+    def stats(self):
+        with self.lock:
+            self._sweep()
+            return {
+                "backend": "memory",
+                "sessions": len(self.sessions),
+                "max_sessions": self.max_sessions,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_s": self.ttl,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+
+class SqliteSessionStore:
+    #Dùng chung được giữa nhiều process (WAL), mỗi luồng có 1 connection riêng.
+    SWEEP_INTERVAL = 30.0
+
+    def __init__(self, path: str, max_turns: int, ttl: float, max_sessions: int, max_bytes: int):
+        self.path = path
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self._last_sweep = 0.0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        db = self._db()
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                last_used REAL NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                summary TEXT NOT NULL DEFAULT '',
+                summary_upto INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_sessions_last_used ON sessions(last_used);
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                bytes INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id);
+        """)
+        columns = {row[1] for row in db.execute("PRAGMA table_info(sessions)")}
+        for name, decl in (("total", "INTEGER NOT NULL DEFAULT 0"),
+                           ("summary", "TEXT NOT NULL DEFAULT ''"),
+                           ("summary_upto", "INTEGER NOT NULL DEFAULT 0")):
+            if name not in columns:
+                db.execute(f"ALTER TABLE sessions ADD COLUMN {name} {decl}")
+        if "total" not in columns:
+            db.execute("UPDATE sessions SET total = "
+                       "(SELECT COUNT(*) FROM messages WHERE messages.session_id = sessions.session_id)")
+        #file DB tạo trước khi có tóm tắt hội thoại → bổ sung cột, dữ liệu cũ giữ nguyên
+
+    def _db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def _delete(self, db, session_ids):
+        for sid in session_ids:
+            db.execute("DELETE FROM messages WHERE session_id = ?", (sid,))
+            db.execute("DELETE FROM sessions WHERE session_id = ?", (sid,))
+
+    def _sweep(self, db, force: bool = False):
+        now = time.time()
+        if not force and now - self._last_sweep < self.SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            expired = [r[0] for r in db.execute("SELECT session_id FROM sessions WHERE last_used < ?", (now - self.ttl,))]
+            self._delete(db, expired)
+            count, total = db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM sessions").fetchone()
+            if count > self.max_sessions or total > self.max_bytes:
+                for sid, size in db.execute("SELECT session_id, bytes FROM sessions ORDER BY last_used").fetchall():
+                    if count <= self.max_sessions and total <= self.max_bytes:
+                        break
+                    self._delete(db, [sid])
+                    count -= 1
+                    total -= size
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def get_state(self, session_id: str):
+        db = self._db()
+        self._sweep(db)
+        row = db.execute(
+            "SELECT last_used, total, summary, summary_upto FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return session_state([], 0, "", 0)
+        db.execute("UPDATE sessions SET last_used = ? WHERE session_id = ?", (time.time(), session_id))
+        rows = db.execute(
+            "SELECT role, content FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+            (session_id, self.max_turns),
+        ).fetchall()
+        history = [{"role": role, "content": content} for role, content in reversed(rows)]
+        return session_state(history, row[1] - len(history), row[2], row[3])
+
+    def get(self, session_id: str):
+        return self.get_state(session_id)["history"]
+
+    def set_summary(self, session_id: str, summary: str, upto: int, expected_upto: int) -> bool:
+        db = self._db()
+        cur = db.execute(
+            "UPDATE sessions SET summary = ?, summary_upto = ?, "
+            "bytes = (SELECT COALESCE(SUM(bytes), 0) FROM messages WHERE session_id = ?) + ? "
+            "WHERE session_id = ? AND summary_upto = ? AND total >= ?",
+            (summary, upto, session_id, len(summary.encode("utf-8")), session_id, expected_upto, upto),
+        )
+        return cur.rowcount > 0
+
+    def append(self, session_id: str, messages):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(
+                "INSERT INTO messages (session_id, role, content, bytes) VALUES (?, ?, ?, ?)",
+                [(session_id, m["role"], m.get("content") or "", message_bytes(m)) for m in messages],
+            )
+            db.execute(
+                "DELETE FROM messages WHERE session_id = ? AND id NOT IN "
+                "(SELECT id FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?)",
+                (session_id, session_id, self.max_turns),
+            )
+            #giữ tối đa MAX_TURNS message như deque(maxlen=MAX_TURNS) trước đây
+            db.execute(
+                "INSERT INTO sessions (session_id, bytes, last_used, total) "
+                "VALUES (?, (SELECT COALESCE(SUM(bytes), 0) FROM messages WHERE session_id = ?), ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET "
+                "bytes = excluded.bytes + length(CAST(sessions.summary AS BLOB)), "
+                "last_used = excluded.last_used, total = sessions.total + excluded.total",
+                (session_id, session_id, time.time(), len(messages)),
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        self._sweep(db)
+
+    def delete(self, session_id: str):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            self._delete(db, [session_id])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def stats(self):
+        db = self._db()
+        self._sweep(db, force=True)
+        count, total = db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM sessions").fetchone()
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "sessions": count,
+            "max_sessions": self.max_sessions,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "ttl_s": self.ttl,
+        }
+
+
+if SESSION_BACKEND == "sqlite":
+    SESSION_STORE = SqliteSessionStore(SESSION_DB_PATH, MAX_TURNS, SESSION_TTL, SESSION_MAX, SESSION_MAX_BYTES)
+else:
+    SESSION_STORE = MemorySessionStore(MAX_TURNS, SESSION_TTL, SESSION_MAX, SESSION_MAX_BYTES)
+
 
 def normalize_rate(rate: str):  return rate if re.fullmatch(r"[+-]?\d+%", rate) else "0%"
 def normalize_pitch(pitch: str): return pitch if re.fullmatch(r"[+-]?\d+Hz", pitch or "") else "+0Hz"
@@ -147,55 +1569,813 @@ def clean_for_tts(text: str) -> str:
     return text or "..."
 #Làm sạch văn bản đầu vào
 
-#Tạo tệp âm thanh TTS không đồng bộ sử dụng edge-tts và aiohttp để xử lý các yêu cầu HTTP một cách an toàn.
-async def synth_to_file_async(text: str, out_path: str):
-    sslcontext = ssl.create_default_context()
-    sslcontext.check_hostname = False
-    sslcontext.verify_mode = ssl.CERT_NONE
-
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=sslcontext)) as session:
-        #Hàm của thư viện edge-tts, dùng để gửi text đến máy chủ Microsoft Edge TTS
-        communicator = edge_tts.Communicate(
-            clean_for_tts(text),
-            voice=VOICE,
-            rate=normalize_rate(RATE),
-            pitch=normalize_pitch(PITCH),
-        )
-        #chỉnh sửa tham số voice, rate, pitch theo cấu hình đã định nghĩa ở trên
-        await communicator.save(out_path)
-        #lưu tệp âm thanh TTS vào đường dẫn out_path
+#Tạo audio TTS không đồng bộ sử dụng edge-tts và aiohttp để xử lý các yêu cầu HTTP một cách an toàn.
+async def synth_to_bytes_async(text: str, connector=None) -> bytes:
+    #Hàm của thư viện edge-tts, dùng để gửi text đến máy chủ Microsoft Edge TTS
+    communicator = edge_tts.Communicate(
+        clean_for_tts(text),
+        voice=VOICE,
+        rate=normalize_rate(RATE),
+        pitch=normalize_pitch(PITCH),
+        connector=connector,
+    )
+    #chỉnh sửa tham số voice, rate, pitch theo cấu hình đã định nghĩa ở trên
+    audio = bytearray()
+    async for chunk in communicator.stream():
+        if chunk["type"] == "audio":
+            audio.extend(chunk["data"])
+    return bytes(audio)
+    #gom MP3 trong bộ nhớ; ghi ra đĩa (hay không) là việc của tts_file / store_audio
+
+
+# ========== TTS EVENT LOOP ==========
+#Trước đây mỗi lần TTS gọi asyncio.run → tạo event loop mới, ssl context mới, connector/session mới.
+#Giờ có 1 event loop chạy nền suốt đời process, giữ 1 connector dùng chung (pool kết nối, cache DNS);
+#các luồng request gửi việc vào qua run_coroutine_threadsafe và nhận lại concurrent Future.
+TTS_MAX_CONCURRENT = int(os.environ.get("TTS_MAX_CONCURRENT", "4"))
+TTS_TIMEOUT = 60.0
+
+
+class SharedTCPConnector(aiohttp.TCPConnector):
+    #edge-tts tạo ClientSession riêng cho mỗi lần đọc và session đó đóng connector khi thoát.
+    #Connector dùng chung bỏ qua close() đó; chỉ thật sự đóng khi TtsEventLoop.shutdown().
+    def close(self, *args, **kwargs):
+        if getattr(self, "_shutting_down", False):
+            return super().close(*args, **kwargs)
+        return asyncio.sleep(0)
+
+
+class TtsEventLoop:
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max(1, max_concurrent)
+        self.loop = asyncio.new_event_loop()
+        self.connector = None
+        self.sem = None
+        self.thread = threading.Thread(target=self._run, name="tts-loop", daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._setup(), self.loop).result()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _setup(self):
+        sslcontext = ssl.create_default_context()
+        sslcontext.check_hostname = False
+        sslcontext.verify_mode = ssl.CERT_NONE
+        self.connector = SharedTCPConnector(ssl=sslcontext, limit=self.max_concurrent * 2, ttl_dns_cache=300)
+        self.sem = asyncio.Semaphore(self.max_concurrent)
+        #giới hạn số lần tổng hợp đồng thời tới máy chủ Edge TTS
+
+    async def _synth(self, text: str):
+        async with self.sem:
+            return await synth_to_bytes_async(text, connector=self.connector)
+
+    def submit(self, text: str):
+        #An toàn đa luồng: trả về concurrent.futures.Future (kết quả là bytes MP3)
+        return asyncio.run_coroutine_threadsafe(self._synth(text), self.loop)
+
+    def synth(self, text: str, timeout: float = TTS_TIMEOUT) -> bytes:
+        fut = self.submit(text)
+        try:
+            return fut.result(timeout)
+        except Exception:
+            fut.cancel()
+            raise
+
+    def shutdown(self):
+        if not self.loop.is_running():
+            return
+        async def _close():
+            self.connector._shutting_down = True
+            await self.connector.close()
+        try:
+            asyncio.run_coroutine_threadsafe(_close(), self.loop).result(5)
+        except Exception as e:
+            print(f"[TTS] loop shutdown: {e}")
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(5)
+
+TTS_LOOP = TtsEventLoop(TTS_MAX_CONCURRENT)
+atexit.register(TTS_LOOP.shutdown)
+
+
+
+
+# ========== TTS CACHE (content-addressed) ==========
+#File audio được đặt tên theo hash của (text đã làm sạch + VOICE/RATE/PITCH) → cùng câu thoại thì dùng lại file cũ.
+#Thư mục tmp được giới hạn theo tổng dung lượng (LRU) và thời gian không dùng; index lưu ra đĩa để giữ qua lần khởi động lại.
+TMP_DIR = os.path.abspath(os.environ.get("TTS_TMP_DIR", "tmp"))
+TTS_CACHE_MAX_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+TTS_CACHE_MAX_AGE = float(os.environ.get("TTS_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+TTS_INDEX_SAVE_INTERVAL = 30.0
+#Ghi index khi có file mới; lần cập nhật "last_used" do cache hit chỉ ghi tối đa mỗi 30s
+
+
+# ========== AUDIO FORMAT ==========
+#Edge TTS trả MP3 48 kbps. AUDIO_FORMAT=opus chuyển sang Opus (Ogg) bitrate thấp hơn bằng ffmpeg (cần có trong PATH,
+#thiếu thì quay về mp3) → clip nhỏ hơn ~2 lần, tải nhanh hơn / nhúng vào JSON được nhiều hơn.
+AUDIO_FORMATS = {"mp3": (".mp3", "audio/mpeg"), "opus": (".opus", "audio/ogg")}
+AUDIO_FORMAT = os.environ.get("AUDIO_FORMAT", "mp3").lower()
+AUDIO_OPUS_BITRATE = os.environ.get("AUDIO_OPUS_BITRATE", "24k")
+FFMPEG = shutil.which("ffmpeg")
+if AUDIO_FORMAT not in AUDIO_FORMATS or (AUDIO_FORMAT == "opus" and FFMPEG is None):
+    print(f"[TTS] AUDIO_FORMAT={AUDIO_FORMAT} unavailable (opus needs ffmpeg), using mp3")
+    AUDIO_FORMAT = "mp3"
+AUDIO_EXT, AUDIO_MIMETYPE = AUDIO_FORMATS[AUDIO_FORMAT]
+
+
+def audio_mimetype(name: str) -> str:
+    ext = os.path.splitext(name)[1]
+    return next((mime for e, mime in AUDIO_FORMATS.values() if e == ext), "application/octet-stream")
+
+
+def is_audio_name(name: str) -> bool:
+    return name.startswith("tts_") and os.path.splitext(name)[1] in {e for e, _ in AUDIO_FORMATS.values()}
+
+
+def encode_audio(mp3: bytes) -> bytes:
+    if AUDIO_FORMAT == "mp3":
+        return mp3
+    proc = subprocess.run(
+        [FFMPEG, "-loglevel", "error", "-f", "mp3", "-i", "pipe:0",
+         "-c:a", "libopus", "-b:a", AUDIO_OPUS_BITRATE, "-application", "voip", "-f", "ogg", "pipe:1"],
+        input=mp3, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=TTS_TIMEOUT, check=True,
+    )
+    return proc.stdout
+
+
+def audio_name_for(text: str) -> str:
+    key = f"{VOICE}|{normalize_rate(RATE)}|{normalize_pitch(PITCH)}|{clean_for_tts(text)}"
+    if AUDIO_FORMAT != "mp3":
+        key += f"|{AUDIO_FORMAT}:{AUDIO_OPUS_BITRATE}"
+    #mp3 giữ nguyên khóa cũ → file đã cache / voice bank vẫn dùng được
+    return f"tts_{hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]}{AUDIO_EXT}"
+
+
+def audio_etag(name: str) -> str:
+    #File đặt tên theo hash nội dung → phần hash chính là ETag mạnh
+    return os.path.splitext(name)[0][len("tts_"):]
+
+
+class TtsCache:
+    def __init__(self, directory: str, max_bytes: int, max_age: float, shared: bool = False):
+        self.dir = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.shared = shared
+        #shared: nhiều worker cùng dùng thư mục → đĩa là nguồn đúng duy nhất: mtime của file = lần dùng gần nhất
+        #(lookup chạm mtime), trước khi dọn thì đọc lại thư mục → giới hạn dung lượng là tổng chung, không phải N lần
+        self.index_path = os.path.join(directory, "tts_index.json")
+        self.entries = OrderedDict()
+        #name → {"bytes", "created", "last_used"}, theo thứ tự dùng gần nhất ở cuối
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self._last_save = 0.0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = {}
+        now = time.time()
+        for name in sorted(os.listdir(self.dir)):
+            path = os.path.join(self.dir, name)
+            if name.endswith(".part"):
+                os.remove(path)
+                #file ghi dở từ lần chạy trước bị dừng giữa chừng
+                continue
+            if name.startswith("tmp_") and name.endswith(".mp3"):
+                #file uuid của phiên bản cũ (trước khi có cache) → xóa khi quá hạn
+                if now - os.path.getmtime(path) > self.max_age:
+                    os.remove(path)
+                continue
+            if not is_audio_name(name):
+                continue
+            meta = saved.get(name) or {}
+            size = os.path.getsize(path)
+            mtime = os.path.getmtime(path)
+            self.entries[name] = {
+                "bytes": size,
+                "created": meta.get("created", mtime),
+                "last_used": meta.get("last_used", mtime),
+            }
+            self.total_bytes += size
+        self.entries = OrderedDict(sorted(self.entries.items(), key=lambda kv: kv[1]["last_used"]))
+        with self.lock:
+            self._evict()
+            self._save()
+
+    def _save(self):
+        tmp_path = f"{self.index_path}.{os.getpid()}.part"
+        #tên file tạm riêng cho từng process: các worker không ghi đè file tạm của nhau
+        self._last_save = time.monotonic()
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f"[TTS ERROR] cannot save cache index: {e}")
+            #index chỉ để giữ thứ tự LRU qua lần khởi động lại → lỗi ghi không được làm hỏng request
+
+    def _resync(self):
+        #Chế độ shared: dựng lại danh sách từ thư mục (gồm cả clip do worker khác ghi / đã bị worker khác xóa)
+        entries, total = [], 0
+        with os.scandir(self.dir) as it:
+            for entry in it:
+                if not is_audio_name(entry.name):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                old = self.entries.get(entry.name)
+                entries.append((entry.name, {"bytes": st.st_size, "created": old["created"] if old else st.st_mtime,
+                                             "last_used": st.st_mtime}))
+                total += st.st_size
+        entries.sort(key=lambda kv: kv[1]["last_used"])
+        self.entries = OrderedDict(entries)
+        self.total_bytes = total
+
+    def _evict(self):
+        now = time.time()
+        while self.entries:
+            name, meta = next(iter(self.entries.items()))
+            if self.total_bytes <= self.max_bytes and now - meta["last_used"] <= self.max_age:
+                break
+            self.entries.popitem(last=False)
+            self.total_bytes -= meta["bytes"]
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.dir, name))
+            except OSError:
+                pass
 
+    def lookup(self, name: str) -> bool:
+        path = os.path.join(self.dir, name)
+        with self.lock:
+            meta = self.entries.get(name)
+            if meta is None and self.shared and os.path.exists(path):
+                meta = self._adopt(name, path)
+            #clip do worker khác tổng hợp: nhận vào index thay vì tổng hợp lại
+            if meta is None or not os.path.exists(path):
+                self.misses += 1
+                return False
+            meta["last_used"] = time.time()
+            self.entries.move_to_end(name)
+            if self.shared:
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+            self.hits += 1
+            if time.monotonic() - self._last_save > TTS_INDEX_SAVE_INTERVAL:
+                self._save()
+            return True
 
-def synth_to_file_blocking(text: str, out_path: str):
-    asyncio.run(synth_to_file_async(text, out_path))
+    def contains(self, name: str) -> bool:
+        #Chỉ kiểm tra có clip hay không: không tính hit/miss, không đổi thứ tự LRU (lookup mới là "dùng" clip)
+        with self.lock:
+            return (name in self.entries or self.shared) and os.path.exists(os.path.join(self.dir, name))
 
+    def _adopt(self, name: str, path: str):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        now = time.time()
+        meta = self.entries[name] = {"bytes": size, "created": now, "last_used": now}
+        self.total_bytes += size
+        return meta
+
+    def add(self, name: str):
+        path = os.path.join(self.dir, name)
+        if not os.path.exists(path):
+            return
+        with self.lock:
+            old = self.entries.pop(name, None)
+            if old is not None:
+                self.total_bytes -= old["bytes"]
+            now = time.time()
+            size = os.path.getsize(path)
+            self.entries[name] = {"bytes": size, "created": now, "last_used": now}
+            self.total_bytes += size
+            if self.shared:
+                self._resync()
+            self._evict()
+            self._save()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "max_age_s": self.max_age,
+                "shared": self.shared,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "evictions": self.evictions,
+            }
+
+TTS_CACHE = TtsCache(TMP_DIR, TTS_CACHE_MAX_BYTES, TTS_CACHE_MAX_AGE, shared=MULTI_WORKER)
+
+# ========== FAST PATH + VOICE BANK ==========
+#Intent có hành động cố định (tạm biệt, hỏi tiến độ / nhận quest) → trả 1 câu soạn sẵn của NPC ("canned" trong
+#npc_personas.json), bỏ qua LM Studio. MP3 của các câu này render trước bằng voice_bank.py vào VOICE_BANK_DIR
+#(tên file giống cache TTS: hash của giọng + tốc độ + cao độ + câu) → bỏ qua luôn edge-tts, trả về trong vài ms.
+#Câu chưa có file trong bank vẫn dùng đường tắt, audio tổng hợp 1 lần rồi nằm trong cache TTS như thường.
+FAST_PATH = os.environ.get("FAST_PATH", "1") == "1"
+FAST_PATH_INTENTS = {i.strip() for i in os.environ.get("FAST_PATH_INTENTS", "farewell,quest_status,quest_confirmation").split(",") if i.strip()}
+FAST_PATH_QUEST_INTENTS = {"quest_status", "quest_confirmation"}
+#câu soạn sẵn của các intent này nói về nhiệm vụ → chỉ dùng khi request có quest_context (như "requires" trong intent_rules.json)
+VOICE_BANK_DIR = os.path.abspath(os.environ.get("VOICE_BANK_DIR", os.path.join(BASE_DIR, "voice_bank~")))
+#thư mục kết thúc bằng "~" → Unity bỏ qua, không import các clip này thành asset
+
+
+class VoiceBank:
+    def __init__(self, directory: str):
+        self.dir = directory
+        self.paths = {}
+        #tên file → đường dẫn (voice_bank/<npc_id>/tts_<hash>.mp3)
+        self.scan()
+
+    def scan(self):
+        paths = {}
+        for root, _, files in os.walk(self.dir):
+            for name in files:
+                if is_audio_name(name):
+                    paths[name] = os.path.join(root, name)
+        self.paths = paths
+
+    def lookup(self, name: str) -> bool:
+        return name in self.paths
+
+    def path(self, name: str):
+        return self.paths.get(name)
+
+    def missing(self):
+        return [(p.npc_id, line) for p in PERSONAS.personas.values() for intent, lines in p.canned.items()
+                if intent in FAST_PATH_INTENTS for line in lines if not self.lookup(audio_name_for(line))]
+
+    def stats(self):
+        return {
+            "enabled": FAST_PATH,
+            "intents": sorted(FAST_PATH_INTENTS),
+            "dir": self.dir,
+            "clips": len(self.paths),
+            "missing_lines": len(self.missing()),
+        }
+
+VOICE_BANK = VoiceBank(VOICE_BANK_DIR)
+if FAST_PATH and VOICE_BANK.missing():
+    print(f"[VOICEBANK] {len(VOICE_BANK.missing())} canned lines have no pre-rendered clip (run voice_bank.py)")
+
+
+# ========== IN-MEMORY AUDIO ==========
+#AUDIO_MEMORY=1: clip vừa tổng hợp nằm trong bộ đệm vòng trong RAM (tối đa AUDIO_MEMORY_MAX_BYTES, clip cũ nhất bị đẩy ra
+#trước) và /audio phục vụ thẳng từ đó, có hỗ trợ Range; file vào cache đĩa được ghi nền sau khi đã trả lời.
+#Request có "inline_audio": true (hoặc AUDIO_INLINE=1) → clip ≤ AUDIO_INLINE_MAX_BYTES được nhúng base64 vào JSON /chat,
+#Unity phát ngay mà không cần request /audio thứ hai.
+AUDIO_MEMORY = os.environ.get("AUDIO_MEMORY", "0") == "1" and not MULTI_WORKER
+#clip chỉ nằm trong RAM của worker đã tổng hợp → worker khác không tìm thấy tới khi ghi nền xong
+AUDIO_MEMORY_MAX_BYTES = int(os.environ.get("AUDIO_MEMORY_MAX_BYTES", str(32 * 1024 * 1024)))
+AUDIO_INLINE = os.environ.get("AUDIO_INLINE", "0") == "1"
+AUDIO_INLINE_MAX_BYTES = int(os.environ.get("AUDIO_INLINE_MAX_BYTES", str(64 * 1024)))
+
+
+class AudioRing:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.clips = OrderedDict()
+        #tên file → bytes, clip dùng gần nhất ở cuối
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        with self.lock:
+            return name in self.clips
+
+    def put(self, name: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.clips.pop(name, None)
+            if old is not None:
+                self.total_bytes -= len(old)
+            self.clips[name] = data
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.clips.popitem(last=False)
+                self.total_bytes -= len(evicted)
+                self.evictions += 1
+
+    def get(self, name: str):
+        with self.lock:
+            data = self.clips.get(name)
+            if data is None:
+                self.misses += 1
+                return None
+            self.clips.move_to_end(name)
+            self.hits += 1
+            return data
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": AUDIO_MEMORY,
+                "clips": len(self.clips),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "evictions": self.evictions,
+            }
+
+AUDIO_RING = AudioRing(AUDIO_MEMORY_MAX_BYTES)
+AUDIO_PERSIST_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audio-persist")
+
+
+def audio_cached(name: str) -> bool:
+    return VOICE_BANK.lookup(name) or name in AUDIO_RING or TTS_CACHE.contains(name)
+    #dùng cho chế độ async (chỉ cần biết clip đã có chưa) → không làm lệch số hit/miss của /tts/cache
+
+
+def audio_path(name: str) -> str:
+    return VOICE_BANK.path(name) or os.path.join(TMP_DIR, name)
+
+
+def audio_exists(name: str) -> bool:
+    return name in AUDIO_RING or os.path.exists(audio_path(name))
+
+
+def write_audio(fname: str, data: bytes):
+    out_path = os.path.join(TMP_DIR, fname)
+    part_path = os.path.join(TMP_DIR, f"{fname}.{uuid.uuid4().hex}.part")
+    #Ghi ra file tạm rồi đổi tên → client không bao giờ đọc phải file đang ghi dở
+    try:
+        with open(part_path, "wb") as f:
+            f.write(data)
+        os.replace(part_path, out_path)
+        TTS_CACHE.add(fname)
+        if DEBUG_LOG:
+            print(f"[TTS] ✅ Saved {AUDIO_FORMAT.upper()}: {out_path}")
+    except OSError as e:
+        print(f"[TTS ERROR] write {fname}: {e}")
+        METRICS.inc("errors_total", "tts_write")
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+def store_audio(fname: str, data: bytes):
+    if AUDIO_MEMORY:
+        AUDIO_RING.put(fname, data)
+        AUDIO_PERSIST_POOL.submit(write_audio, fname, data)
+        #lượt hiện tại không chờ I/O đĩa; file vẫn vào cache TTS cho lần khởi động sau
+    else:
+        write_audio(fname, data)
+
+
+def read_audio(name: str):
+    data = AUDIO_RING.get(name) if AUDIO_MEMORY else None
+    if data is not None:
+        return data
+    try:
+        with open(audio_path(name), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if AUDIO_MEMORY:
+        AUDIO_RING.put(name, data)
+    #clip đọc từ đĩa / voice bank cũng được giữ lại trong RAM cho lần sau
+    return data
+
+
+def inline_audio(text: str) -> dict:
+    #{"audio_base64", "audio_mime"} nếu clip của câu này đã có và đủ nhỏ để nhúng vào JSON, không thì {}
+    name = audio_name_for(text)
+    data = read_audio(name)
+    if data is None or len(data) > AUDIO_INLINE_MAX_BYTES:
+        return {}
+    return {"audio_base64": base64.b64encode(data).decode("ascii"), "audio_mime": audio_mimetype(name)}
 
 
 def tts_file(text: str):
-    os.makedirs("tmp", exist_ok=True)
-    #Tạo thư mục tạm thời "tmp" nếu chưa tồn tại
-    fname = f"tmp_{uuid.uuid4().hex}.mp3"
-    #Tạo tên tệp duy nhất sử dụng UUID để tránh trùng lặp
-    out_path = os.path.join("tmp", fname)
+    fname = audio_name_for(text)
+    out_path = os.path.join(TMP_DIR, fname)
+    if VOICE_BANK.lookup(fname):
+        return VOICE_BANK.path(fname), fname
+    if fname in AUDIO_RING or TTS_CACHE.lookup(fname):
+        return out_path, fname
+    #Có sẵn trong voice bank / RAM / cache đĩa → không cần gọi edge-tts
     try:
-        asyncio.run(synth_to_file_async(text, out_path))
-        #Gọi hàm async để thực sự chuyển text → file MP3.
-        print(f"[TTS] ✅ Saved MP3: {out_path}")
+        with METRICS.stage("tts_synth"):
+            data = encode_audio(TTS_LOOP.synth(text))
+        #Gửi việc sang event loop TTS dùng chung để thực sự chuyển text → MP3 (→ Opus nếu bật).
+        store_audio(fname, data)
     except Exception as e:
         print(f"[TTS ERROR] {e}")
+        METRICS.inc("errors_total", "tts")
     return out_path, fname
 
 
+@app.route("/tts/cache", methods=["GET"])
+def tts_cache_stats():
+    return jsonify({**TTS_CACHE.stats(), "format": AUDIO_FORMAT, "memory": AUDIO_RING.stats()}), 200
+
+
+
+# ========== ASYNC TTS JOB QUEUE ==========
+#Bật bằng TTS_ASYNC=1 hoặc "async_audio": true trong request: /chat trả text ngay, audio được tổng hợp
+#ở worker nền. Trong lúc job chưa xong, /audio/<name> trả 202 (hoặc chờ tối đa ?wait=<giây>).
+TTS_ASYNC = os.environ.get("TTS_ASYNC", "0") == "1" and not MULTI_WORKER
+#job đang chờ chỉ worker nhận /chat biết → /audio/<name> tới worker khác sẽ 404 thay vì 202
+TTS_WORKERS = int(os.environ.get("TTS_WORKERS", "2"))
+TTS_QUEUE_MAX = int(os.environ.get("TTS_QUEUE_MAX", "64"))
+TTS_JOBS_KEEP = 1024
+#số job gần nhất còn giữ trạng thái để /audio/<name> biết job đang chờ hay đã lỗi
+TTS_MAX_WAIT = 30.0
+
+
+class TtsJob:
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text
+        self.status = "queued"
+        self.created = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+
+class TtsJobQueue:
+    #Hàng đợi có giới hạn + nhóm worker nền. Hàng đợi đầy → từ chối (reply vẫn trả về, chỉ không có audio).
+    def __init__(self, workers: int, maxsize: int):
+        self.q = queue.Queue(maxsize=maxsize)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_ms = deque(maxlen=512)
+        self.total_ms = deque(maxlen=512)
+        for i in range(max(1, workers)):
+            threading.Thread(target=self._worker, name=f"tts-job-{i}", daemon=True).start()
+
+    def submit(self, text: str):
+        job = TtsJob(audio_name_for(text), text)
+        with self.lock:
+            pending = self.jobs.get(job.name)
+            if pending is not None and not pending.done.is_set():
+                return pending
+            #cùng câu thoại đang được tổng hợp → dùng chung job
+            self.jobs[job.name] = job
+            self.jobs.move_to_end(job.name)
+            #đăng ký ngay trong cùng lần giữ lock → 2 request cùng câu không tạo 2 job
+            try:
+                self.q.put_nowait(job)
+            except queue.Full:
+                del self.jobs[job.name]
+                if pending is not None:
+                    self.jobs[job.name] = pending
+                self.rejected += 1
+                job = None
+            else:
+                while len(self.jobs) > TTS_JOBS_KEEP:
+                    self.jobs.popitem(last=False)
+        if job is None:
+            print(f"[TTS] queue full ({self.q.qsize()}), skipping audio")
+        return job
+
+    def get(self, name: str):
+        with self.lock:
+            return self.jobs.get(name)
+
+    def _worker(self):
+        while True:
+            job = self.q.get()
+            job.status = "running"
+            job.started = time.monotonic()
+            with self.lock:
+                self.running += 1
+            tts_file(job.text)
+            ok = audio_exists(job.name)
+            job.finished = time.monotonic()
+            job.status = "done" if ok else "failed"
+            with self.lock:
+                self.running -= 1
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self.wait_ms.append((job.started - job.created) * 1000.0)
+                self.total_ms.append((job.finished - job.created) * 1000.0)
+            job.done.set()
+            self.q.task_done()
+
+    def stats(self):
+        with self.lock:
+            wait_ms, total_ms = list(self.wait_ms), list(self.total_ms)
+            return {
+                "queue_depth": self.q.qsize(),
+                "queue_max": self.q.maxsize,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "queue_wait_ms": {"p50": percentile(wait_ms, 50), "p95": percentile(wait_ms, 95)},
+                "job_latency_ms": {"p50": percentile(total_ms, 50), "p95": percentile(total_ms, 95)},
+            }
+
+TTS_QUEUE = TtsJobQueue(TTS_WORKERS, TTS_QUEUE_MAX)
+
+
+@app.route("/llm/stats", methods=["GET"])
+def llm_stats():
+    return jsonify(LLM.stats()), 200
+
+
+@app.route("/tts/stats", methods=["GET"])
+def tts_stats():
+    return jsonify(TTS_QUEUE.stats()), 200
+
+
+# ========== SENTENCE-PIPELINED TTS ==========
+#Khi stream, câu trả lời được cắt thành từng câu; mỗi câu hoàn chỉnh được gửi đi TTS ngay
+#trong lúc LLM vẫn đang sinh phần sau → câu đầu tiên có thể phát sớm.
+TTS_PIPELINE = os.environ.get("TTS_PIPELINE", "0") == "1" and not MULTI_WORKER
+#playlist nằm trong RAM của 1 worker → /audio/stream/<id> tới worker khác sẽ 404
+TTS_PIPELINE_WORKERS = int(os.environ.get("TTS_PIPELINE_WORKERS", "4"))
+TTS_MIN_SENTENCE_CHARS = 20
+#câu quá ngắn ("Oh.") được gộp với câu sau để tránh quá nhiều file nhỏ
+MAX_PLAYLISTS = 256
+PLAYLIST_IDLE_TIMEOUT = 60.0
+#người đọc /audio/stream chờ câu kế tiếp tối đa bấy nhiêu giây (phòng playlist không bao giờ được đóng)
+
+TTS_PIPELINE_POOL = ThreadPoolExecutor(max_workers=TTS_PIPELINE_WORKERS, thread_name_prefix="tts-pipe")
+SENTENCE_END_RE = re.compile(r"[.!?…]+[\"')\]*]*\s+|\n+")
+#chỉ cắt khi đã thấy khoảng trắng sau dấu câu → chắc chắn câu đã kết thúc (không cắt "3." giữa chừng)
+
+
+class SentenceSplitter:
+    def __init__(self, min_chars: int = TTS_MIN_SENTENCE_CHARS):
+        self.min_chars = min_chars
+        self.buf = ""
+
+    def feed(self, text: str):
+        #Thêm token mới, trả về danh sách các câu đã hoàn chỉnh.
+        self.buf += text
+        out, start = [], 0
+        for m in SENTENCE_END_RE.finditer(self.buf):
+            seg = self.buf[start:m.end()].strip()
+            if len(seg) >= self.min_chars:
+                out.append(seg)
+                start = m.end()
+        self.buf = self.buf[start:]
+        return out
+
+    def flush(self):
+        seg, self.buf = self.buf.strip(), ""
+        return [seg] if seg else []
+
+
+class AudioPlaylist:
+    #Danh sách clip theo đúng thứ tự câu; mỗi clip là 1 future của tts_file.
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.chunks = []
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def add(self, text: str):
+        if clean_for_tts(text) == "...":
+            return
+        #câu chỉ có *hành động* hoặc [chú thích] → không có gì để đọc
+        fut = TTS_PIPELINE_POOL.submit(tts_file, text)
+        with self.cond:
+            self.chunks.append(fut)
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def ready(self, start: int):
+        #Các clip đã xong liên tiếp từ vị trí start (không chờ).
+        out = []
+        with self.cond:
+            chunks = list(self.chunks)
+        for fut in chunks[start:]:
+            if not fut.done():
+                break
+            out.append(fut.result()[1])
+        return out
+
+    def iter_names(self):
+        #Trả lần lượt tên file theo thứ tự, chờ clip kế tiếp cho tới khi playlist đóng.
+        i = 0
+        while True:
+            deadline = time.monotonic() + PLAYLIST_IDLE_TIMEOUT
+            with self.cond:
+                while i >= len(self.chunks) and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        print(f"[TTS] playlist {self.id} idle for {PLAYLIST_IDLE_TIMEOUT:.0f}s, ending stream")
+                        return
+                    self.cond.wait(remaining)
+                if i >= len(self.chunks):
+                    return
+                fut = self.chunks[i]
+            yield fut.result()[1]
+            i += 1
+
+
+PLAYLISTS = OrderedDict()
+PLAYLISTS_LOCK = threading.Lock()
+
+def new_playlist():
+    pl = AudioPlaylist()
+    with PLAYLISTS_LOCK:
+        PLAYLISTS[pl.id] = pl
+        while len(PLAYLISTS) > MAX_PLAYLISTS:
+            PLAYLISTS.popitem(last=False)
+    return pl
+
+
+@app.route("/audio/stream/<playlist_id>")
+def serve_audio_stream(playlist_id):
+    #Ghép dần các clip MP3 của 1 câu trả lời thành 1 luồng audio duy nhất (frame MP3 nối tiếp được),
+    #client có thể bắt đầu phát khi câu đầu tiên vừa xong.
+    with PLAYLISTS_LOCK:
+        pl = PLAYLISTS.get(playlist_id)
+    if pl is None:
+        return abort(404, description=f"Playlist {playlist_id} not found")
+
+    def generate():
+        for name in pl.iter_names():
+            data = read_audio(name)
+            if data is not None:
+                yield data
+
+    resp = Response(generate(), mimetype=AUDIO_MIMETYPE)
+    #Opus: các clip Ogg nối tiếp là 1 luồng Ogg "chained" hợp lệ
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
 
 @app.route("/audio/<name>")
-#Tìm nạp và phục vụ tệp âm thanh TTS từ thư mục "tmp"
+#Tìm nạp và phục vụ tệp âm thanh TTS từ thư mục TMP_DIR
 
 def serve_audio(name):
-    path = os.path.join("tmp", name)
-    #Ghép chuỗi
+    job = TTS_QUEUE.get(name)
+    if job is not None and not job.done.is_set():
+        wait = min(max(request.args.get("wait", 0.0, type=float), 0.0), TTS_MAX_WAIT)
+        if wait > 0:
+            job.done.wait(wait)
+        if not job.done.is_set():
+            resp = make_response(jsonify({"status": job.status, "name": name}), 202)
+            resp.headers["Retry-After"] = "1"
+            resp.headers["Cache-Control"] = "no-store"
+            return resp
+    #Job TTS nền chưa xong → 202 để client thử lại (hoặc chờ bằng ?wait=<giây>)
+    if job is not None and job.status == "failed":
+        return abort(404, description=f"Audio file {name} failed to synthesize")
+    if AUDIO_MEMORY and is_audio_name(name):
+        data = read_audio(name)
+        if data is None:
+            return abort(404, description=f"Audio file {name} not found")
+        resp = make_response(send_file(io.BytesIO(data), mimetype=audio_mimetype(name), etag=audio_etag(name),
+                                       max_age=31536000, conditional=True))
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return resp
+    #Phục vụ từ RAM, không chạm đĩa; conditional=True → hỗ trợ Range / If-None-Match như file trên đĩa
+    path = audio_path(name)
+    #File trong voice bank, không thì ghép chuỗi với TMP_DIR
     if not os.path.exists(path):
         return abort(404, description=f"Audio file {name} not found")
-    resp = make_response(send_from_directory("tmp", name, mimetype="audio/mpeg"))
+    if is_audio_name(name):
+        #File đặt tên theo hash nội dung → không bao giờ thay đổi: ETag mạnh + cache lâu dài
+        resp = make_response(send_from_directory(os.path.dirname(path), name, mimetype=audio_mimetype(name),
+                                                 etag=audio_etag(name), max_age=31536000))
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return resp
+    resp = make_response(send_from_directory(TMP_DIR, name, mimetype="audio/mpeg"))
     #Gửi tệp âm thanh với kiểu MIME audio/mpeg
     resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     resp.headers["Pragma"] = "no-cache"
@@ -204,160 +2384,920 @@ def serve_audio(name):
 
 
 
-@app.route("/chat", methods=["POST"])
-def chat():
+@app.route("/intent/batch", methods=["POST"])
+def intent_batch():
     data = request.get_json(silent=True) or {}
+    texts = data.get("texts")
+    if not isinstance(texts, list):
+        return jsonify({"error": "texts must be a list of strings"}), 400
+    if len(texts) > INTENT_BATCH_MAX:
+        return jsonify({"error": f"at most {INTENT_BATCH_MAX} texts per batch"}), 400
+    texts = [(t if isinstance(t, str) else "").strip() for t in texts]
+    results = detect_intent_semantic_batch(texts, (data.get("npc_id") or "").strip() or None)
+    return jsonify({"results": [
+        {"text": t, "intent": intent, "score": score, "confident": score >= INTENT_THRESHOLD}
+        for t, (intent, score) in zip(texts, results)
+    ]}), 200
+#Phân loại intent cho cả danh sách câu trong 1 lần encode (chỉ dùng bộ so khớp ngữ nghĩa, không gọi LLM).
+
+
+@app.route("/intent/index", methods=["GET"])
+def intent_index_stats():
+    return jsonify(INTENT_INDEXES.stats()), 200
+
+
+@app.route("/intent/reload", methods=["POST"])
+def intent_reload():
+    ok = INTENT_INDEXES.reload()
+    return jsonify({"ok": ok, **INTENT_INDEXES.stats()}), 200 if ok else 500
+#Nạp lại intent_examples.json ngay (không cần chờ luồng theo dõi file).
+
+
+@app.route("/emb/stats", methods=["GET"])
+def emb_stats():
+    return jsonify(EMB_BATCHER.stats()), 200
+
+
+@app.route("/intent/cache", methods=["GET"])
+def intent_cache_stats():
+    return jsonify(INTENT_CACHE.stats()), 200
+
+
+@app.route("/intent/cache/clear", methods=["POST"])
+def intent_cache_clear():
+    INTENT_CACHE.clear()
+    return jsonify({"ok": True})
+#Xem thống kê / xóa cache embedding của câu người chơi.
+
+
+def map_intent_to_action(intent: str, npc_id=None):
+    #Tra bảng action của NPC (npc_personas.json), dựng sẵn lúc khởi động; intent không có trong bảng → NONE
+    return PERSONAS.get(npc_id).action_for(intent)
+#Cầu nối intent đã phát hiện với các hành động trò chơi cụ thể và tham số liên quan
+
+
+# ========== PROMPT BUILDER ==========
+#Thứ tự message: [persona cố định] + [lịch sử] + [context thay đổi: quest / trạng thái NPC / thẻ intent] + [câu mới].
+#Phần đầu (persona + lịch sử cũ) giữ nguyên giữa các lượt → LM Studio dùng lại được KV cache của prefix,
+#chỉ phải xử lý phần đuôi. Lịch sử được cắt theo ngân sách token; khi phải cắt thì cắt sâu xuống
+#PROMPT_TRIM_TARGET * ngân sách và ghi nhớ điểm cắt, để prefix ổn định thêm nhiều lượt sau đó.
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "2048"))
+PROMPT_TRIM_TARGET = 0.6
+MESSAGE_OVERHEAD_TOKENS = 4
+#header role/đầu-cuối message trong chat template
+TOKEN_RE = re.compile(r"\w{1,4}|[^\w\s]")
+#ước lượng gần với tokenizer BPE: từ dài bị tách thành từng đoạn ~4 ký tự, mỗi dấu câu 1 token
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    #Kết quả được cache theo nội dung message → lịch sử cũ không phải đếm lại mỗi lượt
+    return len(TOKEN_RE.findall(text or ""))
+
+
+def message_tokens(msg: dict) -> int:
+    return count_tokens(msg.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+# ========== ROLLING SUMMARY ==========
+#Lượt cũ không bị quên khi rời khỏi prompt: worker nền gộp chúng vào 1 đoạn tóm tắt ngắn của session
+#(tóm tắt cũ + các lượt vừa bị đẩy ra → tóm tắt mới), gọi LLM ở mức ưu tiên thấp nhất, không nằm trên đường trả lời.
+#Prompt dùng tóm tắt thay cho các lượt cũ → kích thước prompt gần như phẳng dù hội thoại dài bao nhiêu.
+#Việc gộp được yêu cầu sớm (khi lịch sử chiếm SUMMARY_TRIGGER ngân sách) để tóm tắt sẵn sàng trước khi phải cắt.
+SUMMARY_ENABLED = os.environ.get("SUMMARY_ENABLED", "1") == "1"
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", "160"))
+SUMMARY_TRIGGER = 0.8
+SUMMARY_PRIORITY = 3
+#thấp hơn mọi request của người chơi (LLM_DEFAULT_PRIORITY = 2); nhờ già hóa vẫn không bị bỏ đói
+SUMMARY_QUEUE_MAX = 256
+SUMMARY_HEADER = "[EARLIER IN THIS CONVERSATION]\n"
+SUMMARY_INSTRUCTIONS = """
+You maintain a running memory of a conversation between the player and you, an NPC in a fantasy RPG.
+Merge the new lines into the existing summary. Keep every concrete fact: names, places, items, prices,
+quests accepted or finished, promises, and what the player told you about themselves. Drop small talk.
+Write in the third person ("The player ..."), at most 120 words, plain text only.
+"""
+INTENT_PREFIX_RE = re.compile(r"^\[intent=[^\]]*\]\s*")
+
+
+def summary_transcript(messages) -> str:
+    lines = []
+    for m in messages:
+        content = INTENT_PREFIX_RE.sub("", m.get("content") or "").strip()
+        if content:
+            lines.append(f"{'Player' if m['role'] == 'user' else 'NPC'}: {content}")
+    return "\n".join(lines)
+
+
+class ConversationSummarizer:
+    def __init__(self, maxsize: int):
+        self.q = queue.Queue(maxsize=maxsize)
+        self.pending = {}
+        #session_id → vị trí cần tóm tắt tới; mỗi session chỉ có 1 mục trong hàng đợi
+        self.lock = threading.Lock()
+        self.folded = 0
+        self.failed = 0
+        self.rejected = 0
+        self.lost = 0
+        self.total_ms = deque(maxlen=512)
+        self.llm_post = self.post_sync
+        #payload → JSON trả về; server async thay bằng bản gửi qua AsyncLlmClient (chung giới hạn LLM_MAX_INFLIGHT)
+        threading.Thread(target=self._worker, name="summarizer", daemon=True).start()
+
+    def request(self, session_id: str, upto: int):
+        with self.lock:
+            if session_id in self.pending:
+                self.pending[session_id] = max(self.pending[session_id], upto)
+                return
+            self.pending[session_id] = upto
+        try:
+            self.q.put_nowait(session_id)
+        except queue.Full:
+            with self.lock:
+                self.pending.pop(session_id, None)
+                self.rejected += 1
+        #hàng đợi đầy thì bỏ qua: lượt sau builder sẽ yêu cầu lại
+
+    def _worker(self):
+        while True:
+            session_id = self.q.get()
+            with self.lock:
+                upto = self.pending.pop(session_id, None)
+            start = time.monotonic()
+            try:
+                if upto is not None and self._fold(session_id, upto):
+                    with self.lock:
+                        self.folded += 1
+                        self.total_ms.append((time.monotonic() - start) * 1000.0)
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                print(f"[SUMMARY] session '{session_id}' failed: {e}")
+                METRICS.inc("errors_total", "summary")
+            self.q.task_done()
+
+    def _fold(self, session_id: str, upto: int) -> bool:
+        state = SESSION_STORE.get_state(session_id)
+        history, offset, done = state["history"], state["offset"], state["summary_upto"]
+        if upto <= done:
+            return False
+        if offset > done:
+            with self.lock:
+                self.lost += offset - done
+        #store đã bỏ message trước khi kịp tóm tắt (MAX_TURNS quá nhỏ so với ngân sách prompt)
+        new = history[max(done, offset) - offset:max(0, upto - offset)]
+        if not new:
+            return False
+        with METRICS.stage("llm_summary"):
+            summary = self.summarize(state["summary"], new)
+        ok = SESSION_STORE.set_summary(session_id, summary, min(upto, offset + len(history)), done)
+        if ok and DEBUG_LOG:
+            print(f"[SUMMARY] session '{session_id}': folded {len(new)} messages → ~{count_tokens(summary)} tokens")
+        return ok
+
+    def summarize(self, summary: str, messages) -> str:
+        payload = {
+            "model": MODEL_NAME,
+            "messages": [
+                {"role": "system", "content": SUMMARY_INSTRUCTIONS.strip()},
+                {"role": "user", "content": f"Existing summary:\n{summary or '(none)'}\n\n"
+                                            f"New lines:\n{summary_transcript(messages)}"},
+            ],
+            "max_tokens": SUMMARY_MAX_TOKENS,
+            "temperature": 0.2,
+        }
+        j = self.llm_post(payload)
+        text = (j["choices"][0]["message"]["content"] or "").strip()
+        text = re.sub(r"^(?:updated\s+)?summary\s*:\s*", "", text, flags=re.I).strip()
+        if not text:
+            raise ValueError("empty summary")
+        return text
+
+    def post_sync(self, payload: dict) -> dict:
+        return LLM.post(payload, timeout=60, priority=SUMMARY_PRIORITY).json()
+        #không truyền session_id: tóm tắt không được thay thế (supersede) request đang trả lời người chơi
+
+    def stats(self):
+        with self.lock:
+            total_ms = list(self.total_ms)
+            return {
+                "enabled": SUMMARY_ENABLED,
+                "queue_depth": self.q.qsize(),
+                "folded": self.folded,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "lost_messages": self.lost,
+                "fold_latency_ms": {"p50": percentile(total_ms, 50), "p95": percentile(total_ms, 95)},
+            }
+
+SUMMARIZER = ConversationSummarizer(SUMMARY_QUEUE_MAX)
+
+
+class PromptBuilder:
+    MAX_ANCHORS = 10000
+
+    def __init__(self, budget: int, trim_target: float, summarize: bool):
+        self.budget = budget
+        self.trim_target = trim_target
+        self.summarize = summarize
+        self.anchors = OrderedDict()
+        #session_id → (role, content) của message lịch sử đầu tiên còn giữ trong prompt
+        self.lock = threading.Lock()
+
+    def _fit_start(self, history, limit: int) -> int:
+        #Vị trí nhỏ nhất sao cho history[start:] nằm trong limit token; chỉ cắt ở đầu 1 lượt (message user)
+        total, start = 0, len(history)
+        for i in range(len(history) - 1, -1, -1):
+            total += message_tokens(history[i])
+            if total > limit:
+                break
+            if history[i]["role"] == "user":
+                start = i
+        return start
+
+    @staticmethod
+    def _fingerprint(history, i: int):
+        return tuple((m["role"], m["content"]) for m in history[i:i + 2])
+
+    def _find_anchor(self, history, anchor):
+        #Điểm cắt lần trước: thường vẫn ở đúng vị trí cũ; nếu store đã bỏ bớt message đầu thì nó lùi về trước
+        idx, fp = anchor
+        for i in range(min(idx, len(history) - 1), -1, -1):
+            if self._fingerprint(history, i) == fp:
+                return i
+        return None
+
+    def build(self, session_id: str, prefix: str, history, volatile: str, user_msg: dict,
+              offset: int = 0, summary: str = "", summary_upto: int = 0):
+        #offset: số thứ tự của history[0] trong phiên; summary tóm tắt các message [0, summary_upto)
+        head = [{"role": "system", "content": prefix}]
+        if summary:
+            head.append({"role": "system", "content": SUMMARY_HEADER + summary})
+        tail = ([{"role": "system", "content": volatile}] if volatile else []) + [user_msg]
+        fixed = sum(message_tokens(m) for m in head + tail)
+        room = max(0, self.budget - fixed)
+        history_tokens = [message_tokens(m) for m in history]
+        covered = min(max(0, summary_upto - offset), len(history))
+        #history[:covered] đã nằm trong tóm tắt
+
+        start = None
+        if self.summarize and sum(history_tokens[covered:]) <= room:
+            start = covered
+        #có tóm tắt: prompt = tóm tắt + phần chưa tóm tắt; điểm cắt chỉ đổi khi tóm tắt được cập nhật
+        with self.lock:
+            anchor = self.anchors.get(session_id)
+        if start is None and anchor is not None:
+            i = self._find_anchor(history, anchor)
+            if i is not None and sum(history_tokens[i:]) <= room:
+                start = i
+        if start is None:
+            start = 0 if sum(history_tokens) <= room else self._fit_start(history, int(room * self.trim_target))
+        with self.lock:
+            if 0 < start < len(history):
+                self.anchors[session_id] = (start, self._fingerprint(history, start))
+                self.anchors.move_to_end(session_id)
+                while len(self.anchors) > self.MAX_ANCHORS:
+                    self.anchors.popitem(last=False)
+            else:
+                self.anchors.pop(session_id, None)
+
+        fold_upto = None
+        if self.summarize and sum(history_tokens[covered:]) > room * SUMMARY_TRIGGER:
+            cut = self._fit_start(history, int(room * self.trim_target))
+            if cut > covered:
+                fold_upto = offset + cut
+        #tóm tắt lại từ sớm, trước khi lịch sử vượt ngân sách → lúc phải cắt thì tóm tắt đã có sẵn
+
+        kept = list(history[start:])
+        messages = head + kept + tail
+        info = {
+            "tokens_est": fixed + sum(history_tokens[start:]),
+            "prefix_tokens_est": sum(message_tokens(m) for m in head) + sum(history_tokens[start:]),
+            "history_messages": len(kept),
+            "history_trimmed": start,
+            "summary_tokens_est": message_tokens(head[1]) if summary else 0,
+            "summarized_messages": summary_upto,
+            "summary_fold_upto": fold_upto,
+        }
+        #prefix_tokens_est: phần đầu giống lượt trước (persona + lịch sử giữ lại) → có thể trúng KV cache
+        return messages, info
+
+PROMPT_BUILDER = PromptBuilder(PROMPT_TOKEN_BUDGET, PROMPT_TRIM_TARGET, SUMMARY_ENABLED)
+
+
+def prepare_chat_turn(data: dict):
+    #Phần chung của /chat và /chat/stream: đọc request, phát hiện intent, dựng payload cho LM Studio.
+    #Trả None nếu người dùng không nói gì.
+    turn = begin_chat_turn(data)
+    if turn is None:
+        return None
+    turn["request"] = LLM.begin_request(turn["session_id"])
+    #số thứ tự lượt chat: thay thế lượt cũ cùng session dù lượt này được trả lời bằng đường nào;
+    #ticket phân loại và ticket sinh câu của lượt này không thay thế lượt mới hơn
+    if turn["intent"] is None and not turn["single_call"]:
+        turn["intent"] = classify_intent_llama(turn["user_input"], turn["session_id"], turn["request"],
+                                               turn["valid_intents"])
+    #Chưa chắc chắn: chế độ thường gọi LLM phân loại; chế độ single-call để model trả intent cùng câu trả lời
+    return build_chat_turn(turn, data)
+
+
+def begin_chat_turn(data: dict):
+    #Nửa đầu của prepare_chat_turn (không gọi LLM): đọc request, lịch sử session, intent từ luật từ khóa / embedding.
+    #Server async (chatbox_async.py) chạy phần này trong executor rồi tự await bước phân loại bằng LLM.
     user_input = (data.get("text") or "").strip()
     session_id = (data.get("session_id") or "default").strip() or "default"
     quest_context = (data.get("quest_context") or "").strip()
     npc_context = (data.get("npc_context") or "").strip()
-    #Lấy dữ liệu JSON từ yêu cầu POST, trích xuất văn bản người dùng, session_id và contexts
+    npc_id = (data.get("npc_id") or "").strip() or None
+    persona = PERSONAS.get(npc_id)
+    #Lấy dữ liệu JSON từ yêu cầu POST, trích xuất văn bản người dùng, session_id, NPC và contexts
     
-    print(f"[DEBUG] Input: '{user_input}' | Has quest_context: {bool(quest_context)}")
-    if quest_context:
-        print(f"[DEBUG] Quest context (first 80 chars): {quest_context[:80]}...")
+    if DEBUG_LOG:
+        print(f"[DEBUG] Input: '{user_input}' | Has quest_context: {bool(quest_context)}")
+        if quest_context:
+            print(f"[DEBUG] Quest context (first 80 chars): {quest_context[:80]}...")
     
     if not user_input:
-        return jsonify({"reply": "I didn’t hear anything...", "audio_url": None, "intent": "other"}), 200
-    #Nếu văn bản người dùng rỗng, trả về phản hồi mặc định
-    history = get_history(session_id)
-    #Lấy lịch sử hội thoại cho session hiện tại
-    intent = detect_intent(user_input)
-    #Phát hiện intent từ văn bản người dùng
-    low_text = user_input.lower()
-    
-    # PRIORITY 1: Check for quest confirmation if quest_context exists
-    # This must be checked FIRST to prevent other keywords from overriding
-    confirmation_keywords = ["yes", "sure", "okay", "ok", "i'll help", "i will help", "accept", "agree", "let's do it", "let me help", "count me in", "sounds good", "alright"]
-    if quest_context and any(k in low_text for k in confirmation_keywords):
-        intent = "quest_confirmation"
-        print(f"[QUEST] Detected quest confirmation with keyword in: {low_text}")
-    # PRIORITY 2: Check for quest completion
-    elif any(k in low_text for k in ["finished", "completed", "complete", "done", "turn in", "here are", "i have", "i'm done", "task done", "quest done"]):
-        intent = "complete_quest"
-        print(f"[QUEST] Detected complete_quest with keyword in: {low_text}")
-    # PRIORITY 3: Check for asking about quests
-    elif any(k in low_text for k in ["need help", "need anything", "can i help", "any task", "any quest", "any job"]):
-        intent = "ask_for_quest"
-    # PRIORITY 4: Check for quest status
-    elif any(k in low_text for k in ["my quest", "quest status", "quest progress", "what task", "check quest"]):
-        intent = "quest_status"
-    # PRIORITY 5: Other specific intents
-    elif any(k in low_text for k in ["village", "town", "where"]):
-        intent = "ask_direction"
-    elif any(k in low_text for k in ["attack", "fight", "wolf", "combat"]):
-        intent = "combat"
-    elif any(k in low_text for k in ["shop", "buy", "sell"]):
-        intent = "trade"
-    elif any(k in low_text for k in ["bye", "goodbye"]):
-        intent = "farewell"
-    elif any(k in low_text for k in ["flower", "pick", "gather", "bloom", "petal"]):
-        intent = "gather_flower"
-    #Cải thiện phát hiện intent dựa trên từ khóa cụ thể - với ưu tiên quest confirmation
-    history.append({"role": "user", "content": f"[intent={intent}] {user_input}"})
-    #Lưu lịch sử hội thoại với định dạng đặc biệt để bao gồm intent
+        return None
+    state = SESSION_STORE.get_state(session_id)
+    #Lấy lịch sử hội thoại (kèm tóm tắt các lượt cũ) cho session hiện tại
+    intent = detect_intent_fast(user_input, quest_context, npc_id)
+    #Phát hiện intent: luật từ khóa (intent_rules.json) trước, sau đó mới tới embedding
+    valid_intents = tuple(INTENT_INDEXES.get(npc_id).labels) + ("other",)
+    #nhãn của NPC này: dùng cho cả prompt phân loại và thẻ single-call
+    return {
+        "user_input": user_input,
+        "session_id": session_id,
+        "quest_context": quest_context,
+        "npc_context": npc_context,
+        "npc_id": npc_id,
+        "persona": persona,
+        "state": state,
+        "single_call": bool(data.get("single_call", LLM_SINGLE_CALL)),
+        "intent": intent,
+        "valid_intents": valid_intents,
+        "request": None,
+        #server gán bằng LLM.begin_request ngay sau bước này (mỗi server có hàng đợi LLM riêng)
+    }
+
+
+def build_chat_turn(turn: dict, data: dict):
+    #Nửa sau: dựng prompt + payload khi intent đã chốt (hoặc để model tự trả intent ở chế độ single-call).
+    user_input, session_id, intent = turn["user_input"], turn["session_id"], turn["intent"]
+    quest_context, npc_context, npc_id = turn["quest_context"], turn["npc_context"], turn["npc_id"]
+    persona, state = turn["persona"], turn["state"]
+    history = state["history"]
+    canned = fast_path_line(turn, data)
+    if canned is not None:
+        return canned
+    deferred_intent = intent is None
     
-    # Build contextual system prompt
-    contextual_prompt = system_prompt
+    # Build contextual system prompt: persona cố định ở đầu, context thay đổi theo lượt đặt sát câu mới
+    volatile = []
     if quest_context:
-        contextual_prompt += f"\n\n[QUEST INFO]\n{quest_context}\n"
-        contextual_prompt += "When player asks about quests or help, naturally explain this quest in your own words. "
-        contextual_prompt += "Make it sound like you really need help, not like you're reading from a quest log. "
-        contextual_prompt += "After explaining, ask if they would be willing to help you."
+        volatile.append(
+            f"[QUEST INFO]\n{quest_context}\n"
+            "When player asks about quests or help, naturally explain this quest in your own words. "
+            "Make it sound like you really need help, not like you're reading from a quest log. "
+            "After explaining, ask if they would be willing to help you."
+        )
     if npc_context:
-        contextual_prompt += f"\n\n[YOUR CURRENT STATUS]\n{npc_context}"
+        volatile.append(f"[YOUR CURRENT STATUS]\n{npc_context}")
+    valid_intents = turn["valid_intents"]
+    if deferred_intent:
+        volatile.append(single_call_instructions(valid_intents).strip())
     
-    messages = [{"role": "system", "content": contextual_prompt}] + list(history)
-    payload = {"model": MODEL_NAME, "messages": messages}
+    user_msg = {"role": "user", "content": user_input if deferred_intent else f"[intent={intent}] {user_input}"}
+    with METRICS.stage("prompt_build"):
+        messages, prompt_info = PROMPT_BUILDER.build(session_id, persona.prefix, history, "\n\n".join(volatile), user_msg,
+                                                     state["offset"], state["summary"], state["summary_upto"])
+    METRICS.tag("npc_id", persona.npc_id)
+    payload = {"model": MODEL_NAME, "messages": messages, "stream_options": {"include_usage": True}}
     # Tạo payload cho yêu cầu API Ollama với lịch sử hội thoại và context
-    try:
-        print(f"[DEBUG] Sending to LM Studio: {OLLAMA_URL}")
-        print(f"[DEBUG] Payload: {payload}")
-        resp = requests.post(OLLAMA_URL, json=payload, timeout=60)
-        #Gửi yêu cầu POST đến API LM Studio với payload đã tạo
-        print(f"[DEBUG] LM Studio response status: {resp.status_code}")
-        j = resp.json()
-
-        # ✅ FIX: LM Studio có thể trả về nội dung ở "choices[0].message.content" hoặc "choices[0].text"
-        reply = (
-            j.get("choices", [{}])[0]
-             .get("message", {})
-             .get("content")
-            or j.get("choices", [{}])[0].get("text", "")
-        )
-        reply = (reply or "").strip()
-        #Phân tích phản hồi JSON từ LM Studio để lấy nội dung trả lời
+    if DEBUG_LOG:
+        print(f"[PROMPT] ~{prompt_info['tokens_est']} tokens (prefix ~{prompt_info['prefix_tokens_est']}), "
+              f"history {prompt_info['history_messages']} kept / {prompt_info['history_trimmed']} trimmed, "
+              f"summary ~{prompt_info['summary_tokens_est']} tokens")
+    priority = data.get("priority")
+    return {
+        "user_input": user_input,
+        "session_id": session_id,
+        "request": turn["request"],
+        "priority": priority if isinstance(priority, int) else llm_priority(intent),
+        "history": history,
+        "intent": intent,
+        "deferred_intent": deferred_intent,
+        "npc_id": npc_id,
+        "valid_intents": valid_intents,
+        "payload": payload,
+        "prompt": prompt_info,
+        "canned": None,
+    }
 
-        if not reply:
-            reply = "(no reply from model)"
-    except Exception as e:
-        reply = f"LM Studio not reachable: {e}"
 
-    history.append({"role": "assistant", "content": reply or ""})
-    #Luu phản hồi của NPC vào lịch sử hội thoại
+def fast_path_line(turn: dict, data: dict):
+    #Intent cố định + NPC có câu soạn sẵn → lượt hội thoại không cần payload LLM (tắt cho 1 request: "fast_path": false)
+    intent, persona = turn["intent"], turn["persona"]
+    if not (FAST_PATH and data.get("fast_path", True)) or intent not in FAST_PATH_INTENTS:
+        return None
+    if intent in FAST_PATH_QUEST_INTENTS and not turn["quest_context"]:
+        return None
+    #không có nhiệm vụ nào đang diễn ra → để LLM trả lời thay vì đọc câu về nhiệm vụ
+    last = next((m["content"] for m in reversed(turn["state"]["history"]) if m["role"] == "assistant"), None)
+    line = persona.canned_line(intent, avoid=last)
+    if line is None:
+        return None
+    METRICS.inc("fast_path_total", intent)
+    METRICS.tag("npc_id", persona.npc_id)
+    if DEBUG_LOG:
+        print(f"[FAST] {persona.npc_id}/{intent} -> canned reply")
+    return {
+        "user_input": turn["user_input"],
+        "session_id": turn["session_id"],
+        "request": turn["request"],
+        "priority": llm_priority(intent),
+        "history": turn["state"]["history"],
+        "intent": intent,
+        "deferred_intent": False,
+        "npc_id": turn["npc_id"],
+        "valid_intents": turn["valid_intents"],
+        "payload": None,
+        "prompt": {"fast_path": True, "summary_fold_upto": None},
+        "canned": line,
+    }
+
+
+def finish_chat_turn(turn: dict, intent: str, reply: str):
+    SESSION_STORE.append(turn["session_id"], [
+        {"role": "user", "content": f"[intent={intent}] {turn['user_input']}"},
+        #Lưu lịch sử hội thoại với định dạng đặc biệt để bao gồm intent
+        {"role": "assistant", "content": reply or ""},
+        #Luu phản hồi của NPC vào lịch sử hội thoại
+    ])
+    if turn["prompt"]["summary_fold_upto"] is not None:
+        SUMMARIZER.request(turn["session_id"], turn["prompt"]["summary_fold_upto"])
+    #gộp lượt cũ vào tóm tắt sau khi đã trả lời xong, không làm chậm lượt hiện tại
+
 
+def audio_url_for(url_root: str, text: str, async_audio: bool = False):
+    if async_audio:
+        name = audio_name_for(text)
+        if not audio_cached(name):
+            job = TTS_QUEUE.submit(text)
+            if job is None:
+                return None
+        return url_root.rstrip("/") + f"/audio/{name}"
+    #Chế độ async: trả URL ngay, file sẽ có khi job xong
     try:
-        _, audio_name = tts_file(reply)
-        audio_url = request.url_root.rstrip("/") + f"/audio/{audio_name}"
+        _, audio_name = tts_file(text)
+        return url_root.rstrip("/") + f"/audio/{audio_name}"
     #Tạo tệp âm thanh TTS cho phản hồi và tạo URL để truy cập tệp đó
     #Ghép URL dựa trên URL gốc của yêu cầu hiện tại
     except Exception as e:
-        audio_url = None
-
-    # ===== NEW: Map intent → game action =====
-    action = None
-    params = {}
-
-    if intent == "ask_direction":
-        action = "NAVIGATE"
-        params = {"target": "village", "target_label": "Village"}
-    elif intent == "combat":
-        action = "START_COMBAT"
-    elif intent == "trade":
-        action = "OPEN_SHOP"
-        params = {"shop_id": "default_shop"}
-    elif intent == "farewell":
-        action = "ANIM"
-        params = {"name": "wave"}
-    elif intent == "gather_flower":
-        action = "GATHER_FLOWER"
-        params = {"target": "flower_field", "target_label": "Wildflowers"}
-    elif intent == "quest_confirmation":
-        # Player confirmed to accept the quest
-        action = "ACCEPT_QUEST_CONFIRM"
-        params = {"trigger": "player_confirmed"}
-    elif intent == "ask_for_quest":
-        # Player asking if NPC needs help - explain quest but don't accept yet
-        action = "QUEST_DIALOGUE"
-        params = {"trigger": "player_ask_help"}
-    elif intent == "quest_status":
-        action = "SHOW_QUEST_STATUS"
-        params = {"open_quest_panel": True}
-    elif intent == "complete_quest":
-        action = "COMPLETE_QUEST"
-        params = {"trigger": "turn_in"}
-    else:
-        action = "NONE"
-    #Cầu nối intent đã phát hiện với các hành động trò chơi cụ thể và tham số liên quan
-    return jsonify({
+        return None
+
+
+def prompt_report(turn: dict, usage: dict):
+    #Số token ước lượng phía server + số token thực tế nếu LM Studio trả về usage
+    report = dict(turn["prompt"])
+    report["tokens"] = usage.get("prompt_tokens")
+    if DEBUG_LOG and usage.get("prompt_tokens") is not None:
+        print(f"[PROMPT] backend prompt_tokens={usage['prompt_tokens']} (est ~{report['tokens_est']})")
+    return report
+
+
+SUPERSEDED_RESPONSE = {"reply": "", "audio_url": None, "intent": "other", "action": "NONE", "params": {}, "superseded": True}
+#Trả cho request đã bị thay thế bởi câu mới hơn cùng session (client sẽ bỏ qua; không ghi vào lịch sử)
+
+
+@app.route("/chat", methods=["POST"])
+@timed_request("chat")
+def chat():
+    data = request.get_json(silent=True) or {}
+    try:
+        turn = prepare_chat_turn(data)
+    except LlmSupersededError:
+        return jsonify(SUPERSEDED_RESPONSE), 200
+    if turn is None:
+        return jsonify({"reply": "I didn’t hear anything...", "audio_url": None, "intent": "other"}), 200
+    #Nếu văn bản người dùng rỗng, trả về phản hồi mặc định
+    intent = turn["intent"]
+    payload = turn["payload"]
+    usage = {}
+    try:
+        if DEBUG_LOG:
+            print(f"[DEBUG] Sending to LM Studio: {OLLAMA_URL}")
+            if random.random() < DEBUG_PAYLOAD_SAMPLE:
+                print(f"[DEBUG] Payload: {payload}")
+        #in cả payload (toàn bộ prompt) mỗi request làm chậm đường xử lý → chỉ in mẫu khi bật DEBUG
+        if turn["canned"] is not None:
+            reply = turn["canned"]
+        else:
+            reply = "".join(stream_llm_tokens(payload, turn["session_id"], turn["priority"], usage, turn["request"])).strip()
+        #Gửi yêu cầu tới LM Studio (qua client dùng chung). Dùng stream nội bộ để có thể ngắt ngay
+        #khi request bị thay thế, giải phóng model thay vì sinh nốt câu trả lời không ai dùng.
+        if turn["deferred_intent"]:
+            intent, reply = parse_intent_reply(reply, turn["valid_intents"])
+            METRICS.inc("intent_source_total", "single_call")
+            if DEBUG_LOG:
+                print(f"[INTENT] single-call -> {intent}")
+
+        if not reply:
+            reply = "(no reply from model)"
+            METRICS.inc("fallbacks_total", "empty_reply")
+    except LlmSupersededError:
+        if DEBUG_LOG:
+            print(f"[LLM] session '{turn['session_id']}' superseded, dropping reply")
+        METRICS.inc("fallbacks_total", "superseded")
+        return jsonify(SUPERSEDED_RESPONSE), 200
+    except LlmBusyError as e:
+        reply = BUSY_REPLY
+        METRICS.inc("fallbacks_total", "llm_busy")
+        if DEBUG_LOG:
+            print(f"[LLM] {e}, degraded reply")
+    except Exception as e:
+        reply = f"LM Studio not reachable: {e}"
+        METRICS.inc("errors_total", "llm_generate")
+        METRICS.inc("fallbacks_total", "llm_unreachable")
+    if intent is None:
+        intent = "other"
+    METRICS.tag("intent", intent)
+
+    finish_chat_turn(turn, intent, reply)
+    async_audio = bool(data.get("async_audio", TTS_ASYNC)) and not MULTI_WORKER
+    with METRICS.stage("tts"):
+        audio_url = audio_url_for(request.url_root, reply, async_audio)
+    action, params = map_intent_to_action(intent, turn["npc_id"])
+    resp = {
         "reply": reply,
         "audio_url": audio_url,
         "intent": intent,
         "action": action,
-        "params": params
-    }), 200
+        "params": params,
+        "prompt": prompt_report(turn, usage),
+    }
+    if audio_url and not async_audio and data.get("inline_audio", AUDIO_INLINE):
+        resp.update(inline_audio(reply))
+    #clip nhỏ nhúng luôn vào JSON (audio_url vẫn giữ cho client cũ)
+    return jsonify(resp), 200
     #Trả về phản hồi JSON bao gồm văn bản trả lời, URL âm thanh, intent, hành động và tham số
 
 
+# ========== STREAMING (SSE) ==========
+#Chờ tối đa bấy nhiêu ký tự đầu của stream để tìm dòng "INTENT: ..." trong chế độ single-call.
+STREAM_TAG_BUFFER = 96
+
+def stream_llm_tokens(payload: dict, session_id=None, priority: int = LLM_DEFAULT_PRIORITY, usage: dict = None,
+                      request: int = None):
+    #Gửi payload với stream=true tới LM Studio và trả dần từng đoạn text (OpenAI-compatible SSE: "data: {...}").
+    #Có câu mới cùng session → LlmSupersededError, đóng kết nối để LM Studio dừng sinh.
+    start = time.perf_counter()
+    try:
+        yield from _stream_llm_pieces(payload, session_id, priority, usage, start, request)
+    finally:
+        METRICS.observe("llm_generate", (time.perf_counter() - start) * 1000.0)
+    #llm_generate gồm cả thời gian chờ hàng đợi LLM (xem /llm/stats) và thời gian sinh
+
+
+def parse_stream_line(line: str, usage: dict = None):
+    #1 dòng SSE của LM Studio → đoạn text ("" nếu không có), None khi gặp [DONE]
+    if not line or not line.startswith("data:"):
+        return ""
+    chunk = line[5:].strip()
+    if chunk == "[DONE]":
+        return None
+    try:
+        j = json.loads(chunk)
+    except ValueError:
+        return ""
+    if usage is not None and j.get("usage"):
+        usage.update(j["usage"])
+    #chunk cuối (stream_options.include_usage) mang số token thực tế backend đã xử lý
+    choice = (j.get("choices") or [{}])[0]
+    return (choice.get("delta") or {}).get("content") or choice.get("text") or ""
+
+
+def _stream_llm_pieces(payload: dict, session_id, priority: int, usage: dict, start: float, request: int):
+    first = True
+    with LLM.stream(payload, 60, session_id, priority, request) as (resp, ticket):
+        resp.raise_for_status()
+        resp.encoding = "utf-8"
+        for line in resp.iter_lines(decode_unicode=True):
+            if ticket.superseded:
+                raise LlmSupersededError("superseded while generating")
+            piece = parse_stream_line(line, usage)
+            if piece is None:
+                break
+            if piece:
+                if first:
+                    METRICS.observe("llm_first_token", (time.perf_counter() - start) * 1000.0)
+                    first = False
+                yield piece
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def intent_tag_ready(buf: str) -> bool:
+    #Đủ dữ liệu để tách thẻ intent: đã có nội dung sau dòng đầu, hoặc buffer đã quá dài.
+    return len(buf) >= STREAM_TAG_BUFFER or re.search(r"\S.*\n\s*\S.{5}", buf) is not None
+
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    #Giống /chat nhưng trả về text/event-stream:
+    #  event: meta  → intent, action, params (sớm, trước khi model trả lời xong)
+    #  event: token → từng đoạn text của câu trả lời
+    #  event: audio → (tts_pipeline) clip của từng câu, theo thứ tự, ngay khi TTS xong
+    #  event: done  → reply đầy đủ + audio_url (giống JSON của /chat)
+    data = request.get_json(silent=True) or {}
+    timing = METRICS.begin("chat_stream")
+    try:
+        turn = prepare_chat_turn(data)
+    except LlmSupersededError:
+        turn = SUPERSEDED_RESPONSE
+    url_root = request.url_root.rstrip("/")
+    pipeline = bool(data.get("tts_pipeline", TTS_PIPELINE)) and not MULTI_WORKER
+    async_audio = bool(data.get("async_audio", TTS_ASYNC)) and not MULTI_WORKER
+    #nhiều worker: bỏ qua yêu cầu của client, trả audio đồng bộ (vẫn đúng định dạng response)
+    playlist = new_playlist() if pipeline and isinstance(turn, dict) and turn is not SUPERSEDED_RESPONSE \
+        and turn["canned"] is None else None
+    #câu soạn sẵn đã có nguyên clip trong voice bank → không cần tách câu
+
+    def generate():
+        #Phần lớn request chạy sau khi view đã trả về → đo tổng thời gian tới khi stream kết thúc
+        CURRENT_TIMING.set(timing)
+        try:
+            yield from generate_events()
+        finally:
+            if playlist is not None:
+                playlist.close()
+            #client ngắt SSE giữa chừng (GeneratorExit ở yield) → vẫn đóng playlist, người đọc /audio/stream không treo
+            METRICS.end(timing)
+
+    def generate_events():
+        if turn is SUPERSEDED_RESPONSE:
+            yield sse_event("done", SUPERSEDED_RESPONSE)
+            return
+        if turn is None:
+            reply = "I didn’t hear anything..."
+            yield sse_event("meta", {"intent": "other", "action": "NONE", "params": {}})
+            yield sse_event("token", {"text": reply})
+            yield sse_event("done", {"reply": reply, "audio_url": None, "intent": "other", "action": "NONE", "params": {}})
+            return
+        intent = turn["intent"]
+        pending = ""
+        parts = []
+        splitter = SentenceSplitter()
+        sent_audio = []
+        usage = {}
+        tag_filter = IntentTagFilter() if turn["deferred_intent"] else None
+
+        def meta_event():
+            action, params = map_intent_to_action(intent, turn["npc_id"])
+            meta = {"intent": intent, "action": action, "params": params}
+            if playlist is not None:
+                meta["audio_stream_url"] = f"{url_root}/audio/stream/{playlist.id}"
+            return sse_event("meta", meta)
+
+        def audio_events(names):
+            for name in names:
+                sent_audio.append(f"{url_root}/audio/{name}")
+                yield sse_event("audio", {"index": len(sent_audio) - 1, "audio_url": sent_audio[-1]})
+
+        def emit(piece):
+            parts.append(piece)
+            yield sse_event("token", {"text": piece})
+            if playlist is not None:
+                for sentence in splitter.feed(piece):
+                    playlist.add(sentence)
+                yield from audio_events(playlist.ready(len(sent_audio)))
+
+        if not turn["deferred_intent"]:
+            yield meta_event()
+        try:
+            pieces = [turn["canned"]] if turn["canned"] is not None else \
+                stream_llm_tokens(turn["payload"], turn["session_id"], turn["priority"], usage, turn["request"])
+            for piece in pieces:
+                if intent is None:
+                    #single-call: giữ lại phần đầu cho tới khi tách được dòng "INTENT: ..."
+                    pending += piece
+                    if not intent_tag_ready(pending):
+                        continue
+                    intent, piece = parse_intent_reply(pending, turn["valid_intents"])
+                    METRICS.inc("intent_source_total", "single_call")
+                    if piece:
+                        piece += pending[len(pending.rstrip()):]
+                    #giữ khoảng trắng cuối để ghép đúng với token kế tiếp
+                    if DEBUG_LOG:
+                        print(f"[INTENT] single-call (stream) -> {intent}")
+                    yield meta_event()
+                if tag_filter is not None:
+                    piece = tag_filter.feed(piece)
+                    #thẻ lặp lại ở giữa câu trả lời không được lọt ra token/TTS
+                if piece:
+                    yield from emit(piece)
+        except LlmSupersededError:
+            if DEBUG_LOG:
+                print(f"[LLM] session '{turn['session_id']}' superseded, dropping stream")
+            METRICS.inc("fallbacks_total", "superseded")
+            yield sse_event("done", SUPERSEDED_RESPONSE)
+            return
+        except LlmBusyError as e:
+            if DEBUG_LOG:
+                print(f"[LLM] {e}, degraded reply")
+            METRICS.inc("fallbacks_total", "llm_busy")
+            if intent is None:
+                intent = "other"
+                yield meta_event()
+            yield from emit(BUSY_REPLY)
+        except Exception as e:
+            METRICS.inc("errors_total", "llm_generate")
+            if not parts and not pending:
+                METRICS.inc("fallbacks_total", "llm_unreachable")
+                yield from emit(f"LM Studio not reachable: {e}")
+        if intent is None:
+            #stream kết thúc trước khi đủ buffer
+            intent, head = parse_intent_reply(pending, turn["valid_intents"])
+            yield meta_event()
+            if head:
+                yield from emit(head)
+        if tag_filter is not None:
+            tail = tag_filter.flush()
+            if tail:
+                yield from emit(tail)
+        reply = "".join(parts).strip()
+        if tag_filter is not None:
+            reply = strip_intent_tags(reply)
+        if not reply:
+            reply = "(no reply from model)"
+            METRICS.inc("fallbacks_total", "empty_reply")
+        METRICS.tag("intent", intent)
+
+        finish_chat_turn(turn, intent, reply)
+        action, params = map_intent_to_action(intent, turn["npc_id"])
+        done = {"reply": reply, "intent": intent, "action": action, "params": params, "prompt": prompt_report(turn, usage)}
+        if playlist is not None:
+            for sentence in splitter.flush():
+                playlist.add(sentence)
+            playlist.close()
+            for i, name in enumerate(playlist.iter_names()):
+                if i >= len(sent_audio):
+                    yield from audio_events([name])
+            done["audio_url"] = f"{url_root}/audio/stream/{playlist.id}"
+            done["audio_playlist"] = sent_audio
+        else:
+            with METRICS.stage("tts"):
+                done["audio_url"] = audio_url_for(url_root, reply, async_audio)
+            if done["audio_url"] and not async_audio and data.get("inline_audio", AUDIO_INLINE):
+                done.update(inline_audio(reply))
+        yield sse_event("done", done)
+
+    resp = Response(generate(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
 
 @app.route("/reset", methods=["POST"])
 def reset():
     data = request.get_json(silent=True) or {}
     session_id = (data.get("session_id") or "default").strip()
-    if session_id in SESSIONS:
-        del SESSIONS[session_id]
+    SESSION_STORE.delete(session_id)
     return jsonify({"ok": True})
 #Xóa lịch sử hội thoại cho một session cụ thể khi nhận được yêu cầu reset.
 
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    #Histogram thời gian từng giai đoạn + bộ đếm, kèm số liệu hiện tại của các cache / hàng đợi
+    intent_cache, tts_cache, llm, emb = INTENT_CACHE.stats(), TTS_CACHE.stats(), LLM.stats(), EMB_BATCHER.stats()
+    gauges = [
+        ("intent_cache_hits_total", intent_cache["hits"]),
+        ("intent_cache_misses_total", intent_cache["misses"]),
+        ("tts_cache_hits_total", tts_cache["hits"]),
+        ("tts_cache_misses_total", tts_cache["misses"]),
+        ("llm_inflight", llm["inflight"]),
+        ("llm_waiting", llm["waiting"]),
+        ("llm_rejected_total", llm["rejected"]),
+        ("llm_timed_out_total", llm["timed_out"]),
+        ("llm_superseded_total", llm["superseded"]),
+        ("emb_batches_total", emb["batches"]),
+        ("emb_batched_requests_total", emb["requests"]),
+        ("tts_queue_depth", TTS_QUEUE.stats()["queue_depth"]),
+    ]
+    if request.args.get("format") == "json":
+        return jsonify({**METRICS.snapshot(), "gauges": dict(gauges)}), 200
+    return Response(METRICS.prometheus(gauges), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/npcs", methods=["GET"])
+def npcs():
+    return jsonify(PERSONAS.stats()), 200
+
+
+@app.route("/voicebank", methods=["GET"])
+def voicebank_stats():
+    return jsonify(VOICE_BANK.stats()), 200
+
+
+@app.route("/voicebank/reload", methods=["POST"])
+def voicebank_reload():
+    VOICE_BANK.scan()
+    return jsonify(VOICE_BANK.stats()), 200
+#Quét lại VOICE_BANK_DIR sau khi chạy voice_bank.py (không cần khởi động lại server).
+
+
+@app.route("/sessions/stats", methods=["GET"])
+def sessions_stats():
+    return jsonify({**SESSION_STORE.stats(), "summary": SUMMARIZER.stats()}), 200
+
+# ========== READINESS ==========
+def warm_up():
+    #Nạp model embedding + encode thử 1 câu ở luồng nền: server nhận request ngay (luật từ khóa, LLM vẫn chạy),
+    #/ready báo 503 tới khi xong để launcher / load balancer biết lúc nào intent ngữ nghĩa không còn bị chậm.
+    try:
+        with startup_phase("emb_warmup"):
+            EMB_MODEL.encode(["hello"], normalize_embeddings=True)
+            INTENT_INDEXES.get()
+            #backend cấu hình lỗi → model chuyển sang torch; dựng lại embedding ví dụ ngay, trước request đầu tiên
+    except Exception as e:
+        print(f"[STARTUP] embedding warm-up failed: {e}")
+    STARTUP_TIMINGS["boot_to_ready"] = round((time.perf_counter() - BOOT_T0) * 1000.0, 1)
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    return jsonify({"ok": True, "pid": os.getpid()}), 200
+#Liveness: process còn phục vụ request (khác /ready: model đã nạp xong chưa)
+
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    ok = EMB_MODEL.loaded or not EMB_WARMUP
+    #tắt warm-up (EMB_WARMUP=0) → model nạp ở request đầu tiên, coi như sẵn sàng ngay
+    return jsonify({
+        "ready": ok,
+        "emb_model": EMB_MODEL_NAME,
+        "emb_backend": EMB_MODEL.backend,
+        "emb_model_loaded": EMB_MODEL.loaded,
+        "error": EMB_MODEL.error,
+        "startup_ms": STARTUP_TIMINGS,
+    }), 200 if ok else 503
+
+
+def start_background_threads():
+    if EMB_WARMUP:
+        threading.Thread(target=warm_up, name="emb-warmup", daemon=True).start()
+    if INTENT_RELOAD_INTERVAL > 0:
+        threading.Thread(target=INTENT_INDEXES.watch, name="intent-reload", daemon=True).start()
+
+
+# ========== PREFORK WORKERS (serve.py) ==========
+#serve.py nạp module này 1 lần trong process cha (CHATBOX_PREFORK=1 → không mở luồng nền lúc import), gọi preload()
+#rồi fork các worker: trang bộ nhớ của model + embedding intent được chia sẻ copy-on-write giữa các worker.
+#Luồng nền, event loop TTS, connection SQLite không sống sót qua fork → after_fork() tạo lại trong từng worker.
+#(PREFORK / MULTI_WORKER đọc ở đầu file: cấu hình TTS / audio cần biết trước)
+
+
+def preload():
+    torch.set_num_threads(1)
+    #process cha chỉ encode vài câu: không dựng pool luồng OpenMP trước khi fork
+    warm_up()
+    TTS_LOOP.shutdown()
+    #luồng event loop TTS của process cha không dùng tới (worker tạo loop riêng)
+
+
+def after_fork(torch_threads: int = 1):
+    global TTS_LOOP, TTS_QUEUE, SUMMARIZER, LLM
+    torch.set_num_threads(max(1, torch_threads))
+    #chia số core cho các worker thay vì mỗi worker dùng hết → không tranh CPU khi encode đồng thời
+    TTS_LOOP = TtsEventLoop(TTS_MAX_CONCURRENT)
+    TTS_QUEUE = TtsJobQueue(TTS_WORKERS, TTS_QUEUE_MAX)
+    SUMMARIZER = ConversationSummarizer(SUMMARY_QUEUE_MAX)
+    LLM = LlmClient(LLM_MAX_INFLIGHT, LLM_MAX_WAITING, LLM_QUEUE_TIMEOUT)
+    if isinstance(SESSION_STORE, SqliteSessionStore):
+        SESSION_STORE.local = threading.local()
+    #connection SQLite mở trong process cha không được dùng lại sau fork
+    start_background_threads()
+
+
+def on_worker_exit():
+    #serve.py gọi khi worker dừng êm (worker thoát bằng os._exit, atexit không chạy)
+    AUDIO_PERSIST_POOL.shutdown(wait=True)
+    #ghi nốt các clip đang chờ vào cache đĩa
+    TTS_LOOP.shutdown()
+
+
+STARTUP_TIMINGS["module_init"] = round((time.perf_counter() - BOOT_T0) * 1000.0, 1)
+if not (__name__ == "__main__" and not os.environ.get("WERKZEUG_RUN_MAIN")) and not PREFORK:
+    start_background_threads()
+#process cha của reloader (debug=True) chỉ theo dõi file, không phục vụ request → không cần nạp model;
+#serve.py gọi start_background_threads() trong từng worker sau khi fork
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
+#Chế độ async (1 event loop cho mọi hội thoại, không tốn 1 luồng / request): python chatbox_async.py
+#Production (nhiều worker, model nạp trước khi fork): python serve.py chatbox --workers 4
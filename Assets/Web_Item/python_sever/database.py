@@ -604,8 +604,32 @@ def update_progress():
     finally:
         cursor.close()
         conn.close()
+# ================================
+# ❤️ Health / readiness (cho serve.py, load balancer)
+# ================================
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    return jsonify({"ok": True})
+
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+        conn.close()
+        return jsonify({"ready": True})
+    except Exception as e:
+        return jsonify({"ready": False, "error": str(e)}), 503
+    # MySQL không kết nối được → 503 để load balancer không gửi request tới
+
+
 # ================================
 # 🚀 Chạy server
 # ================================
+# Production (nhiều worker, dừng êm): python Assets/serve.py database --workers 2
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5002, debug=True)
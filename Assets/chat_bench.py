@@ -0,0 +1,678 @@
+#Benchmark tải end-to-end cho /chat (hoặc /chat/stream), chạy hoàn toàn offline trên máy Linux chỉ có CPU:
+#  - LLM giả lập kiểu OpenAI (/v1/chat/completions, có stream) ngay trong process benchmark: độ trễ token đầu,
+#    tốc độ sinh token, số slot song song chỉnh được → đo phần việc của ChatBox chứ không đo LM Studio
+#  - Edge TTS giả lập (vá edge_tts.Communicate.stream trong process server): trễ cố định + theo độ dài câu
+#  - server thật (Flask đa luồng / chatbox_async / serve.py prefork) chạy ở process con, thư mục làm việc riêng
+#    (cache TTS, intent_index, sessions.db mới mỗi lần chạy) → các lần chạy so sánh được với nhau
+#  - phát lại tập câu người chơi (chat_bench_corpus.json: chào hỏi, nhiệm vụ, mua bán, lạc đề...) với N client đồng thời,
+#    mỗi client là 1 session (đổi session sau --turns-per-session lượt)
+#Báo cáo: p50/p95/p99 từng giai đoạn (đọc dòng [TIMING] của server → số chính xác, không phải cận bucket của /metrics),
+#độ trễ phía client, requests/s, CPU và RSS/PSS của cả cây process server. Kết quả ghi JSON; --baseline để so với lần trước.
+#Model embedding dùng bản thật, nạp từ cache HuggingFace (HF_HUB_OFFLINE=1) → cần tải model 1 lần trước đó.
+#Chạy:  python chat_bench.py --concurrency 16 --requests 500 --out bench.json
+#       python chat_bench.py --server serve --workers 4 --baseline bench.json --max-regression 0.10
+#       python chat_bench.py --env LLM_SINGLE_CALL=1 --llm-tokens-per-sec 30
+import os, sys, json, time, random, signal, socket, hashlib, argparse, platform, resource, tempfile, threading, subprocess
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_PATH = os.path.join(BASE_DIR, "chat_bench_corpus.json")
+SERVERS = ("flask", "async", "serve")
+TIMING_PREFIX = "[TIMING] "
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+REPLY_WORDS = ("the road north is quiet today but wolves still roam near the old mill so keep your blade close "
+               "and your lantern lit I can sell you bread herbs and a sturdy shield if you have the coin traveler").split()
+
+
+def percentile(values, pct: float) -> float:
+    #cùng cách tính với ChatBox.percentile (không import ChatBox: process benchmark không nạp torch)
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(pct / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+
+def summarize(values) -> dict:
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values), 2) if values else 0.0,
+        "p50_ms": round(percentile(values, 50), 2),
+        "p95_ms": round(percentile(values, 95), 2),
+        "p99_ms": round(percentile(values, 99), 2),
+        "max_ms": round(max(values), 2) if values else 0.0,
+    }
+
+
+# ========== STUB LLM (OpenAI-compatible) ==========
+class StubLlmHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    #giữ kết nối như LM Studio (ChatBox dùng pool kết nối); stream gửi chunked
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        messages = body.get("messages") or [{}]
+        system = messages[0].get("content") or ""
+        last = messages[-1].get("content") or ""
+        prompt_tokens = sum(len(m.get("content") or "") for m in messages) // 4
+        stub = self.server
+        if system.startswith("Classify the user's intent"):
+            pieces = ["other"]
+            #nhãn bất kỳ là đủ: benchmark đo đường đi của request, không đo độ chính xác
+        elif "running memory" in system:
+            pieces = stub.reply_pieces("The player talked about " + last[-80:], stub.reply_tokens // 2)
+        else:
+            pieces = stub.reply_pieces(last, stub.reply_tokens)
+            if "[HIDDEN INTENT TAG]" in system:
+                pieces.insert(0, "INTENT: other\n")
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(pieces),
+                 "total_tokens": prompt_tokens + len(pieces)}
+        with stub.slot():
+            stub.count(body.get("stream"))
+            time.sleep(stub.ttft)
+            if body.get("stream"):
+                self._stream(pieces, usage, stub.token_interval)
+            else:
+                time.sleep(stub.token_interval * len(pieces))
+                data = json.dumps({"choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)},
+                                                "finish_reason": "stop"}], "usage": usage}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+    def _chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _stream(self, pieces, usage: dict, interval: float):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for i, piece in enumerate(pieces):
+                if i:
+                    time.sleep(interval)
+                self._chunk(f"data: {json.dumps({'choices': [{'index': 0, 'delta': {'content': piece}}]})}\n\n".encode())
+            self._chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode())
+            self._chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            #ChatBox đóng stream khi request bị thay thế (supersede) → giống LM Studio: dừng sinh
+
+
+class StubLlmServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, ttft_ms: float, tokens_per_sec: float, reply_tokens: int, slots: int):
+        super().__init__(("127.0.0.1", port), StubLlmHandler)
+        self.ttft = ttft_ms / 1000.0
+        self.token_interval = 1.0 / tokens_per_sec if tokens_per_sec > 0 else 0.0
+        self.reply_tokens = max(1, reply_tokens)
+        self.slots = threading.BoundedSemaphore(slots) if slots > 0 else None
+        #LM Studio chỉ sinh song song vài request (parallel slots), phần còn lại xếp hàng
+        self.lock = threading.Lock()
+        self.requests = {"stream": 0, "blocking": 0}
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+        #ChatBox đóng kết nối giữ sẵn / stream bị thay thế giữa chừng: bình thường, không in traceback
+
+    def slot(self):
+        return self.slots if self.slots is not None else nullcontext()
+
+    def count(self, stream):
+        with self.lock:
+            self.requests["stream" if stream else "blocking"] += 1
+
+    def reply_pieces(self, seed_text: str, n: int):
+        rnd = random.Random(hashlib.md5(seed_text.encode("utf-8")).hexdigest())
+        words = [rnd.choice(REPLY_WORDS) for _ in range(n)]
+        words[0] = words[0].capitalize()
+        return [w + ("." if i == n - 1 else " ") for i, w in enumerate(words)]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="stub-llm", daemon=True).start()
+        return self
+
+
+# ========== STUB EDGE TTS + SERVER PROCESS ==========
+def install_tts_stub(latency_ms: float, ms_per_char: float, bytes_per_char: int):
+    #Thay phần gọi mạng của edge-tts: ChatBox vẫn chạy đủ đường TTS (event loop, cache, ghi file, /audio)
+    import asyncio, edge_tts
+    original_init = edge_tts.Communicate.__init__
+
+    def init(self, text, *args, **kwargs):
+        original_init(self, text, *args, **kwargs)
+        self._bench_text = text
+
+    async def stream(self):
+        text = self._bench_text.encode("utf-8")
+        await asyncio.sleep((latency_ms + ms_per_char * len(text)) / 1000.0)
+        frame = hashlib.md5(text).digest() * 64
+        remaining = max(1, len(text) * bytes_per_char)
+        while remaining > 0:
+            data = frame[:remaining]
+            remaining -= len(data)
+            yield {"type": "audio", "data": data}
+
+    edge_tts.Communicate.__init__ = init
+    edge_tts.Communicate.stream = stream
+
+
+def run_server(args):
+    #Process con: vá edge-tts rồi chạy server thật; các biến môi trường do process benchmark đặt sẵn
+    install_tts_stub(args.tts_latency_ms, args.tts_ms_per_char, args.tts_bytes_per_char)
+    sys.path.insert(0, BASE_DIR)
+    if args.server == "serve":
+        import serve
+        sys.argv = ["serve.py", "chatbox", "--host", "127.0.0.1", "--port", str(args.port), "--workers", str(args.workers)]
+        return serve.main()
+        #edge-tts đã vá trước khi fork → mọi worker đều dùng bản giả lập
+    if args.server == "async":
+        os.environ["ASYNC_HOST"], os.environ["ASYNC_PORT"] = "127.0.0.1", str(args.port)
+        from aiohttp import web
+        import chatbox_async
+        web.run_app(chatbox_async.make_app(), host="127.0.0.1", port=args.port, print=None)
+        return 0
+    from werkzeug.serving import make_server
+    import ChatBox
+    server = make_server("127.0.0.1", args.port, ChatBox.app, threaded=True)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown, daemon=True).start())
+    server.serve_forever()
+    return 0
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, workdir: str, llm_port: int):
+    env = dict(os.environ)
+    env.update({
+        "OLLAMA_URL": f"http://127.0.0.1:{llm_port}/v1/chat/completions",
+        "HF_HUB_OFFLINE": "1",
+        "TRANSFORMERS_OFFLINE": "1",
+        "LOG_TIMINGS": "1",
+        "PYTHONUNBUFFERED": "1",
+        "TTS_TMP_DIR": os.path.join(workdir, "tmp"),
+        "SESSION_DB_PATH": os.path.join(workdir, "sessions.db"),
+        "INTENT_INDEX_DIR": os.path.join(workdir, "intent_index"),
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    cmd = [sys.executable, os.path.abspath(__file__), "--serve-child", "--server", args.server,
+           "--port", str(args.port), "--workers", str(args.workers),
+           "--tts-latency-ms", str(args.tts_latency_ms), "--tts-ms-per-char", str(args.tts_ms_per_char),
+           "--tts-bytes-per-char", str(args.tts_bytes_per_char)]
+    log = open(os.path.join(workdir, "server.log"), "ab")
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    log.close()
+    return proc
+
+
+def wait_ready(proc, base_url: str, timeout: float) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with code {proc.returncode}")
+        try:
+            r = requests.get(base_url + "/ready", timeout=2)
+            if r.status_code == 200:
+                return r.json()
+        except requests.RequestException:
+            pass
+        time.sleep(0.25)
+    raise RuntimeError(f"server not ready after {timeout:.0f}s")
+
+
+def stop_server(proc, timeout: float = 30.0):
+    if proc.poll() is not None:
+        return
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+
+# ========== CPU / RSS CỦA CÂY PROCESS SERVER ==========
+def process_tree(root: int):
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "r") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    pids, stack = [], [root]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack.extend(children.get(pid, ()))
+    return pids
+
+
+def read_proc(pid: int):
+    #(giây CPU user+system, RSS byte, PSS byte) của 1 process; PSS chia đều trang dùng chung giữa các worker đã fork
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm", "r") as f:
+            rss = int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+    pss = None
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    pss = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK, rss, pss
+
+
+class ProcSampler:
+    def __init__(self, root: int, interval: float):
+        self.root = root
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.cpu = {}
+        #pid → giây CPU lần đọc gần nhất (giữ lại cả worker đã thoát)
+        self.rss_peak = self.pss_peak = 0
+        self.rss_last = self.pss_last = 0
+        self.processes = 0
+        self.thread = threading.Thread(target=self._run, name="proc-sampler", daemon=True)
+
+    def sample(self):
+        rss_total, pss_total, pss_known, alive = 0, 0, True, 0
+        for pid in process_tree(self.root):
+            info = read_proc(pid)
+            if info is None:
+                continue
+            cpu, rss, pss = info
+            alive += 1
+            rss_total += rss
+            if pss is None:
+                pss_known = False
+            else:
+                pss_total += pss
+            with self.lock:
+                self.cpu[pid] = cpu
+        with self.lock:
+            self.rss_last, self.pss_last = rss_total, (pss_total if pss_known else None)
+            self.rss_peak = max(self.rss_peak, rss_total)
+            if pss_known:
+                self.pss_peak = max(self.pss_peak, pss_total)
+            self.processes = alive
+
+    def cpu_seconds(self) -> float:
+        with self.lock:
+            return sum(self.cpu.values())
+
+    def reset_peak(self):
+        with self.lock:
+            self.rss_peak, self.pss_peak = self.rss_last, (self.pss_last or 0)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+
+
+# ========== TẢI ==========
+def load_corpus(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        items = json.load(f)["utterances"]
+    return [u for u in items if (u.get("text") or "").strip()]
+
+
+class LoadRunner:
+    def __init__(self, args, base_url: str, corpus):
+        self.args = args
+        self.url = base_url + ("/chat/stream" if args.route == "stream" else "/chat")
+        self.corpus = list(corpus)
+        random.Random(args.seed).shuffle(self.corpus)
+        #thứ tự cố định theo --seed → 2 lần chạy gửi cùng chuỗi câu
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.run_id = hashlib.md5(f"{time.time()}".encode()).hexdigest()[:8]
+
+    def _take(self, limit, deadline):
+        with self.lock:
+            if (limit is not None and self.issued >= limit) or (deadline is not None and time.monotonic() >= deadline):
+                return None
+            self.issued += 1
+            index = self.next_index
+            self.next_index += 1
+        return self.corpus[index % len(self.corpus)]
+
+    def _post(self, http, body: dict) -> dict:
+        start = time.perf_counter()
+        result = {"ok": False}
+        try:
+            if self.args.route == "stream":
+                with http.post(self.url, json=body, stream=True, timeout=self.args.request_timeout) as r:
+                    result["status"] = r.status_code
+                    event = None
+                    for line in r.iter_lines(decode_unicode=True):
+                        if line.startswith("event:"):
+                            event = line[6:].strip()
+                        elif line.startswith("data:") and event == "token" and "ttft_ms" not in result:
+                            result["ttft_ms"] = (time.perf_counter() - start) * 1000.0
+                        elif line.startswith("data:") and event == "done":
+                            done = json.loads(line[5:])
+                            result.update(ok=r.status_code == 200, intent=done.get("intent"))
+                            break
+            else:
+                r = http.post(self.url, json=body, timeout=self.args.request_timeout)
+                result["status"] = r.status_code
+                if r.status_code == 200:
+                    j = r.json()
+                    result.update(ok=True, intent=j.get("intent"),
+                                  fast_path=bool((j.get("prompt") or {}).get("fast_path")))
+        except (requests.RequestException, ValueError) as e:
+            result["error"] = type(e).__name__
+        result["latency_ms"] = (time.perf_counter() - start) * 1000.0
+        return result
+
+    def _client(self, index: int, limit, deadline, results: list):
+        http = requests.Session()
+        turns, session = 0, 0
+        while True:
+            utterance = self._take(limit, deadline)
+            if utterance is None:
+                break
+            if turns >= self.args.turns_per_session:
+                turns, session = 0, session + 1
+            #người chơi mới (session mới) sau vài lượt → lịch sử / tóm tắt không phình mãi
+            body = {"text": utterance["text"], "session_id": f"bench-{self.run_id}-{index}-{session}"}
+            for key in ("npc_id", "quest_context", "npc_context"):
+                if utterance.get(key):
+                    body[key] = utterance[key]
+            result = self._post(http, body)
+            result["kind"] = utterance.get("kind", "other")
+            turns += 1
+            with self.lock:
+                results.append(result)
+            if self.args.think_ms > 0:
+                time.sleep(self.args.think_ms / 1000.0)
+        http.close()
+
+    def run(self, requests_limit=None, duration=None) -> dict:
+        self.issued = 0
+        deadline = time.monotonic() + duration if duration else None
+        results = []
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self._client, args=(i, requests_limit, deadline, results), daemon=True)
+                   for i in range(self.args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return {"elapsed_s": time.perf_counter() - start, "results": results}
+
+
+def client_report(phase: dict) -> dict:
+    results, elapsed = phase["results"], phase["elapsed_s"]
+    ok = [r for r in results if r["ok"]]
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            key = r.get("error") or f"http_{r.get('status')}"
+            errors[key] = errors.get(key, 0) + 1
+    by_kind, intents = {}, {}
+    for r in ok:
+        by_kind.setdefault(r["kind"], []).append(r["latency_ms"])
+        intents[r.get("intent") or "none"] = intents.get(r.get("intent") or "none", 0) + 1
+    report = {
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_sec": round(len(ok) / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency": summarize([r["latency_ms"] for r in ok]),
+        "latency_by_kind": {k: summarize(v) for k, v in sorted(by_kind.items())},
+        "intents": dict(sorted(intents.items())),
+        "fast_path": sum(1 for r in ok if r.get("fast_path")),
+    }
+    ttft = [r["ttft_ms"] for r in ok if "ttft_ms" in r]
+    if ttft:
+        report["time_to_first_token"] = summarize(ttft)
+    return report
+
+
+def stage_report(log_path: str, offset: int) -> dict:
+    #Dòng [TIMING] {"route": ..., "ms": {stage: ms, ..., "total": ms}} của từng request trong pha đo
+    stages, skipped = {}, 0
+    with open(log_path, "rb") as f:
+        f.seek(offset)
+        for raw in f:
+            line = raw.decode("utf-8", "replace").strip()
+            if not line.startswith(TIMING_PREFIX):
+                continue
+            try:
+                entry = json.loads(line[len(TIMING_PREFIX):])
+                route, ms = entry["route"], entry["ms"]
+            except (ValueError, KeyError, TypeError):
+                skipped += 1
+                #nhiều worker cùng ghi 1 file log → hiếm khi 2 dòng dính nhau
+                continue
+            for stage, value in ms.items():
+                stages.setdefault(route, {}).setdefault(stage, []).append(float(value))
+    report = {route: {stage: summarize(v) for stage, v in sorted(s.items())} for route, s in sorted(stages.items())}
+    return {"routes": report, "unparsed_lines": skipped}
+
+
+# ========== SO SÁNH VỚI LẦN CHẠY TRƯỚC ==========
+GATED_METRICS = {"client_p50_ms", "client_p95_ms", "requests_per_sec"}
+#chỉ các số tổng thể mới làm benchmark thất bại; p99 và từng giai đoạn dao động nhiều ở mẫu nhỏ → chỉ in ra
+
+
+def compare(baseline: dict, current: dict, max_regression):
+    #Độ trễ tăng / throughput giảm quá max_regression (tỉ lệ, vd. 0.10 = 10%) → hồi quy
+    rows = [("client_p50_ms", baseline["client"]["latency"]["p50_ms"], current["client"]["latency"]["p50_ms"], True),
+            ("client_p95_ms", baseline["client"]["latency"]["p95_ms"], current["client"]["latency"]["p95_ms"], True),
+            ("client_p99_ms", baseline["client"]["latency"]["p99_ms"], current["client"]["latency"]["p99_ms"], True),
+            ("requests_per_sec", baseline["client"]["requests_per_sec"], current["client"]["requests_per_sec"], False),
+            ("server_cpu_s", baseline["process"]["cpu_s"], current["process"]["cpu_s"], True),
+            ("server_rss_peak_mb", baseline["process"]["rss_peak_mb"], current["process"]["rss_peak_mb"], True)]
+    base_routes, cur_routes = baseline["stages"]["routes"], current["stages"]["routes"]
+    for route in sorted(set(base_routes) & set(cur_routes)):
+        for stage in sorted(set(base_routes[route]) & set(cur_routes[route])):
+            rows.append((f"{route}.{stage}_p95_ms", base_routes[route][stage]["p95_ms"],
+                         cur_routes[route][stage]["p95_ms"], True))
+    out, regressions = {}, []
+    for name, old, new, lower_is_better in rows:
+        change = (new - old) / old if old else 0.0
+        out[name] = {"baseline": old, "current": new, "change": round(change, 4)}
+        worse = change > 0 if lower_is_better else change < 0
+        if max_regression is not None and worse and abs(change) > max_regression and name in GATED_METRICS:
+            regressions.append(name)
+        print(f"[BENCH] {name:<40} {old:>10.2f} -> {new:>10.2f}  ({change * 100:+.1f}%)")
+    return {"baseline_created": baseline.get("created"), "metrics": out, "regressions": regressions}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end load benchmark for the ChatBox /chat pipeline")
+    parser.add_argument("--server", choices=SERVERS, default="flask")
+    parser.add_argument("--workers", type=int, default=2, help="worker processes for --server serve")
+    parser.add_argument("--route", choices=("chat", "stream"), default="chat")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="measured requests (ignored with --duration)")
+    parser.add_argument("--duration", type=float, default=None, help="measure for this many seconds instead")
+    parser.add_argument("--warmup", type=int, default=None, help="unmeasured requests first (default: 2 x concurrency)")
+    parser.add_argument("--turns-per-session", type=int, default=8)
+    parser.add_argument("--think-ms", type=float, default=0.0, help="pause between a client's requests")
+    parser.add_argument("--request-timeout", type=float, default=120.0)
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--llm-ttft-ms", type=float, default=150.0, help="stub LLM delay before the first token")
+    parser.add_argument("--llm-tokens-per-sec", type=float, default=60.0)
+    parser.add_argument("--llm-reply-tokens", type=int, default=40)
+    parser.add_argument("--llm-slots", type=int, default=4, help="requests the stub LLM generates in parallel (0 = unlimited)")
+    parser.add_argument("--tts-latency-ms", type=float, default=120.0)
+    parser.add_argument("--tts-ms-per-char", type=float, default=1.0)
+    parser.add_argument("--tts-bytes-per-char", type=int, default=400, help="~48 kbps MP3 at normal speaking speed")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra server environment")
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--sample-interval", type=float, default=0.25)
+    parser.add_argument("--workdir", default=None, help="server working directory (default: fresh temp dir)")
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--baseline", default=None, help="earlier result JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=None,
+                        help="fail (exit 1) if latency p50/p95 or requests/s get worse than this fraction vs --baseline")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--serve-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_child:
+        return run_server(args)
+    bad_env = [e for e in args.env if "=" not in e]
+    if bad_env:
+        parser.error(f"--env expects KEY=VALUE: {', '.join(bad_env)}")
+    if not sys.platform.startswith("linux"):
+        parser.error("CPU / RSS sampling reads /proc: Linux only")
+    args.concurrency = max(1, args.concurrency)
+    args.warmup = args.concurrency * 2 if args.warmup is None else max(0, args.warmup)
+    args.port = args.port or free_port()
+    corpus = load_corpus(args.corpus)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="chat_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    log_path = os.path.join(workdir, "server.log")
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    llm = StubLlmServer(free_port(), args.llm_ttft_ms, args.llm_tokens_per_sec, args.llm_reply_tokens, args.llm_slots).start()
+    print(f"[BENCH] stub LLM on :{llm.server_address[1]}, starting {args.server} server on :{args.port} (workdir {workdir})")
+    proc = start_server(args, workdir, llm.server_address[1])
+    sampler = None
+    try:
+        t0 = time.perf_counter()
+        try:
+            ready = wait_ready(proc, base_url, args.startup_timeout)
+        except RuntimeError as e:
+            print(f"[BENCH ERROR] {e}; last server log lines:")
+            with open(log_path, "r", encoding="utf-8", errors="replace") as f:
+                print("".join(f.readlines()[-30:]))
+            return 2
+        startup_s = time.perf_counter() - t0
+        sampler = ProcSampler(proc.pid, args.sample_interval).start()
+        runner = LoadRunner(args, base_url, corpus)
+
+        if args.warmup:
+            print(f"[BENCH] warm-up: {args.warmup} requests")
+            runner.run(requests_limit=args.warmup)
+        time.sleep(0.2)
+        #để các dòng [TIMING] của pha khởi động ghi xong trước khi đánh dấu vị trí log
+        offset = os.path.getsize(log_path)
+        sampler.sample()
+        sampler.reset_peak()
+        cpu_start = sampler.cpu_seconds()
+        usage_start = resource.getrusage(resource.RUSAGE_SELF)
+        llm_start = dict(llm.requests)
+        print(f"[BENCH] measuring: {f'{args.duration:.0f}s' if args.duration else f'{args.requests} requests'}"
+              f" at concurrency {args.concurrency}")
+        phase = runner.run(requests_limit=None if args.duration else args.requests, duration=args.duration)
+        sampler.sample()
+        cpu_s = sampler.cpu_seconds() - cpu_start
+        usage_end = resource.getrusage(resource.RUSAGE_SELF)
+        try:
+            server_metrics = requests.get(base_url + "/metrics", params={"format": "json"}, timeout=10).json()
+            server_metrics.pop("stages", None)
+            #giai đoạn đã tính chính xác từ log; giữ bộ đếm (fallback, nguồn intent, cache hit...) để đối chiếu
+        except (requests.RequestException, ValueError):
+            server_metrics = None
+        time.sleep(0.2)
+        stages = stage_report(log_path, offset)
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        stop_server(proc)
+        llm.shutdown()
+
+    elapsed = phase["elapsed_s"]
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": git_commit(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpu_count": os.cpu_count()},
+        "config": {k: v for k, v in vars(args).items() if k not in ("serve_child", "out", "baseline", "workdir", "port")},
+        "corpus": {"path": args.corpus, "utterances": len(corpus)},
+        "server": {"startup_s": round(startup_s, 2), "ready": ready},
+        "client": client_report(phase),
+        "stages": stages,
+        "process": {
+            "processes": sampler.processes,
+            "cpu_s": round(cpu_s, 3),
+            "cpu_percent": round(cpu_s / elapsed * 100.0, 1) if elapsed > 0 else 0.0,
+            #100% = 1 core bận suốt pha đo
+            "rss_peak_mb": round(sampler.rss_peak / 1048576.0, 1),
+            "rss_end_mb": round(sampler.rss_last / 1048576.0, 1),
+            "pss_peak_mb": round(sampler.pss_peak / 1048576.0, 1) if sampler.pss_last is not None else None,
+            "load_generator_cpu_s": round((usage_end.ru_utime + usage_end.ru_stime)
+                                          - (usage_start.ru_utime + usage_start.ru_stime), 3),
+            #CPU của chính benchmark (client + LLM giả lập): cao gần bằng số core → kết quả bị giới hạn bởi máy đo
+        },
+        "stub_llm_requests": {k: llm.requests[k] - llm_start[k] for k in llm.requests},
+        "server_metrics": server_metrics,
+    }
+    status = 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["comparison"] = compare(json.load(f), report, args.max_regression)
+        if report["comparison"]["regressions"]:
+            print(f"[BENCH] REGRESSION: {', '.join(report['comparison']['regressions'])}")
+            status = 1
+    print(json.dumps({k: report[k] for k in ("client", "process")}, indent=2))
+    for route, route_stages in report["stages"]["routes"].items():
+        for stage, s in route_stages.items():
+            print(f"[BENCH] {route}.{stage:<28} n={s['count']:<6} p50={s['p50_ms']:>9.2f}  "
+                  f"p95={s['p95_ms']:>9.2f}  p99={s['p99_ms']:>9.2f} ms")
+    out = args.out or f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"[BENCH] saved {out}")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,447 @@
+#Chế độ phục vụ bất đồng bộ cho ChatBox: /chat, /reset, /audio/<name> chạy như coroutine trên 1 event loop (aiohttp.web).
+#Request đang chờ LM Studio / Edge TTS chỉ là 1 coroutine treo ở await → 1 process giữ được hàng trăm hội thoại
+#đang chờ thay vì mỗi hội thoại chiếm 1 luồng như Flask. Việc nặng CPU / chặn (embedding, SQLite, dựng prompt)
+#chạy trong 1 ThreadPoolExecutor nhỏ, số luồng cố định (ASYNC_EXECUTOR_WORKERS).
+#Request / response giống hệt server Flask; toàn bộ logic (intent, persona, session, prompt, cache TTS) dùng lại từ ChatBox.
+#Chạy:  python chatbox_async.py   (ASYNC_HOST / ASYNC_PORT, mặc định 0.0.0.0:5000)
+import os, time, ssl, random, asyncio, contextvars, functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import aiohttp
+from aiohttp import web
+import ChatBox
+from ChatBox import (METRICS, LlmQueue, LlmBusyError, LlmSupersededError, SUPERSEDED_RESPONSE, BUSY_REPLY,
+                     LLM_DEFAULT_PRIORITY, LLM_CLASSIFY_PRIORITY, OLLAMA_URL, TMP_DIR, TTS_CACHE, TTS_QUEUE, SESSION_STORE)
+
+ASYNC_HOST = os.environ.get("ASYNC_HOST", "0.0.0.0")
+ASYNC_PORT = int(os.environ.get("ASYNC_PORT", "5000"))
+ASYNC_EXECUTOR_WORKERS = int(os.environ.get("ASYNC_EXECUTOR_WORKERS", "8"))
+AUDIO_POLL_INTERVAL = 0.05
+
+EXECUTOR = ThreadPoolExecutor(max_workers=max(1, ASYNC_EXECUTOR_WORKERS), thread_name_prefix="async-exec")
+
+
+async def run_blocking(fn, *args):
+    #Chạy hàm chặn trong executor, mang theo contextvars → METRICS.stage bên trong vẫn ghi vào đúng request
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(EXECUTOR, functools.partial(ctx.run, fn, *args))
+
+
+async def read_json(request) -> dict:
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+    #giống request.get_json(silent=True) của Flask: body hỏng → {}
+
+
+def url_root(request) -> str:
+    return f"{request.scheme}://{request.host}/"
+
+
+def timed_request(route: str):
+    #Bản async của ChatBox.timed_request (bản gốc trả về ngay khi gọi coroutine, không đo được thời gian await)
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(request):
+            timing = METRICS.begin(route)
+            try:
+                return await fn(request)
+            finally:
+                METRICS.end(timing)
+        return wrapper
+    return decorator
+
+
+# ========== ASYNC LLM CLIENT ==========
+class AsyncLlmClient:
+    #Cùng luật hàng đợi với ChatBox.LlmClient (dùng chung ChatBox.LlmQueue: giới hạn chỗ, ưu tiên + già hóa,
+    #câu mới thay thế câu cũ cùng session) nhưng chờ bằng asyncio.Condition và gửi bằng aiohttp
+    #→ request đang xếp hàng / đang sinh không giữ luồng nào.
+    #Luồng tóm tắt hội thoại (ChatBox.SUMMARIZER) cũng gửi qua client này (xem on_startup) → chung 1 giới hạn.
+    def __init__(self, max_inflight: int, max_waiting: int, queue_timeout: float):
+        self.queue = LlmQueue(max_inflight, max_waiting, queue_timeout)
+        self.max_inflight = self.queue.max_inflight
+        self.http = None
+        self.cond = None
+
+    async def start(self):
+        #Tạo trong event loop của server (Condition / ClientSession gắn với loop đang chạy)
+        self.cond = asyncio.Condition()
+        self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_inflight * 2))
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+
+    @asynccontextmanager
+    async def slot(self, timeout: float = None, session_id=None, priority: int = LLM_DEFAULT_PRIORITY,
+                   request: int = None):
+        deadline = time.monotonic() + self.queue.timeout_for(timeout)
+        async with self.cond:
+            try:
+                ticket = self.queue.admit(session_id, priority, request)
+            finally:
+                self.cond.notify_all()
+            admitted = False
+            try:
+                while not self.queue.ready(ticket, deadline):
+                    try:
+                        await asyncio.wait_for(self.cond.wait(), deadline - time.monotonic())
+                    except asyncio.TimeoutError:
+                        pass
+                admitted = True
+            finally:
+                self.queue.leave(ticket, admitted)
+                self.cond.notify_all()
+        try:
+            yield ticket
+        finally:
+            async with self.cond:
+                self.queue.finish(ticket)
+                self.cond.notify_all()
+
+    async def begin_request(self, session_id) -> int:
+        async with self.cond:
+            try:
+                return self.queue.begin_request(session_id)
+            finally:
+                self.cond.notify_all()
+
+    async def post(self, payload: dict, timeout: float, session_id=None, priority: int = LLM_DEFAULT_PRIORITY,
+                   request: int = None):
+        async with self.slot(timeout, session_id, priority, request) as ticket:
+            async with self.http.post(OLLAMA_URL, json=payload, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                j = await resp.json(content_type=None)
+            if ticket.superseded:
+                raise LlmSupersededError("superseded while generating")
+            return j
+
+    @asynccontextmanager
+    async def stream(self, payload: dict, timeout: float, session_id=None, priority: int = LLM_DEFAULT_PRIORITY,
+                     request: int = None):
+        #timeout áp cho kết nối và từng lần đọc (như timeout của requests), không giới hạn tổng thời gian sinh
+        async with self.slot(timeout, session_id, priority, request) as ticket:
+            client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+            async with self.http.post(OLLAMA_URL, json={**payload, "stream": True}, timeout=client_timeout) as resp:
+                yield resp, ticket
+
+    def stats(self):
+        return self.queue.stats()
+
+LLM = AsyncLlmClient(ChatBox.LLM_MAX_INFLIGHT, ChatBox.LLM_MAX_WAITING, ChatBox.LLM_QUEUE_TIMEOUT)
+
+
+async def classify_intent_llama(text: str, session_id=None, request: int = None, valid_intents=None) -> str:
+    try:
+        with METRICS.stage("llm_classify"):
+            j = await LLM.post(ChatBox.classify_payload(text, valid_intents), timeout=15, session_id=session_id,
+                               priority=LLM_CLASSIFY_PRIORITY, request=request)
+        return ChatBox.classify_label(j, valid_intents)
+    except LlmSupersededError:
+        raise
+    except Exception:
+        METRICS.inc("errors_total", "llm_classify")
+        METRICS.inc("fallbacks_total", "classify_other")
+        return "other"
+
+
+async def stream_llm_tokens(payload: dict, session_id=None, priority: int = LLM_DEFAULT_PRIORITY, usage: dict = None,
+                            request: int = None):
+    start = time.perf_counter()
+    first = True
+    try:
+        async with LLM.stream(payload, 60, session_id, priority, request) as (resp, ticket):
+            resp.raise_for_status()
+            async for raw in resp.content:
+                if ticket.superseded:
+                    raise LlmSupersededError("superseded while generating")
+                piece = ChatBox.parse_stream_line(raw.decode("utf-8", "replace").strip(), usage)
+                if piece is None:
+                    break
+                if piece:
+                    if first:
+                        METRICS.observe("llm_first_token", (time.perf_counter() - start) * 1000.0)
+                        first = False
+                    yield piece
+    finally:
+        METRICS.observe("llm_generate", (time.perf_counter() - start) * 1000.0)
+
+
+# ========== ASYNC TTS ==========
+class AsyncTts:
+    #Gọi edge-tts ngay trên event loop của server (connector dùng chung, tối đa TTS_MAX_CONCURRENT lần cùng lúc).
+    #Nhiều request cần cùng 1 câu thoại chưa có trong cache → chỉ tổng hợp 1 lần, các request khác await chung.
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max(1, max_concurrent)
+        self.connector = None
+        self.sem = None
+        self.pending = {}
+        #tên file → Task đang tổng hợp
+
+    async def start(self):
+        sslcontext = ssl.create_default_context()
+        sslcontext.check_hostname = False
+        sslcontext.verify_mode = ssl.CERT_NONE
+        self.connector = ChatBox.SharedTCPConnector(ssl=sslcontext, limit=self.max_concurrent * 2, ttl_dns_cache=300)
+        self.sem = asyncio.Semaphore(self.max_concurrent)
+
+    async def close(self):
+        if self.connector is not None:
+            self.connector._shutting_down = True
+            await self.connector.close()
+
+    async def _synth(self, text: str, fname: str):
+        try:
+            with METRICS.stage("tts_synth"):
+                async with self.sem:
+                    data = await asyncio.wait_for(ChatBox.synth_to_bytes_async(text, connector=self.connector),
+                                                  ChatBox.TTS_TIMEOUT)
+                if ChatBox.AUDIO_FORMAT != "mp3":
+                    data = await run_blocking(ChatBox.encode_audio, data)
+            await run_blocking(ChatBox.store_audio, fname, data)
+        except Exception as e:
+            print(f"[TTS ERROR] {e}")
+            METRICS.inc("errors_total", "tts")
+
+    async def tts_file(self, text: str):
+        fname = ChatBox.audio_name_for(text)
+        out_path = os.path.join(TMP_DIR, fname)
+        if ChatBox.VOICE_BANK.lookup(fname):
+            return ChatBox.VOICE_BANK.path(fname), fname
+        if fname in ChatBox.AUDIO_RING or await run_blocking(TTS_CACHE.lookup, fname):
+            return out_path, fname
+        #lookup stat file trên đĩa (và nhận clip của worker khác ở chế độ shared) → không chạy trên event loop
+        task = self.pending.get(fname)
+        if task is None:
+            task = asyncio.ensure_future(self._synth(text, fname))
+            self.pending[fname] = task
+            task.add_done_callback(lambda _: self.pending.pop(fname, None))
+        await asyncio.shield(task)
+        #shield: 1 request bị hủy không hủy luôn bản tổng hợp mà request khác đang chờ
+        return out_path, fname
+
+TTS = AsyncTts(ChatBox.TTS_MAX_CONCURRENT)
+
+
+async def audio_url_for(root: str, text: str, async_audio: bool = False):
+    if async_audio:
+        return ChatBox.audio_url_for(root, text, True)
+    #chế độ async_audio chỉ đẩy job vào TTS_QUEUE, không chặn
+    try:
+        _, audio_name = await TTS.tts_file(text)
+        return root.rstrip("/") + f"/audio/{audio_name}"
+    except Exception:
+        return None
+
+
+# ========== ROUTES ==========
+@timed_request("chat")
+async def chat(request):
+    data = await read_json(request)
+    try:
+        turn = await run_blocking(ChatBox.begin_chat_turn, data)
+        if turn is not None:
+            turn["request"] = await LLM.begin_request(turn["session_id"])
+        if turn is not None and turn["intent"] is None and not turn["single_call"]:
+            turn["intent"] = await classify_intent_llama(turn["user_input"], turn["session_id"], turn["request"],
+                                                         turn["valid_intents"])
+    except LlmSupersededError:
+        return web.json_response(SUPERSEDED_RESPONSE)
+    if turn is None:
+        return web.json_response({"reply": "I didn’t hear anything...", "audio_url": None, "intent": "other"})
+    turn = await run_blocking(ChatBox.build_chat_turn, turn, data)
+    intent = turn["intent"]
+    payload = turn["payload"]
+    usage = {}
+    try:
+        if ChatBox.DEBUG_LOG:
+            print(f"[DEBUG] Sending to LM Studio: {OLLAMA_URL}")
+            if random.random() < ChatBox.DEBUG_PAYLOAD_SAMPLE:
+                print(f"[DEBUG] Payload: {payload}")
+        if turn["canned"] is not None:
+            reply = turn["canned"]
+        else:
+            reply = "".join([piece async for piece in stream_llm_tokens(payload, turn["session_id"], turn["priority"], usage, turn["request"])]).strip()
+        if turn["deferred_intent"]:
+            intent, reply = ChatBox.parse_intent_reply(reply, turn["valid_intents"])
+            METRICS.inc("intent_source_total", "single_call")
+            if ChatBox.DEBUG_LOG:
+                print(f"[INTENT] single-call -> {intent}")
+
+        if not reply:
+            reply = "(no reply from model)"
+            METRICS.inc("fallbacks_total", "empty_reply")
+    except LlmSupersededError:
+        if ChatBox.DEBUG_LOG:
+            print(f"[LLM] session '{turn['session_id']}' superseded, dropping reply")
+        METRICS.inc("fallbacks_total", "superseded")
+        return web.json_response(SUPERSEDED_RESPONSE)
+    except LlmBusyError as e:
+        reply = BUSY_REPLY
+        METRICS.inc("fallbacks_total", "llm_busy")
+        if ChatBox.DEBUG_LOG:
+            print(f"[LLM] {e}, degraded reply")
+    except Exception as e:
+        reply = f"LM Studio not reachable: {e}"
+        METRICS.inc("errors_total", "llm_generate")
+        METRICS.inc("fallbacks_total", "llm_unreachable")
+    if intent is None:
+        intent = "other"
+    METRICS.tag("intent", intent)
+
+    await run_blocking(ChatBox.finish_chat_turn, turn, intent, reply)
+    async_audio = bool(data.get("async_audio", ChatBox.TTS_ASYNC))
+    with METRICS.stage("tts"):
+        audio_url = await audio_url_for(url_root(request), reply, async_audio)
+    action, params = ChatBox.map_intent_to_action(intent, turn["npc_id"])
+    resp = {
+        "reply": reply,
+        "audio_url": audio_url,
+        "intent": intent,
+        "action": action,
+        "params": params,
+        "prompt": ChatBox.prompt_report(turn, usage),
+    }
+    if audio_url and not async_audio and data.get("inline_audio", ChatBox.AUDIO_INLINE):
+        resp.update(await run_blocking(ChatBox.inline_audio, reply))
+    return web.json_response(resp)
+
+
+async def reset(request):
+    data = await read_json(request)
+    session_id = (data.get("session_id") or "default").strip()
+    await run_blocking(SESSION_STORE.delete, session_id)
+    return web.json_response({"ok": True})
+
+
+async def serve_audio(request):
+    name = request.match_info["name"]
+    if name != os.path.basename(name) or name.startswith("."):
+        raise web.HTTPNotFound(text=f"Audio file {name} not found")
+    job = TTS_QUEUE.get(name)
+    if job is not None and not job.done.is_set():
+        try:
+            wait = float(request.query.get("wait", 0.0))
+        except ValueError:
+            wait = 0.0
+        deadline = time.monotonic() + min(max(wait, 0.0), ChatBox.TTS_MAX_WAIT)
+        while not job.done.is_set() and time.monotonic() < deadline:
+            await asyncio.sleep(AUDIO_POLL_INTERVAL)
+        #job chạy ở luồng worker của TTS_QUEUE → hỏi định kỳ thay vì chặn event loop bằng Event.wait
+        if not job.done.is_set():
+            return web.json_response({"status": job.status, "name": name}, status=202,
+                                     headers={"Retry-After": "1", "Cache-Control": "no-store"})
+    if job is not None and job.status == "failed":
+        raise web.HTTPNotFound(text=f"Audio file {name} failed to synthesize")
+    if ChatBox.AUDIO_MEMORY and ChatBox.is_audio_name(name):
+        data = ChatBox.AUDIO_RING.get(name)
+        if data is None:
+            data = await run_blocking(ChatBox.read_audio, name)
+        if data is None:
+            raise web.HTTPNotFound(text=f"Audio file {name} not found")
+        return memory_audio_response(request, name, data)
+    path = ChatBox.audio_path(name)
+    if not os.path.isfile(path):
+        raise web.HTTPNotFound(text=f"Audio file {name} not found")
+    if ChatBox.is_audio_name(name):
+        #File đặt tên theo hash nội dung → cache lâu dài; FileResponse tự trả ETag + 304 / 206 (Range)
+        return web.FileResponse(path, headers={"Content-Type": ChatBox.audio_mimetype(name),
+                                               "Cache-Control": "public, max-age=31536000, immutable"})
+    return web.FileResponse(path, headers={"Content-Type": "audio/mpeg",
+                                           "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0",
+                                           "Pragma": "no-cache"})
+
+
+def memory_audio_response(request, name: str, data: bytes):
+    #Clip trong RAM: tự xử lý If-None-Match và Range (1 khoảng byte) như FileResponse làm với file trên đĩa
+    etag = f'"{ChatBox.audio_etag(name)}"'
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.headers.get("If-None-Match") == etag:
+        return web.Response(status=304, headers=headers)
+    try:
+        rng = request.http_range
+    except ValueError:
+        rng = slice(None)
+    if rng.start is None and rng.stop is None:
+        return web.Response(body=data, content_type=ChatBox.audio_mimetype(name), headers=headers)
+    span = range(len(data))[rng]
+    if not span:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{len(data)}"})
+    headers["Content-Range"] = f"bytes {span.start}-{span.stop - 1}/{len(data)}"
+    return web.Response(status=206, body=data[span.start:span.stop], content_type=ChatBox.audio_mimetype(name),
+                        headers=headers)
+
+
+async def ready(request):
+    ok = ChatBox.EMB_MODEL.loaded or not ChatBox.EMB_WARMUP
+    return web.json_response({
+        "ready": ok,
+        "mode": "async",
+        "emb_model": ChatBox.EMB_MODEL_NAME,
+        "emb_backend": ChatBox.EMB_MODEL.backend,
+        "emb_model_loaded": ChatBox.EMB_MODEL.loaded,
+        "error": ChatBox.EMB_MODEL.error,
+        "startup_ms": ChatBox.STARTUP_TIMINGS,
+    }, status=200 if ok else 503)
+
+
+async def llm_stats(request):
+    return web.json_response(LLM.stats())
+
+
+async def metrics(request):
+    llm = LLM.stats()
+    gauges = [
+        ("llm_inflight", llm["inflight"]),
+        ("llm_waiting", llm["waiting"]),
+        ("llm_rejected_total", llm["rejected"]),
+        ("llm_timed_out_total", llm["timed_out"]),
+        ("llm_superseded_total", llm["superseded"]),
+        ("tts_pending", len(TTS.pending)),
+        ("async_tasks", len(asyncio.all_tasks())),
+    ]
+    if request.query.get("format") == "json":
+        return web.json_response({**METRICS.snapshot(), "gauges": dict(gauges)})
+    return web.Response(text=METRICS.prometheus(gauges), content_type="text/plain")
+
+
+async def on_startup(app):
+    await LLM.start()
+    await TTS.start()
+    loop = asyncio.get_running_loop()
+
+    def post_summary(payload: dict) -> dict:
+        #chạy ở luồng summarizer: gửi coroutine sang event loop và chờ kết quả
+        return asyncio.run_coroutine_threadsafe(
+            LLM.post(payload, timeout=60, priority=ChatBox.SUMMARY_PRIORITY), loop).result()
+
+    ChatBox.SUMMARIZER.llm_post = post_summary
+    #nếu không, tóm tắt đi qua ChatBox.LLM với giới hạn riêng → tổng cộng có thể gửi 2×LLM_MAX_INFLIGHT tới LM Studio
+
+
+async def on_cleanup(app):
+    ChatBox.SUMMARIZER.llm_post = ChatBox.SUMMARIZER.post_sync
+    await LLM.close()
+    await TTS.close()
+    EXECUTOR.shutdown(wait=False)
+
+
+def make_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post("/chat", chat)
+    app.router.add_post("/reset", reset)
+    app.router.add_get("/audio/{name}", serve_audio)
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/llm/stats", llm_stats)
+    app.router.add_get("/metrics", metrics)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    print(f"[ASYNC] serving /chat /reset /audio on {ASYNC_HOST}:{ASYNC_PORT} "
+          f"(executor {ASYNC_EXECUTOR_WORKERS} threads, LLM slots {LLM.max_inflight})")
+    web.run_app(make_app(), host=ASYNC_HOST, port=ASYNC_PORT, print=None)
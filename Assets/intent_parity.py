@@ -0,0 +1,133 @@
+#So sánh 1 backend embedding (vd. onnx-int8) với model gốc (torch fp32) trước khi đổi EMB_BACKEND:
+#độ chính xác intent trên INTENT_EXAMPLES + tập câu giữ lại (intent_heldout.json), mức trùng quyết định
+#giữa 2 backend, độ lệch embedding, thời gian encode và RAM tăng thêm khi nạp model.
+#Chạy:  python intent_parity.py onnx-int8 --reference torch --out parity.json
+#Thoát mã 1 nếu backend mới lệch quá ngưỡng (--min-agreement / --max-drop).
+import os, sys, json, time, argparse
+os.environ.setdefault("EMB_WARMUP", "0")
+import numpy as np
+import torch
+import ChatBox
+
+HELDOUT_PATH = os.path.join(ChatBox.BASE_DIR, "intent_heldout.json")
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return 0.0
+
+
+def encode(model, texts):
+    return np.asarray(model.encode(texts, normalize_embeddings=True, convert_to_numpy=True), dtype=np.float32)
+
+
+def decide(index, q_emb, labels):
+    #Chấm điểm đúng như server (IntentIndex.score: top-k láng giềng gần nhất theo từng intent)
+    results = index.score(torch.from_numpy(q_emb))
+    return np.array([labels.index(r[0]) for r in results]), np.array([r[1] for r in results])
+
+
+def evaluate(backend: str, ex_texts, labels, test_sets, repeats: int):
+    before = rss_mb()
+    start = time.perf_counter()
+    model = ChatBox.EMB_BACKENDS[backend](ChatBox.EMB_MODEL_NAME)
+    load_ms = (time.perf_counter() - start) * 1000.0
+    encode(model, ["warm up"])
+    rss_delta = rss_mb() - before
+
+    ex_emb = encode(model, ex_texts)
+    index = ChatBox.IntentIndex(ChatBox.INTENT_EXAMPLES, matrix=torch.from_numpy(ex_emb))
+    result = {"backend": backend, "load_ms": round(load_ms, 1), "rss_delta_mb": round(rss_delta, 1)}
+    preds = {}
+    for name, (texts, gold) in test_sets.items():
+        emb = ex_emb if name == "examples" else encode(model, texts)
+        pred, score = decide(index, emb, labels)
+        confident = score >= ChatBox.INTENT_THRESHOLD
+        #dưới ngưỡng thì ChatBox chuyển sang LLM → tính riêng độ chính xác của các quyết định "chắc chắn"
+        correct = pred == gold
+        result[name] = {
+            "count": len(texts),
+            "accuracy": round(float(correct.mean()), 4),
+            "confident_rate": round(float(confident.mean()), 4),
+            "confident_accuracy": round(float(correct[confident].mean()), 4) if confident.any() else None,
+        }
+        preds[name] = (pred, confident, emb)
+
+    timings = []
+    for i in range(repeats):
+        t = time.perf_counter()
+        encode(model, [test_sets["heldout"][0][i % len(test_sets["heldout"][0])]])
+        timings.append((time.perf_counter() - t) * 1000.0)
+    t = time.perf_counter()
+    encode(model, ex_texts)
+    result["encode_ms"] = {
+        "single_p50": round(ChatBox.percentile(timings, 50), 2),
+        "single_p95": round(ChatBox.percentile(timings, 95), 2),
+        "batch_all_examples": round((time.perf_counter() - t) * 1000.0, 2),
+    }
+    del model
+    return result, preds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Intent accuracy parity between embedding backends")
+    parser.add_argument("backend", choices=sorted(ChatBox.EMB_BACKENDS))
+    parser.add_argument("--reference", default="torch", choices=sorted(ChatBox.EMB_BACKENDS))
+    parser.add_argument("--heldout", default=HELDOUT_PATH)
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--min-agreement", type=float, default=0.98)
+    parser.add_argument("--max-drop", type=float, default=0.02)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    labels = list(ChatBox.INTENT_EXAMPLES.keys())
+    ex_texts, label_idx = [], []
+    for i, label in enumerate(labels):
+        ex_texts.extend(ChatBox.INTENT_EXAMPLES[label])
+        label_idx.extend([i] * len(ChatBox.INTENT_EXAMPLES[label]))
+    label_idx = np.array(label_idx)
+    with open(args.heldout, "r", encoding="utf-8") as f:
+        heldout = [e for e in json.load(f)["examples"] if e["intent"] in labels]
+    test_sets = {
+        "examples": (ex_texts, label_idx),
+        "heldout": ([e["text"] for e in heldout], np.array([labels.index(e["intent"]) for e in heldout])),
+    }
+
+    ref, ref_preds = evaluate(args.reference, ex_texts, labels, test_sets, args.repeats)
+    cand, cand_preds = evaluate(args.backend, ex_texts, labels, test_sets, args.repeats)
+
+    parity = {}
+    for name in test_sets:
+        (rp, rc, ref_emb), (cp, cc, cand_emb) = ref_preds[name], cand_preds[name]
+        cos = (ref_emb * cand_emb).sum(axis=1)
+        parity[name] = {
+            "label_agreement": round(float((rp == cp).mean()), 4),
+            "decision_agreement": round(float(((rp == cp) & (rc == cc)).mean()), 4),
+            "embedding_cosine_mean": round(float(cos.mean()), 4),
+            "embedding_cosine_min": round(float(cos.min()), 4),
+        }
+    drop = ref["heldout"]["accuracy"] - cand["heldout"]["accuracy"]
+    passed = all(p["label_agreement"] >= args.min_agreement for p in parity.values()) and drop <= args.max_drop
+    report = {
+        "model": ChatBox.EMB_MODEL_NAME,
+        "reference": ref,
+        "candidate": cand,
+        "parity": parity,
+        "heldout_accuracy_drop": round(drop, 4),
+        "passed": passed,
+    }
+    print(json.dumps(report, indent=2))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
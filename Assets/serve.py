@@ -0,0 +1,204 @@
+#Launcher production cho ChatBox.py và Web_Item/python_sever/database.py (thay cho app.run(debug=True) 1 process):
+#  - process cha nạp app 1 lần (ChatBox: model embedding + embedding intent, qua preload()), mở socket rồi fork N worker
+#    → các worker dùng chung trang bộ nhớ model (copy-on-write) và chung 1 socket (kernel chia kết nối)
+#  - worker chết bất thường → tự khởi động lại; SIGTERM / Ctrl+C → dừng êm: /ready trả 503, ngừng nhận kết nối,
+#    chờ request đang chạy (kể cả SSE) tối đa --graceful-timeout giây rồi mới thoát
+#  - /healthz (process còn sống) và /ready (sẵn sàng nhận traffic) cho load balancer / systemd / k8s
+#Chạy:  python serve.py chatbox --workers 4            (cổng mặc định 5000)
+#       python serve.py database --workers 2           (cổng mặc định 5002)
+#Windows không có fork → chạy 1 process, vẫn dùng server đa luồng + dừng êm.
+import os, sys, json, time, signal, socket, argparse, importlib, threading, traceback, gc
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APPS = {
+    "chatbox": (os.path.join(BASE_DIR, "ChatBox.py"), 5000),
+    "database": (os.path.join(BASE_DIR, "Web_Item", "python_sever", "database.py"), 5002),
+}
+CAN_FORK = hasattr(os, "fork")
+RESTART_BACKOFF = 1.0
+#worker chết ngay sau khi khởi động (< MIN_WORKER_UPTIME giây) → chờ 1 chút trước khi fork lại, tránh vòng lặp crash
+MIN_WORKER_UPTIME = 5.0
+
+
+class WorkerApp:
+    #Bọc app WSGI của worker: đếm request đang xử lý (tới khi response stream đóng) và trả 503 ở /ready khi đang dừng
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.draining = threading.Event()
+
+    def _done(self):
+        with self.lock:
+            self.inflight -= 1
+
+    def __call__(self, environ, start_response):
+        if self.draining.is_set() and environ.get("PATH_INFO") == "/ready":
+            body = json.dumps({"ready": False, "draining": True, "pid": os.getpid()}).encode()
+            start_response("503 SERVICE UNAVAILABLE", [("Content-Type", "application/json"),
+                                                       ("Content-Length", str(len(body)))])
+            return [body]
+        with self.lock:
+            self.inflight += 1
+        try:
+            return ClosingIterator(self.app(environ, start_response), self._done)
+        except BaseException:
+            self._done()
+            raise
+
+    def wait_idle(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while self.inflight > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return self.inflight == 0
+
+
+def load_app_module(name: str, prefork: bool, workers: int = 1):
+    path, _ = APPS[name]
+    sys.path.insert(0, os.path.dirname(path))
+    if prefork:
+        os.environ["CHATBOX_PREFORK"] = "1"
+        os.environ["CHATBOX_WORKERS"] = str(workers)
+    return importlib.import_module(os.path.splitext(os.path.basename(path))[0])
+
+
+def run_worker(module, args, index: int, fd=None) -> int:
+    app = WorkerApp(module.app)
+    server = make_server(args.host, args.port, app, threaded=True, fd=fd)
+    stopping = threading.Event()
+
+    def drain_then_shutdown():
+        time.sleep(args.drain_delay)
+        #đủ lâu để load balancer thấy /ready = 503 và ngừng gửi request mới
+        server.shutdown()
+
+    def stop(signum, frame):
+        if stopping.is_set():
+            return
+        stopping.set()
+        app.draining.set()
+        threading.Thread(target=drain_then_shutdown, name="drain", daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"[SERVE] worker {index} (pid {os.getpid()}) serving on {args.host}:{args.port}")
+    server.serve_forever()
+    idle = app.wait_idle(args.graceful_timeout)
+    hook = getattr(module, "on_worker_exit", None)
+    if hook is not None:
+        hook()
+    print(f"[SERVE] worker {index} (pid {os.getpid()}) stopped"
+          + ("" if idle else f", {app.inflight} requests cut off after {args.graceful_timeout}s"))
+    return 0
+
+
+def spawn(module, args, sock, index: int) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 1
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    #handler của process cha không áp dụng cho worker; run_worker đặt handler dừng êm khi đã sẵn sàng
+    try:
+        hook = getattr(module, "after_fork", None)
+        if hook is not None:
+            hook(args.torch_threads)
+        code = run_worker(module, args, index, fd=sock.fileno())
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def supervise(module, args, sock) -> int:
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+    workers = {}
+    #pid → (số thứ tự worker, lúc khởi động)
+    for i in range(args.workers):
+        workers[spawn(module, args, sock, i)] = (i, time.monotonic())
+    deadline = None
+    while workers:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            index, started = workers.pop(pid)
+            if not stopping.is_set():
+                print(f"[SERVE] worker {index} (pid {pid}) exited with status {status}, restarting")
+                if time.monotonic() - started < MIN_WORKER_UPTIME:
+                    time.sleep(RESTART_BACKOFF)
+                workers[spawn(module, args, sock, index)] = (index, time.monotonic())
+            continue
+        if stopping.is_set() and deadline is None:
+            print(f"[SERVE] shutting down {len(workers)} workers")
+            for pid in workers:
+                os.kill(pid, signal.SIGTERM)
+            deadline = time.monotonic() + args.drain_delay + args.graceful_timeout + 5.0
+        elif deadline is not None and time.monotonic() > deadline:
+            for pid in workers:
+                print(f"[SERVE] worker pid {pid} did not stop in time, killing")
+                os.kill(pid, signal.SIGKILL)
+            deadline = float("inf")
+        time.sleep(0.1)
+    sock.close()
+    print("[SERVE] all workers stopped")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-process production server for ChatBox / database API")
+    parser.add_argument("app", choices=sorted(APPS))
+    parser.add_argument("--host", default=os.environ.get("SERVE_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("SERVE_WORKERS", str(os.cpu_count() or 1))))
+    parser.add_argument("--torch-threads", type=int, default=None,
+                        help="intra-op threads per worker (default: cores / workers)")
+    parser.add_argument("--graceful-timeout", type=float, default=float(os.environ.get("SERVE_GRACEFUL_TIMEOUT", "30")))
+    parser.add_argument("--drain-delay", type=float, default=float(os.environ.get("SERVE_DRAIN_DELAY", "0")),
+                        help="seconds /ready reports 503 before a stopping worker closes its listener")
+    parser.add_argument("--backlog", type=int, default=512)
+    args = parser.parse_args()
+    args.port = args.port or APPS[args.app][1]
+    args.workers = max(1, args.workers)
+    if args.torch_threads is None:
+        args.torch_threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    if args.app == "chatbox" and args.workers > 1 and CAN_FORK:
+        if "SESSION_BACKEND" not in os.environ:
+            os.environ["SESSION_BACKEND"] = "sqlite"
+            print("[SERVE] SESSION_BACKEND=sqlite (history must be shared between workers)")
+        elif os.environ["SESSION_BACKEND"] != "sqlite":
+            print("[SERVE] WARNING: memory session store is per worker; a session may lose history between requests")
+        for name in ("TTS_ASYNC", "TTS_PIPELINE", "AUDIO_MEMORY"):
+            if os.environ.get(name) == "1":
+                print(f"[SERVE] WARNING: {name}=1 keeps state inside one worker (the next request may reach another); "
+                      f"disabled with --workers {args.workers}, use chatbox_async.py for that mode")
+        #ChatBox tự tắt các chế độ này khi CHATBOX_WORKERS > 1 (kể cả khi request bật "async_audio" / "tts_pipeline");
+        #cache TTS trên đĩa chuyển sang chế độ dùng chung (giới hạn dung lượng tính chung cho mọi worker)
+
+    start = time.perf_counter()
+    module = load_app_module(args.app, prefork=CAN_FORK, workers=args.workers)
+    if not CAN_FORK:
+        print("[SERVE] os.fork unavailable, running a single process")
+        return run_worker(module, args, 0)
+    hook = getattr(module, "preload", None)
+    if hook is not None:
+        hook()
+    gc.collect()
+    gc.freeze()
+    #đối tượng đã nạp chuyển sang thế hệ "vĩnh viễn": GC của worker không chạm tới → trang nhớ không bị copy
+    print(f"[SERVE] {args.app} loaded in {(time.perf_counter() - start) * 1000.0:.0f} ms, "
+          f"forking {args.workers} workers ({args.torch_threads} torch threads each)")
+
+    sock = socket.create_server((args.host, args.port), backlog=args.backlog)
+    sock.set_inheritable(True)
+    return supervise(module, args, sock)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+#Render trước MP3 cho các câu soạn sẵn (mục "canned" trong npc_personas.json) vào VOICE_BANK_DIR/<npc_id>/ (mặc định Assets/voice_bank~).
+#Tên file giống cache TTS (hash giọng + tốc độ + cao độ + câu) → đổi VOICE/RATE/PITCH thì chạy lại script.
+#Chạy lúc build (cần mạng tới Edge TTS):  python voice_bank.py [--npc snow] [--force] [--prune]
+#Server đang chạy: POST /voicebank/reload để nạp các clip mới.
+import os, sys, json, time, uuid, argparse
+os.environ.setdefault("EMB_WARMUP", "0")
+import ChatBox
+
+
+def render(text: str, out_path: str):
+    part_path = f"{out_path}.{uuid.uuid4().hex}.part"
+    try:
+        data = ChatBox.encode_audio(ChatBox.TTS_LOOP.synth(text))
+        #cùng định dạng server đang phục vụ (AUDIO_FORMAT: mp3 / opus)
+        with open(part_path, "wb") as f:
+            f.write(data)
+        os.replace(part_path, out_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-render canned NPC lines into the voice bank")
+    parser.add_argument("--npc", action="append", default=None, help="only these npc_id (repeatable)")
+    parser.add_argument("--force", action="store_true", help="re-render clips that already exist")
+    parser.add_argument("--prune", action="store_true", help="delete clips no longer referenced by any canned line")
+    args = parser.parse_args()
+
+    personas = ChatBox.PERSONAS.personas
+    npc_ids = args.npc or sorted(personas)
+    unknown = [n for n in npc_ids if n not in personas]
+    if unknown:
+        parser.error(f"unknown npc_id: {', '.join(unknown)}")
+
+    report = {"dir": ChatBox.VOICE_BANK_DIR, "voice": ChatBox.VOICE, "format": ChatBox.AUDIO_FORMAT,
+              "rendered": 0, "skipped": 0, "failed": [], "pruned": 0}
+    start = time.perf_counter()
+    for npc_id in npc_ids:
+        npc_dir = os.path.join(ChatBox.VOICE_BANK_DIR, npc_id)
+        os.makedirs(npc_dir, exist_ok=True)
+        wanted = set()
+        for intent, lines in personas[npc_id].canned.items():
+            for line in lines:
+                name = ChatBox.audio_name_for(line)
+                wanted.add(name)
+                out_path = os.path.join(npc_dir, name)
+                if os.path.exists(out_path) and not args.force:
+                    report["skipped"] += 1
+                    continue
+                try:
+                    render(line, out_path)
+                    report["rendered"] += 1
+                    print(f"[VOICEBANK] {npc_id}/{intent}: {line}")
+                except Exception as e:
+                    report["failed"].append({"npc_id": npc_id, "intent": intent, "text": line, "error": str(e)})
+                    print(f"[VOICEBANK ERROR] {npc_id}/{intent}: {e}")
+        if args.prune:
+            for name in os.listdir(npc_dir):
+                if ChatBox.is_audio_name(name) and name not in wanted:
+                    os.remove(os.path.join(npc_dir, name))
+                    report["pruned"] += 1
+    report["elapsed_s"] = round(time.perf_counter() - start, 2)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    ChatBox.TTS_LOOP.shutdown()
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
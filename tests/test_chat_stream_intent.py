@@ -0,0 +1,73 @@
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Assets")
+sys.path.insert(0, ASSETS_DIR)
+WORK_DIR = tempfile.mkdtemp(prefix="chatbox_test_")
+os.environ.setdefault("INTENT_INDEX_DIR", os.path.join(WORK_DIR, "intent_index"))
+os.environ.setdefault("SESSION_DB_PATH", os.path.join(WORK_DIR, "sessions.db"))
+os.environ.setdefault("TTS_TMP_DIR", os.path.join(WORK_DIR, "tmp"))
+
+import ChatBox  # noqa: E402
+
+# Thẻ intent xuất hiện SAU câu đầu (không nằm trong buffer đầu stream)
+LATE_TAG_PIECES = ["Ah, hello ", "there, traveler! ", "The road north has been quiet ", "for days now, ",
+                   "and the wolves ", "have not come back.\n", "INT", "ENT: ", "trade\n", "Care to see ", "my wares?"]
+
+
+def sse_events(body: str):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+@pytest.fixture
+def stream_reply(monkeypatch):
+    def run(pieces, session_id):
+        monkeypatch.setattr(ChatBox, "detect_intent_fast", lambda *a, **k: None)
+        monkeypatch.setattr(ChatBox, "stream_llm_tokens", lambda *a, **k: iter(pieces))
+        monkeypatch.setattr(ChatBox, "audio_url_for", lambda *a, **k: None)
+        resp = ChatBox.app.test_client().post("/chat/stream", json={
+            "text": "tell me about the north road", "session_id": session_id,
+            "single_call": True, "tts_pipeline": False, "fast_path": False,
+        })
+        return sse_events(resp.get_data(as_text=True))
+    return run
+
+
+def test_filter_holds_possible_tag_until_newline():
+    f = ChatBox.IntentTagFilter()
+    assert f.feed("Hello there.\n") == "Hello there.\n"
+    assert f.feed("INT") == ""
+    assert f.feed("ENT: trade") == ""
+    assert f.feed("\nSure, ") == "Sure, "
+    assert f.feed("in the tent.") == "in the tent."
+    assert f.feed("\nIntentionally so.") == "\nIntentionally so."
+    assert f.flush() == ""
+
+
+def test_late_intent_tag_never_reaches_tokens_or_history(stream_reply):
+    events = stream_reply(LATE_TAG_PIECES, "test-late-tag")
+    tokens = "".join(data["text"] for event, data in events if event == "token")
+    done = events[-1][1]
+    assert events[-1][0] == "done"
+    assert "INTENT" not in tokens.upper()
+    assert "INTENT" not in done["reply"].upper()
+    assert done["reply"].startswith("Ah, hello there, traveler!")
+    assert done["reply"].endswith("Care to see my wares?")
+    history = ChatBox.SESSION_STORE.get_state("test-late-tag")["history"]
+    assert history[-1]["role"] == "assistant"
+    assert "INTENT" not in history[-1]["content"].upper()
+
+
+def test_leading_intent_tag_still_sets_intent(stream_reply):
+    events = stream_reply(["INTENT: trade\n", "Take a look ", "at my wares, friend."], "test-lead-tag")
+    meta = [data for event, data in events if event == "meta"]
+    assert meta[0]["intent"] == "trade"
+    assert events[-1][1]["reply"] == "Take a look at my wares, friend."